@@ -1,9 +1,18 @@
 import streamlit as st
 import pandas as pd 
+import numpy as np
 import pdb
+import math
+import datetime
 from streamlit import session_state as ss
 
-from model import Model
+from model import Model, hash_units
+from model_points import ModelPoints
+import background
+import cache
+import disk_cache
+import mortality
+from diagnostics import Diagnostics
 
 
 
@@ -14,32 +23,75 @@ def group_monthly_to_yearly(monthly_values):
     Groups monthly values into yearly totals.
 
     Parameters:
-    - monthly_values: list or array-like, monthly values
+    - monthly_values: list or array-like, monthly values along the last axis (e.g. units x months)
 
     Returns:
-    - list: yearly totals
+    - np.ndarray: yearly totals along the last axis
     """
-    # Calculate the number of years based on the length of the monthly values
-    num_years = len(monthly_values) // 12  # Assuming complete years of monthly data
-    yearly_totals = []
+    monthly_values = np.asarray(monthly_values, dtype=float)
+    # Calculate the number of years based on the number of months
+    num_years = monthly_values.shape[-1] // 12  # Assuming complete years of monthly data
 
-    for year in range(num_years):
-        # Calculate the start and end index for the current year
-        start_index = year * 12
-        end_index = start_index + 12
-        
-        # Sum the monthly values for the current year
-        yearly_total = sum(monthly_values[start_index:end_index])
-        yearly_totals.append(yearly_total)
+    # Sum each block of 12 months at once
+    return monthly_values[..., :num_years * 12].reshape(monthly_values.shape[:-1] + (num_years, 12)).sum(axis=-1)
 
-    return yearly_totals
 
+# stage timers shared by the app and the model, see diagnostics.py
+if 'diagnostics' not in ss:
+    ss['diagnostics'] = Diagnostics.from_environment()
 
-units = pd.read_csv('units.csv')
+units = ss.diagnostics.measure('read units', lambda: ModelPoints.read_csv('units.csv'))
 
 
+# results are also cached on disk, shared with the other sessions and CLI runs, see disk_cache.py
 if 'model' not in ss:
-    ss['model'] = Model(units)   
+    ss['model'] = Model(units, ss.diagnostics, disk_cache.shared())
+
+# the model runs on a background thread, so that the last results stay on screen while new ones compute
+if 'runner' not in ss:
+    ss['runner'] = background.BackgroundRunner()
+
+# background runs shown in progress on this rerun, see refresh_when_done
+pending_runs = []
+
+
+def model_job(compute):
+    '''
+        background job calling compute(model) on the session's model, stopped at the next model stage once cancelled.
+    '''
+    model = ss.model
+
+    def job(cancelled):
+        with model.cancellable(cancelled):
+            return compute(model)
+
+    return job
+
+
+def background_result(slot, key, compute, label):
+    '''
+        result of compute(model) for the inputs key, computed in the background.
+
+        While a run for new inputs is in progress, the last good result is returned and a progress bar is shown;
+        the first result of the session is waited for. A run for earlier inputs still in progress is cancelled.
+    '''
+    run = ss.runner.submit(slot, key, model_job(compute))
+    latest = ss.runner.latest(slot)
+
+    if latest is None or run.done():
+        with st.spinner(label):
+            error = run.future.exception()
+        if error is None:
+            return run.result()
+        if latest is None:
+            raise error
+        st.exception(error)
+        return latest[1]
+
+    st.progress(ss.runner.progress(slot), text=label)
+    pending_runs.append(run)
+
+    return latest[1]
 
 
 # Set up the Streamlit page
@@ -58,12 +110,32 @@ with st.sidebar:
     # User Input Section
     st.header('Input Parameters')
 
-    mortality_table_label = st.selectbox('Mortality table', ['SAIFL98_SAIML98', 'CUSTOM', 'SA8590_light', 'SA8590_heavy'], 0)
+    # every mortality_table_<label>.csv and mortality_cohort_<label>.csv in the app directory, see mortality.table_labels
+    period_labels = mortality.table_labels('period')
+    generational_labels = mortality.table_labels('generational')
+    table_options = period_labels + [f'{label} (generational)' for label in generational_labels]
+    mortality_table_label = st.selectbox('Mortality table', table_options, table_options.index('SAIFL98_SAIML98') if 'SAIFL98_SAIML98' in table_options else 0)
+    generational = mortality_table_label not in period_labels
+
+    improvement_label = None
+    improvement_labels = mortality.table_labels('improvement')
+    if improvement_labels and not generational:
+        improvement_label = st.selectbox('Mortality improvement', ['None'] + improvement_labels, 0)
+        improvement_label = None if improvement_label == 'None' else improvement_label
+
+    if generational or improvement_label:
+        valuation_year = st.number_input('Valuation year', min_value=1900, max_value=2200, step=1, value=datetime.date.today().year)
+    if improvement_label:
+        improvement_base_year = st.number_input('Mortality table base year', min_value=1900, max_value=2200, step=1, value=valuation_year)
 
 
 
     longevity_loading_pct = st.slider('Longevity loading %', min_value=0, max_value=20, value=10)
 
+    # sidebar labels of the fractional age assumptions, see mortality.FRACTIONAL_ASSUMPTIONS
+    fractional_assumptions = {'Annual': None, 'Uniform distribution of deaths': 'udd', 'Constant force': 'constant_force', 'Balducci': 'balducci'}
+    fractional_assumption = fractional_assumptions[st.selectbox('Monthly mortality', list(fractional_assumptions), 0)]
+
 
 
 
@@ -101,26 +173,65 @@ with st.sidebar:
 
             refund_on_resale_duration = st.slider('Early exit term (years)', min_value=0, max_value=20, value=10)
 
-    if st.button('Generate Results'):
-        excel_data = ss.model.generate_excel()
-        #print(excel_data)
-        st.download_button(
-            label="Download Results",
-            data=excel_data,
-            file_name="retirement_village_model_results.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-
 
 
 
 #st.write(longevity_loading_pct)
-mortality_tables = pd.read_csv(f'mortality_table_{mortality_table_label}.csv')
+def load_mortality_tables():
+    if generational:
+        return mortality.load_generational_table(mortality_table_label[:-len(' (generational)')], valuation_year)
+    if improvement_label:
+        return mortality.load_improved_table(mortality_table_label, improvement_label, improvement_base_year, valuation_year)
+    return mortality.load_mortality_table(mortality_table_label)
+
+mortality_tables = ss.diagnostics.measure('read mortality table', load_mortality_tables)
+
+# inputs of the model calls, bound to the background jobs when they are submitted
+life_expectancy_args = (mortality_tables, longevity_loading_pct, fractional_assumption)
+main_args = (units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale, replacement, refund_on_resale_duration, single_double, package, purchase_price, monthly_fee, monthly_expense, fractional_assumption)
+life_expectancy_key = (mortality.mortality_table_key(mortality_tables),) + life_expectancy_args[1:]
+results_key = (mortality.mortality_table_key(mortality_tables), hash_units(units)) + main_args[2:]
+
+
+# interactive reruns only read the result cache, results are written to it once they are exported to Excel
+def compute_results(model, args=main_args):
+    results = model.main(*args, cache_result=False)
+    return results, model.all_workings, model.store
+
+
+def compute_excel(model, life_expectancy_args=life_expectancy_args, main_args=main_args):
+    model.remaining_life_expectancies(*life_expectancy_args)
+    model.main(*main_args, cache_result=False)
+    model.write_result_cache()
+    return model.generate_excel()
+
+
+with st.sidebar:
+    # the workbook is built in the background, and offered for download while the inputs stay the same
+    if st.button('Generate Results'):
+        ss['excel_key'] = results_key
+
+    if ss.get('excel_key') == results_key:
+        run = ss.runner.submit('excel', results_key, model_job(compute_excel))
+        if not run.done():
+            st.progress(ss.runner.progress('excel'), text='Building results workbook')
+            pending_runs.append(run)
+        elif run.error() is not None:
+            st.exception(run.error())
+        else:
+            st.download_button(
+                label="Download Results",
+                data=run.result(),
+                file_name="retirement_village_model_results.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+    elif 'excel_key' in ss:
+        ss.runner.cancel('excel')
 
 #packages = ['Life Rights Single', 'Life Rights Double', 'Rental Single', 'Rental Double']
 #tab1, tab2, tab3, tab4, tab5 = st.tabs(["Life Expectancies"] + packages)
 
-tab000, tab2, tab1, tab00, tab0 = st.tabs(['User Guide', 'Results', 'Life Expectancies', 'Model Points', 'Mortality Rates'])
+tab000, tab2, tab1, tab00, tab0, tab_diagnostics = st.tabs(['User Guide', 'Results', 'Life Expectancies', 'Model Points', 'Mortality Rates', 'Diagnostics'])
 
 with tab000:
     st.header('Overview')
@@ -131,6 +242,7 @@ with tab000:
     st.markdown('- Life Expectancies')
     st.markdown('- Model Points')
     st.markdown('- Mortality Rates')
+    st.markdown('- Diagnostics')
     st.write('Results can be downloaded using the "Generate Results" and "Download Results" buttons at the bottom of the sidebar.')
     st.write('The input parameters will be described in more detail below.')
     st.header('Input Parameters')
@@ -142,12 +254,26 @@ with tab000:
         - 'SAIFL98_SAIML98': A standard South African mortality table.
         - 'CUSTOM': A custom mortality table.
         - 'SA8590_light' & 'SA8590_heavy': Mortality tables based on South African assumptions for various population demographics. The rates in this table are not split by gender.
+        - Any other table saved as mortality_table_<name>.csv (rates by age) or mortality_cohort_<name>.csv (generational, rates by 'Age' and 'Year', shown as '<name> (generational)') in the model directory.
     - **Recommended Value**: SAIFL98_SAIML98.
 
+    ### Mortality Improvement
+    - **Description**: Only shown when improvement scales are saved as mortality_improvement_<name>.csv, with 'Age', 'Year', 'MaleImprovement' and 'FemaleImprovement' columns (the annual reduction in mortality rates). The mortality table is taken to be the rates of the 'Mortality table base year' and reduced by the scale for each later year. Ages and years outside the scale use its nearest age and year.
+    - **Recommended Value**: None.
+
+    ### Valuation Year
+    - **Description**: The calendar year of the ages in the model points, shown for generational tables and mortality improvement. Each unit is valued with the rates of its own year of birth.
+
     ### Longevity Loading %
     - **Description**: This parameter allows you to adjust the mortality rates used in the model. Increasing this parameter will decrease the mortality rates used in the model, resulting in longer life expectancies and reduced profitability of the Life Rights Package.
     - **Recommended Value**: To allow for uncertainty and prudence in the mortality rates, recommend applying a 10% longevity loading to the mortality rates.
 
+    ### Monthly Mortality
+    - **Description**: How life expectancies are calculated from the annual mortality rates.
+        - **Annual**: Life expectancies in whole years of survival, increased by the longevity loading.
+        - **Uniform distribution of deaths**, **Constant force** and **Balducci**: Life expectancies in months, with survival within each year of age following the chosen assumption. The longevity loading reduces the mortality rates themselves (e.g. a 10% loading uses 90% of each rate).
+    - **Recommended Value**: Annual, which matches earlier versions of the model.
+
     ### Property Investment Return (annual %)
     - **Description**: Represents the annual return on property investments as a percentage. This is used to project future investment returns for the retirement village.
     - **Range**: -10% to 10%.
@@ -162,7 +288,7 @@ with tab000:
     - **Range**: 0 to 40 years (default 40 years).
 
     ### Single or Double
-    - **Description**: Choose between a single or double occupancy for the unit.
+    - **Description**: Choose between a single or double occupancy for the unit. A double unit is occupied until the second death, so its occupancy is projected with the joint (last survivor) life expectancy of the main member and spouse, which is longer than either of their own life expectancies.
     - **Options**: 'Single' or 'Double' (default 'Single').
 
     ### Package Type
@@ -198,43 +324,51 @@ with tab000:
     ### Early Exit Term (years)
     - **Description**: Defines the number of years during which the refund applies for residents exiting early.
     - **Range**: 0-20 years (default 10 years).
-    """)  
+
+    ### Per Unit Parameters
+    - **Description**: The model points file can set the package and pricing of each unit with 'Single/Double', 'Package', 'Purchase Price', 'Monthly Fee' and 'Monthly Expense' columns. The sidebar values are used for units without these columns or with blank values, so a portfolio can mix Life Rights and Rental, Single and Double units.
+    """)
 
 with tab00:
-    df = units.set_index('ID', drop=True)
+    df = units.to_frame().set_index('ID', drop=True)
     st.dataframe(df)
 
 with tab0:
     st.write('Mortality rates before longevity loading adjustment')
-    df = mortality_tables.set_index('Age', drop=True)
+    if isinstance(mortality_tables, mortality.GenerationalTable):
+        df = mortality_tables.to_frame().set_index(['Age', 'Year'], drop=True)
+    else:
+        df = mortality_tables.set_index('Age', drop=True)
     st.dataframe(df)
 
 with tab1:
     st.header('Life Expectancy from various ages')
 
-    df, fig = ss['model'].remaining_life_expectancies(mortality_tables, longevity_loading_pct)
-    st.plotly_chart(fig)
-    st.write('**Life Expectancy from Various Ages Data**')
-    df = df.set_index('Age', drop=True)
-    st.dataframe(df)
+    df, fig = background_result('life_expectancies', life_expectancy_key, lambda model, args=life_expectancy_args: model.remaining_life_expectancies(*args), 'Calculating life expectancies')
+    with ss.diagnostics.section('render life expectancies'):
+        st.plotly_chart(fig)
+        st.write('**Life Expectancy from Various Ages Data**')
+        df = df.set_index('Age', drop=True)
+        st.dataframe(df)
 
 
 
 
 with tab2:
 
-    df = ss['model'].main(units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale, replacement, refund_on_resale_duration, single_double, package, purchase_price, monthly_fee, monthly_expense)
+    df, data, store = background_result('results', results_key, compute_results, 'Calculating results')
     df = df.set_index('ID', drop=True)
 
-    st.header("Summary Graph")
-    st.bar_chart(df['NPV'], y_label="net present value")
+    with ss.diagnostics.section('render summary'):
+        st.header("Summary Graph")
+        st.bar_chart(df['NPV'], y_label="net present value")
     
 
 #    with 
-    #units_package = units[units['Package'] == package]
-    st.header("Summary Cashflows")
+        #units_package = units[units['Package'] == package]
+        st.header("Summary Cashflows")
     
-    st.dataframe(df)
+        st.dataframe(df)
 
     #  col1, col2 = st.columns(2)
 
@@ -261,30 +395,63 @@ with tab2:
 
 
 
-    data = ss.model.all_workings
-#    # Create tabs based on the keys of the dictionary
-#    tabs = st.tabs(list(data.keys()))
-
+    # one page of units at a time, so the page does not grow with the number of units
+    unit_ids = list(data)
 
     st.subheader("Graphs")
-    # Display each tab's content
-    for i, (key, content) in enumerate(data.items()):
-       # with tabs[i]:
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox('Units per page', [10, 25, 50, 100], 0)
+    with col2:
+        n_pages = max(1, math.ceil(len(unit_ids) / page_size))
+        page = st.number_input('Page', min_value=1, max_value=n_pages, value=1, step=1)
+    page_ids = unit_ids[(page - 1) * page_size:page * page_size]
+
+    with ss.diagnostics.section('render graphs', len(page_ids)):
+        st.caption(f'Units {(page - 1) * page_size + 1} to {(page - 1) * page_size + len(page_ids)} of {len(unit_ids)}')
+        positions = [store.position(key) for key in page_ids]
+        values_to_plot = group_monthly_to_yearly(store.leg('All Discounted Cashflows', positions))
+        # Create a DataFrame for plotting, one column per unit
+        plot_df = pd.DataFrame(values_to_plot.T, columns=[str(key) for key in page_ids])
+        plot_df.index.name = 'Year'
+        # Display the bar chart
+        st.bar_chart(plot_df, x_label='years', y_label='present value of cashflows')
+
+    st.subheader("Cashflows Breakdown")
+    with ss.diagnostics.section('render breakdown', 1):
+        key = st.selectbox('Unit', page_ids)
+        if key is not None:
+            content = data[key].set_index('Month')
+            st.write(content)
 
+with tab_diagnostics:
+    st.header('Diagnostics')
+    st.write('Time, call counts and memory of each stage of the model and of the app, accumulated over reruns. Set the RETIREMENT_VILLAGE_DIAGNOSTICS environment variable to 1 (or to profile and/or memory, comma separated, for cProfile and tracemalloc captures) to record them from the start of the session.')
 
+    ss.diagnostics.enabled = st.checkbox('Record diagnostics', value=ss.diagnostics.enabled)
+    if st.button('Reset diagnostics'):
+        ss.diagnostics.reset()
 
-        values_to_plot = content['All Discounted Cashflows']
-        values_to_plot = group_monthly_to_yearly(values_to_plot)
-    # pdb.set_trace()
-        st.write(f'**{key}**')
-        # Create a DataFrame for plotting
-        #plot_df = pd.DataFrame({'Year': [int(x / 12) for x in range(len(values_to_plot))], 'Discounted Cashflows': values_to_plot})
-        plot_df = pd.DataFrame({'Year': [x for x in range(len(values_to_plot))], 'Discounted Cashflows': values_to_plot})
-        # Display the bar chart
-        st.bar_chart(plot_df.set_index('Year'), x_label='years', y_label='present value of cashflows')
+    st.subheader('Stages')
+    st.dataframe(ss.diagnostics.report().set_index('stage'))
 
-    st.subheader("Cashflows Breakdown")
-    for i, (key, content) in enumerate(data.items()):
-        st.write(f'**{key}**')
-        content = content.set_index('Month')
-        st.write(content)
\ No newline at end of file
+    st.subheader('Cache')
+    st.write(cache.shared.stats())
+
+    if ss.model.result_cache is not None:
+        st.subheader('Result cache')
+        st.write(ss.model.result_cache.stats())
+
+    if ss.diagnostics.profile:
+        st.subheader('Profile')
+        st.dataframe(ss.diagnostics.profile_report())
+
+
+# rerun once the background runs in progress above have finished
+if pending_runs:
+    @st.fragment(run_every=0.5)
+    def refresh_when_done(runs=tuple(pending_runs)):
+        if all(run.done() for run in runs):
+            st.rerun()
+
+    refresh_when_done()
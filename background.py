@@ -0,0 +1,151 @@
+'''
+    Background computation for the app.
+
+    A BackgroundRunner runs model calls on a worker thread so that the Streamlit
+    script can render the last good results straight away. Each kind of
+    computation has a slot (e.g. 'results' or 'excel') holding its latest run,
+    keyed by its inputs. Submitting a run with new inputs to a slot cancels the
+    run it supersedes. A run still waiting is dropped, and a running one is told
+    to stop through its cancelled event (Model.cancellable checks it between
+    model stages).
+
+    Runs execute one at a time in submission order. They share the session's
+    Model, whose stages are not safe to build concurrently.
+'''
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+
+class Run:
+    '''
+        one submitted computation.
+
+        Attributes:
+        key: the inputs the run computes results for.
+        cancelled (threading.Event): set when the run is superseded or cancelled.
+        future (concurrent.futures.Future): the result of function(cancelled).
+    '''
+
+    def __init__(self, key, function):
+        self.key = key
+        self.function = function
+        self.cancelled = threading.Event()
+        self.future = None
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def error(self):
+        '''
+            the exception raised by a run that failed without being cancelled, else None.
+        '''
+        if not self.future.done() or self.cancelled.is_set():
+            return None
+        try:
+            return self.future.exception()
+        except CancelledError:
+            return None
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+
+class BackgroundRunner:
+    '''
+        run functions on a worker thread, keeping the latest run and the last good result of each slot.
+
+        Parameters:
+        max_workers (int): number of worker threads, 1 so that runs sharing a Model never overlap.
+    '''
+
+    def __init__(self, max_workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='background')
+        self.lock = threading.Lock()
+        self.runs = {}
+        # slot -> (key, value) of its last completed run and how long that run took
+        self.results = {}
+        self.durations = {}
+
+    def submit(self, slot, key, function):
+        '''
+            run function(cancelled) for key in slot, unless the latest run of the slot is already for key.
+
+            The previous run of the slot is cancelled if it was for other inputs, or retried if it was itself cancelled.
+        '''
+        with self.lock:
+            run = self.runs.get(slot)
+            if run is not None and run.key == key and not run.cancelled.is_set():
+                return run
+            if run is not None:
+                run.cancel()
+
+            run = Run(key, function)
+            run.future = self.executor.submit(self.execute, slot, run)
+            self.runs[slot] = run
+
+            return run
+
+    def execute(self, slot, run):
+        if run.cancelled.is_set():
+            raise CancelledError()
+
+        run.started = time.perf_counter()
+        try:
+            value = run.function(run.cancelled)
+        finally:
+            run.finished = time.perf_counter()
+
+        with self.lock:
+            if not run.cancelled.is_set():
+                self.results[slot] = (run.key, value)
+                self.durations[slot] = run.elapsed()
+
+        return value
+
+    def cancel(self, slot):
+        with self.lock:
+            run = self.runs.pop(slot, None)
+        if run is not None:
+            run.cancel()
+
+    def latest(self, slot):
+        '''
+            (key, value) of the last completed run of a slot, None before the first.
+        '''
+        with self.lock:
+            return self.results.get(slot)
+
+    def progress(self, slot):
+        '''
+            rough fraction of the latest run of a slot that is done, from how long its last completed run took.
+        '''
+        with self.lock:
+            run = self.runs.get(slot)
+            duration = self.durations.get(slot)
+
+        if run is None or run.done():
+            return 1.0
+        if not duration:
+            return 0.0
+
+        return min(run.elapsed() / duration, 0.99)
+
+    def shutdown(self):
+        with self.lock:
+            runs = list(self.runs.values())
+        for run in runs:
+            run.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,276 @@
+'''
+    Benchmarks of the model on synthetic portfolios.
+
+    Synthetic unit files with mixed ages, genders and Single/Double units are
+    generated for each size and run against every shipped mortality table, across
+    projection terms and with replacement on and off. Every case runs in its own
+    forked process so that its peak RSS is measured on its own.
+
+    Each run is appended to a JSON history (benchmark_history.json by default) with
+    the wall time of every model stage, the throughput in unit-months per second and
+    the peak RSS of each case, and compared with the previous run so that
+    regressions between versions are visible.
+
+        python benchmark.py --sizes 1 1000 100000 --terms 1 10 40
+        python benchmark.py --sizes 1000000 --terms 40 --benchmarks main
+'''
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import cache
+import mortality
+from diagnostics import Diagnostics, peak_rss
+from model import Model
+
+
+BENCHMARKS = ['main', 'calculate_life_expectancy', 'remaining_life_expectancies', 'generate_excel']
+
+# parameters of every case other than the term and replacement, the app's defaults with refunds on
+PARAMETERS = {
+    'longevity_loading_pct': 10,
+    'discount_rate': 10,
+    'investment_return': 0,
+    'refund_on_resale_pct': 80,
+    'refund_on_resale_duration': 10,
+    'single_double': 'Single',
+    'package': 'Life Rights',
+    'purchase_price_input': 125000,
+    'monthly_fee': 1000,
+    'monthly_expense': 1000,
+}
+
+
+def synthetic_units(n, seed=0, double_fraction=0.5, min_age=55, max_age=95):
+    '''
+        synthetic units file with n units of mixed ages and genders, a double_fraction of them Double units.
+
+        Spouses are a few years younger than the main member on average. Single units have no spouse.
+    '''
+    rng = np.random.default_rng(seed)
+
+    main_ages = rng.integers(min_age, max_age + 1, n)
+    spouse_ages = np.clip(main_ages + np.rint(rng.normal(-3, 4, n)).astype(np.int64), min_age, max_age)
+    main_genders = rng.choice(['Male', 'Female'], n)
+    double = rng.random(n) < double_fraction
+
+    return pd.DataFrame({
+        'ID': [f'Unit {i}' for i in range(n)],
+        'Main Member Age': main_ages,
+        'Main Member Gender': main_genders,
+        'Spouse Age': np.where(double, spouse_ages, np.nan),
+        'Spouse Gender': np.where(double, np.where(main_genders == 'Male', 'Female', 'Male'), None),
+        'Single/Double': np.where(double, 'Double', 'Single'),
+    })
+
+
+def benchmark_main(units, mortality_tables, term, replacement):
+    model = Model(units, Diagnostics(enabled=True))
+    model.main(units, mortality_tables, investment_term=term, replacement=replacement, workings=False, **PARAMETERS)
+
+    report = model.diagnostics.report()
+    return report['seconds'].sum(), dict(zip(report['stage'], report['seconds']))
+
+
+def benchmark_calculate_life_expectancy(units, mortality_tables, max_calls=10000):
+    '''
+        time of the scalar calculate_life_expectancy (per call, over up to max_calls units) and of the vectorised
+        calculate_life_expectancies for all units.
+    '''
+    model = Model(units)
+    ages = units['Main Member Age'].to_numpy()
+    genders = units['Main Member Gender'].to_numpy()
+    calls = min(len(units), max_calls)
+
+    start = time.perf_counter()
+    for age, gender in zip(ages[:calls].tolist(), genders[:calls].tolist()):
+        model.calculate_life_expectancy(mortality_tables, age, gender, PARAMETERS['longevity_loading_pct'])
+    scalar = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.calculate_life_expectancies(mortality_tables, ages, genders, PARAMETERS['longevity_loading_pct'])
+    vectorised = time.perf_counter() - start
+
+    return scalar + vectorised, {'calculate_life_expectancy (per call)': scalar / max(calls, 1), 'calculate_life_expectancies': vectorised}
+
+
+def benchmark_remaining_life_expectancies(mortality_tables):
+    model = Model(pd.DataFrame())
+
+    start = time.perf_counter()
+    model.remaining_life_expectancies(mortality_tables, PARAMETERS['longevity_loading_pct'])
+    seconds = time.perf_counter() - start
+
+    return seconds, {'remaining_life_expectancies': seconds}
+
+
+def benchmark_generate_excel(units, mortality_tables, term, replacement):
+    model = Model(units, Diagnostics(enabled=True))
+    model.main(units, mortality_tables, investment_term=term, replacement=replacement, **PARAMETERS)
+    model.generate_excel()
+
+    report = model.diagnostics.report()
+    return report['seconds'].sum(), dict(zip(report['stage'], report['seconds']))
+
+
+def run_case(case):
+    '''
+        run one benchmark case (in a fresh process) and return its record.
+    '''
+    # every case starts from an empty cache, as a fresh app or batch run would
+    cache.shared.clear()
+
+    mortality_tables = mortality.load_mortality_table(case['mortality_table'])
+    units = synthetic_units(case['units'], case['seed']) if case['units'] is not None else None
+
+    benchmark = case['benchmark']
+    if benchmark == 'main':
+        seconds, stages = benchmark_main(units, mortality_tables, case['term'], case['replacement'])
+    elif benchmark == 'calculate_life_expectancy':
+        seconds, stages = benchmark_calculate_life_expectancy(units, mortality_tables)
+    elif benchmark == 'remaining_life_expectancies':
+        seconds, stages = benchmark_remaining_life_expectancies(mortality_tables)
+    elif benchmark == 'generate_excel':
+        seconds, stages = benchmark_generate_excel(units, mortality_tables, case['term'], case['replacement'])
+    else:
+        raise ValueError(f'Unknown benchmark {benchmark}, expected one of {BENCHMARKS}')
+
+    record = dict(case, seconds=seconds, stages=stages, peak_rss_bytes=peak_rss())
+    if case['term'] is not None:
+        record['unit_months_per_second'] = case['units'] * case['term'] * 12 / seconds if seconds else None
+    elif case['units'] is not None:
+        record['units_per_second'] = case['units'] / seconds if seconds else None
+
+    return record
+
+
+def cases(benchmarks, sizes, mortality_tables, terms, replacements, excel_max_units, seed=0):
+    '''
+        benchmark cases for every combination of the arguments that applies to each benchmark.
+    '''
+    for benchmark in benchmarks:
+        for mortality_table in mortality_tables:
+            if benchmark == 'remaining_life_expectancies':
+                yield {'benchmark': benchmark, 'mortality_table': mortality_table, 'units': None, 'term': None, 'replacement': None, 'seed': seed}
+            elif benchmark == 'calculate_life_expectancy':
+                for size in sizes:
+                    yield {'benchmark': benchmark, 'mortality_table': mortality_table, 'units': size, 'term': None, 'replacement': None, 'seed': seed}
+            else:
+                for size, term, replacement in itertools.product(sizes, terms, replacements):
+                    if benchmark == 'generate_excel' and size > excel_max_units:
+                        continue
+                    yield {'benchmark': benchmark, 'mortality_table': mortality_table, 'units': size, 'term': term, 'replacement': replacement, 'seed': seed}
+
+
+def case_key(record):
+    return tuple(record[name] for name in ('benchmark', 'mortality_table', 'units', 'term', 'replacement'))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_history(path, history):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(history, file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def comparison(records, previous):
+    '''
+        records with the seconds and peak RSS of the matching case of the previous run and their ratios.
+    '''
+    previous = {case_key(record): record for record in previous.get('results', [])} if previous else {}
+
+    rows = []
+    for record in records:
+        row = {name: record[name] for name in ('benchmark', 'mortality_table', 'units', 'term', 'replacement', 'seconds', 'peak_rss_bytes')}
+        row['throughput'] = record.get('unit_months_per_second', record.get('units_per_second'))
+        before = previous.get(case_key(record))
+        row['previous seconds'] = before['seconds'] if before else None
+        row['time ratio'] = record['seconds'] / before['seconds'] if before and before['seconds'] else None
+        row['rss ratio'] = record['peak_rss_bytes'] / before['peak_rss_bytes'] if before and before['peak_rss_bytes'] and record['peak_rss_bytes'] is not None else None
+        rows.append(row)
+
+    return pd.DataFrame(rows).astype({'units': 'Int64', 'term': 'Int64'})
+
+
+def format_rss(nbytes):
+    # peak RSS is None where the resource module is not available
+    return f'{nbytes / 1024 / 1024:.1f} MiB' if nbytes is not None else 'n/a'
+
+
+def run(benchmarks=BENCHMARKS, sizes=(1, 1000, 100000), mortality_tables=None, terms=(1, 10, 40), replacements=(False, True), excel_max_units=100, history_path='benchmark_history.json', seed=0):
+    '''
+        run the benchmark cases, append them to the history and return the comparison with the previous run.
+    '''
+    if mortality_tables is None:
+        mortality_tables = mortality.table_labels()
+
+    context = multiprocessing.get_context('fork')
+    records = []
+    for case in cases(benchmarks, sizes, mortality_tables, terms, replacements, excel_max_units, seed):
+        # a new process per case, so that peak RSS is per case
+        with context.Pool(1) as pool:
+            record = pool.apply(run_case, (case,))
+        records.append(record)
+        print(f"{record['benchmark']:<28}{record['mortality_table']:<18}{str(record['units']):>9}{str(record['term']):>5}{str(record['replacement']):>7}{record['seconds']:>10.3f}s{format_rss(record['peak_rss_bytes']):>14}", file=sys.stderr)
+
+    history = read_history(history_path)
+    result = comparison(records, history[-1] if history else None)
+
+    history.append({
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': records,
+    })
+    write_history(history_path, history)
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the model on synthetic portfolios.')
+    parser.add_argument('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1, 1000, 100000], help='numbers of units (up to 1,000,000)')
+    parser.add_argument('--mortality-tables', nargs='+', help='mortality table labels, defaults to every shipped table')
+    parser.add_argument('--terms', nargs='+', type=int, default=[1, 10, 40], help='projection terms in years')
+    parser.add_argument('--replacement', nargs='+', choices=['on', 'off'], default=['off', 'on'])
+    parser.add_argument('--excel-max-units', type=int, default=100, help='largest portfolio to write to Excel')
+    parser.add_argument('--history', default='benchmark_history.json', help='JSON history the run is appended to')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    result = run(args.benchmarks, args.sizes, args.mortality_tables, args.terms, [value == 'on' for value in args.replacement], args.excel_max_units, args.history, args.seed)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(result.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
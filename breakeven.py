@@ -0,0 +1,90 @@
+'''
+    Break-even values of the model parameters for every unit.
+
+    The NPV of a unit is linear in the purchase price, monthly fee, monthly expense
+    and refund %, since each only scales one or two cashflow legs of a fixed exit
+    schedule. The break-even value of these follows directly from the present
+    values of one projection.
+
+    Other parameters (the discount rate, investment return and early exit term)
+    change the NPV nonlinearly. They are solved by bisection on all units at once:
+    every unit has its own bracket, and each step evaluates the NPV of every unit at
+    its own midpoint from the same exit schedule and cashflow legs.
+'''
+import numpy as np
+
+import engine
+
+
+def linear_breakeven(slope, intercept, target_npv):
+    '''
+        x solving slope * x + intercept = target_npv for every unit, NaN where the NPV does not depend on x.
+    '''
+    slope = np.asarray(slope, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(slope != 0, (target_npv - intercept) / slope, np.nan)
+
+
+def bisect(function, low, high, tolerance=1e-6, max_iterations=100):
+    '''
+        root of function(x) = 0 for every unit by bisection, where function maps an array with a value per unit to an
+        array with a value per unit.
+
+        Parameters:
+        low, high (array-like): bracket of each unit.
+        tolerance (float): stop once every bracket is narrower than this.
+        max_iterations (int): maximum number of bisection steps.
+
+        Returns:
+        np.ndarray: the root of each unit, NaN where function has the same sign at both ends of its bracket.
+    '''
+    low = np.array(low, dtype=float)
+    high = np.array(high, dtype=float)
+
+    f_low = function(low)
+    f_high = function(high)
+    bracketed = np.sign(f_low) * np.sign(f_high) <= 0
+
+    for _ in range(max_iterations):
+        if not bracketed.any() or np.max((high - low)[bracketed]) < tolerance:
+            break
+
+        middle = (low + high) / 2
+        f_middle = function(middle)
+
+        # keep the half of the bracket in which function changes sign
+        lower = np.sign(f_middle) == np.sign(f_low)
+        low = np.where(lower, middle, low)
+        f_low = np.where(lower, f_middle, f_low)
+        high = np.where(lower, high, middle)
+
+    root = np.where(f_low == 0, low, (low + high) / 2)
+
+    return np.where(bracketed, root, np.nan)
+
+
+def discount_factors(discount_rates, months):
+    '''
+        (units x months) discount factors for an annual discount rate (in %) per unit.
+    '''
+    return 1/(1 + engine.unit_column(np.asarray(discount_rates, dtype=float))/(100*12)) ** np.arange(months)
+
+
+def present_values(cashflows, factors):
+    '''
+        present value of each unit of (units x months) cashflows, with a vector of discount factors or a row per unit.
+    '''
+    if np.ndim(factors) == 1:
+        return engine.present_values(cashflows, factors)
+    return np.einsum('ij,ij->i', cashflows, factors)
+
+
+def price_legs(schedule, last_life_expectancies, is_life_rights, investment_return, purchase_price, refund_on_resale_pct, refund_on_resale_duration):
+    '''
+        sale and refund legs of the Life Rights units (zero for other units), for per unit parameters.
+    '''
+    prices = engine.occupant_prices(schedule, last_life_expectancies, investment_return, purchase_price)
+    sale = np.where(is_life_rights, engine.sale_leg(schedule, prices), 0.0)
+    refund = np.where(is_life_rights, engine.refund_leg(schedule, prices, last_life_expectancies, refund_on_resale_pct, refund_on_resale_duration), 0.0)
+
+    return sale, refund
@@ -0,0 +1,138 @@
+'''
+    In-process cache shared by every Streamlit session and rerun.
+
+    Parsed CSV files and anything derived from them are kept in a single LRU cache
+    bounded by both the number of entries and their total size in bytes. Files are
+    keyed by path, modification time and size so that editing a CSV invalidates
+    its cached copy on the next read.
+'''
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def estimate_nbytes(value):
+    '''
+        rough size in bytes of a cached value.
+    '''
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return value.nbytes + sum(sys.getsizeof(x) for x in value.ravel())
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(x) for x in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(x) for x in value)
+    if hasattr(value, '__dict__'):
+        return estimate_nbytes(vars(value))
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    '''
+        thread safe least recently used cache bounded by entry count and total bytes.
+    '''
+
+    def __init__(self, max_entries=256, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build):
+        '''
+            return the cached value for key, calling build() to create it on a miss.
+        '''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = build()
+        self.put(key, value)
+
+        return value
+
+    def put(self, key, value):
+        nbytes = estimate_nbytes(value)
+
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+
+            # values larger than the whole cache are returned but not kept
+            if nbytes > self.max_bytes:
+                return
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+
+    def invalidate(self, predicate):
+        '''
+            drop every entry whose key satisfies predicate(key).
+        '''
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.nbytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+shared = LRUCache()
+
+
+def file_key(path):
+    '''
+        cache key for a file that changes whenever the file is modified.
+    '''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+def cached_file(kind, path, parse):
+    '''
+        parse(path) cached until the file changes.
+
+        Entries for earlier versions of the same file are dropped when a new version is read.
+    '''
+    key = (kind, file_key(path))
+    shared.invalidate(lambda k: k[0] == kind and k[1][0] == key[1][0] and k[1] != key[1])
+
+    return shared.get(key, lambda: parse(path))
+
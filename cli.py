@@ -0,0 +1,263 @@
+'''
+    Command line entry point for running the model in batch, outside Streamlit.
+
+    Reads a units CSV and a JSON or YAML config holding the parameters of
+    Model.main, runs the vectorised engine for every unit at once and writes the
+    results table to Parquet, CSV or Excel (by file extension). The wall time and
+    peak memory of every stage are reported on stderr (see diagnostics.py).
+
+        python cli.py units.csv config.json -o results.parquet --store cashflows.arrow
+
+    A config only needs the parameters that differ from the app's defaults, e.g.
+
+        {"mortality_table": "SA8590_light", "discount_rate": 8, "single_double": "Double"}
+
+    where mortality_table is a table label (as in the app) or the path to a mortality table CSV. A generational
+    table label (mortality_cohort_<label>.csv) or a mortality_improvement scale label also needs a
+    valuation_year, and an improvement scale applies from the period table's improvement_base_year.
+
+    With --scenarios, every unit is also valued under the discount_curves and/or investment_return_paths CSVs of the
+    config (see scenarios.py), e.g.
+
+        python cli.py units.csv config.json --scenarios scenario_npvs.parquet
+
+    With --chunk-size, a units file too large to value at once is streamed through the model that many units at a
+    time (see streaming.py). Only the portfolio aggregates (NPV totals, yearly cashflows and life expectancy
+    distributions) are kept, written with --aggregates to .xlsx or .json, and a single -o output gets the life
+    expectancies and NPVs of every unit (.csv or .parquet), e.g.
+
+        python cli.py portfolio.csv config.json --chunk-size 10000 --aggregates portfolio.xlsx -o npvs.parquet
+
+    Results are cached on disk and shared with the app (see disk_cache.py), so a repeat run with the same units,
+    mortality table and parameters reads them back. Use --no-result-cache to always run the model.
+
+    Only pandas and numpy are imported on this path (not streamlit or plotly); pyarrow,
+    openpyxl and PyYAML are imported only when a Parquet/Arrow, Excel or YAML file is used.
+'''
+import argparse
+import inspect
+import json
+import os
+import sys
+
+import pandas as pd
+
+import disk_cache
+import mortality
+from diagnostics import Diagnostics
+from model import Model
+from model_points import ModelPoints
+
+
+# defaults of the app's sidebar widgets
+DEFAULT_PARAMETERS = {
+    'mortality_table': 'SAIFL98_SAIML98',
+    'mortality_improvement': None,
+    'improvement_base_year': None,
+    'valuation_year': None,
+    'longevity_loading_pct': 10,
+    'discount_rate': 10,
+    'investment_term': 40,
+    'investment_return': 0,
+    'refund_on_resale_pct': 0,
+    'replacement': False,
+    'refund_on_resale_duration': 0,
+    'single_double': 'Single',
+    'package': 'Life Rights',
+    'purchase_price_input': 125000,
+    'monthly_fee': 1000,
+    'monthly_expense': 1000,
+    # None, 'udd', 'constant_force' or 'balducci', see Model.main
+    'fractional_assumption': None,
+    # curves CSVs of monthly rates per scenario for --scenarios, see scenarios.py
+    'discount_curves': None,
+    'investment_return_paths': None,
+}
+
+MAIN_PARAMETERS = [name for name in inspect.signature(Model.main).parameters if name not in ('self', 'units', 'mortality_tables', 'workings', 'cache_result')]
+
+
+def read_config(path):
+    '''
+        model parameters from a JSON or (.yaml/.yml) YAML file, on top of DEFAULT_PARAMETERS.
+    '''
+    with open(path) as file:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError as error:
+                raise ImportError('PyYAML is required to read YAML configs, install it with `pip install pyyaml`') from error
+            config = yaml.safe_load(file) or {}
+        else:
+            config = json.load(file)
+
+    unknown = sorted(set(config) - set(DEFAULT_PARAMETERS))
+    if unknown:
+        raise ValueError(f'Unknown parameters in {path}: {unknown}, expected some of {list(DEFAULT_PARAMETERS)}')
+
+    return {**DEFAULT_PARAMETERS, **config}
+
+
+def load_mortality_tables(table, mortality_improvement=None, improvement_base_year=None, valuation_year=None):
+    '''
+        mortality table DataFrame (or mortality.GenerationalTable) from a table label or the path to a mortality table
+        CSV, projected with the mortality_improvement scale label if given.
+    '''
+    if table.endswith('.csv'):
+        columns = mortality.read_mortality_table(table)
+        return pd.DataFrame({column: values.copy() for column, values in columns.items()})
+
+    generational = table in mortality.table_labels('generational') and table not in mortality.table_labels('period')
+    if (generational or mortality_improvement) and valuation_year is None:
+        raise ValueError('valuation_year is required for generational tables and mortality improvement')
+
+    if generational:
+        return mortality.load_generational_table(table, valuation_year)
+    if mortality_improvement:
+        base_year = improvement_base_year if improvement_base_year is not None else valuation_year
+        return mortality.load_improved_table(table, mortality_improvement, base_year, valuation_year)
+
+    return mortality.load_mortality_table(table)
+
+
+def write_results(model, path, results=None):
+    '''
+        write the results table (or other results, e.g. the scenario NPVs) to a .parquet, .csv or .xlsx file.
+    '''
+    if results is None:
+        results = model.cashflows
+
+    if path.endswith('.parquet'):
+        results.to_parquet(path, index=False)
+    elif path.endswith('.csv'):
+        results.to_csv(path, index=False)
+    elif path.endswith('.xlsx') and results is not model.cashflows:
+        results.to_excel(path, index=False)
+    elif path.endswith('.xlsx'):
+        model.write_excel(path, single_workings_sheet=True)
+    else:
+        raise ValueError(f'Unsupported output file {path}, expected .parquet, .csv or .xlsx')
+
+
+def write_aggregates(aggregates, path):
+    '''
+        write the aggregates of a streamed run (see streaming.PortfolioAggregates) to an .xlsx workbook with a sheet per
+        aggregate, or to a .json file.
+    '''
+    frames = aggregates.frames()
+    if path.endswith('.xlsx'):
+        with pd.ExcelWriter(path) as writer:
+            for name, frame in frames.items():
+                frame.to_excel(writer, sheet_name=name, index=False)
+    elif path.endswith('.json'):
+        with open(path, 'w') as file:
+            json.dump({'units': aggregates.units, **{name: frame.to_dict('records') for name, frame in frames.items()}}, file, indent=2)
+    else:
+        raise ValueError(f'Unsupported aggregates file {path}, expected .xlsx or .json')
+
+
+def format_bytes(nbytes):
+    if nbytes is None or pd.isna(nbytes):
+        return ''
+    return f'{nbytes / 1024 / 1024:.1f} MiB'
+
+
+def print_report(report, file=sys.stderr):
+    lines = [f"{'stage':<28}{'seconds':>10}{'peak':>14}{'peak RSS':>14}"]
+    for record in report.to_dict('records'):
+        lines.append(f"{record['stage']:<28}{record['seconds']:>10.3f}{format_bytes(record['peak bytes']):>14}{format_bytes(record['peak RSS bytes']):>14}")
+    lines.append(f"{'total':<28}{report['seconds'].sum():>10.3f}")
+
+    print('\n'.join(lines), file=file)
+
+
+def run(units_path, config_path, outputs=(), store_path=None, workings=False, trace_memory=True, report_path=None, profile=False, scenarios_path=None, result_cache=None, chunk_size=None, aggregates_path=None):
+    '''
+        run the model for a units CSV and config, writing the outputs.
+
+        Parameters:
+        units_path (str): units CSV, with the same columns as units.csv.
+        config_path (str): JSON or YAML model parameters, see DEFAULT_PARAMETERS.
+        outputs (list): results files to write (.parquet, .csv or .xlsx).
+        store_path (str): if given, save the monthly cashflows of every unit (see results_store.ResultsStore.save).
+        workings (bool): include the per unit workings in Excel outputs, which is much slower for large unit files.
+        trace_memory (bool): measure peak memory per stage with tracemalloc, which slows the run down somewhat.
+        report_path (str): if given, also write the stage report to this CSV or JSON file.
+        profile (bool): also run under cProfile, see the model's diagnostics.profile_report().
+        scenarios_path (str): if given, write the NPVs of every unit under the discount_curves and
+            investment_return_paths of the config to this file, see Model.value_scenarios.
+        result_cache (disk_cache.DiskCache): if given, reuse results cached on disk by earlier runs and the app.
+        chunk_size (int): if given, stream the units through the model this many at a time (see Model.stream). outputs
+            may then be a single .csv or .parquet file, which gets the life expectancies and NPVs of every unit.
+        aggregates_path (str): if given with chunk_size, write the portfolio aggregates to this .xlsx or .json file.
+
+        Returns:
+        tuple: the Model and the stage report DataFrame.
+    '''
+    if chunk_size and (len(outputs) > 1 or store_path or workings or scenarios_path):
+        raise ValueError('A streamed run (chunk_size) writes at most one per unit output, without a store, workings or scenarios')
+
+    diagnostics = Diagnostics(enabled=True, profile=profile, trace_memory=trace_memory)
+    try:
+        config = diagnostics.measure('read config', lambda: read_config(config_path))
+        mortality_tables = diagnostics.measure('read mortality table', lambda: load_mortality_tables(config['mortality_table'], config['mortality_improvement'], config['improvement_base_year'], config['valuation_year']))
+        parameters = {name: config[name] for name in MAIN_PARAMETERS}
+
+        if chunk_size:
+            # the units are read a chunk at a time by the model
+            model = Model(None, diagnostics)
+            aggregates = model.stream(units_path, mortality_tables, chunk_size, outputs[0] if outputs else None, **parameters)
+            if aggregates_path:
+                diagnostics.measure(f'write {os.path.basename(aggregates_path)}', lambda: write_aggregates(aggregates, aggregates_path))
+        else:
+            units = diagnostics.measure('read units', lambda: ModelPoints.read_csv(units_path))
+            model = Model(units, diagnostics, result_cache)
+            model.main(units, mortality_tables, workings=workings, **parameters)
+
+            for path in outputs:
+                diagnostics.measure(f'write {os.path.basename(path)}', lambda path=path: write_results(model, path))
+            if store_path:
+                diagnostics.measure(f'write {os.path.basename(store_path)}', lambda: model.store.save(store_path))
+            if scenarios_path:
+                scenario_results = model.value_scenarios(units, mortality_tables, config['discount_curves'], config['investment_return_paths'], **parameters)
+                diagnostics.measure(f'write {os.path.basename(scenarios_path)}', lambda: write_results(model, scenarios_path, scenario_results))
+    finally:
+        diagnostics.stop()
+
+    report = diagnostics.report()
+    if report_path:
+        if report_path.endswith('.json'):
+            report.to_json(report_path, orient='records', indent=2)
+        else:
+            report.to_csv(report_path, index=False)
+
+    return model, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the retirement village model in batch.')
+    parser.add_argument('units', help='units CSV')
+    parser.add_argument('config', help='JSON or YAML file of Model.main parameters')
+    parser.add_argument('-o', '--output', action='append', default=[], help='results file to write (.parquet, .csv or .xlsx), may be repeated')
+    parser.add_argument('--store', help='save the monthly cashflows of every unit to an Arrow (.arrow) or Parquet (.parquet) file')
+    parser.add_argument('--workings', action='store_true', help='include the per unit workings in Excel outputs')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false', help='do not measure peak memory per stage with tracemalloc')
+    parser.add_argument('--report', help='write the stage timings to a .csv or .json file')
+    parser.add_argument('--profile', action='store_true', help='run under cProfile and print the slowest functions')
+    parser.add_argument('--no-result-cache', dest='result_cache', action='store_false', help='always run the model rather than reuse results cached on disk (see disk_cache.py)')
+    parser.add_argument('--scenarios', help='write the NPVs of every unit under the discount_curves and investment_return_paths of the config (.parquet, .csv or .xlsx)')
+    parser.add_argument('--chunk-size', type=int, help='stream the units through the model this many at a time, keeping only the portfolio aggregates (see streaming.py)')
+    parser.add_argument('--aggregates', help='with --chunk-size, write the NPV totals, yearly cashflows and life expectancy distributions (.xlsx or .json)')
+    args = parser.parse_args(argv)
+
+    model, report = run(args.units, args.config, args.output, args.store, args.workings, args.trace_memory, args.report, args.profile, args.scenarios, disk_cache.DiskCache.from_environment() if args.result_cache else None, args.chunk_size, args.aggregates)
+    print_report(report)
+    if args.chunk_size:
+        print(model.aggregates.npv_summary().to_string(index=False))
+    if args.profile:
+        with pd.option_context('display.width', 200, 'display.max_colwidth', 80):
+            print(model.diagnostics.profile_report().to_string(index=False), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+'''
+    Stage timers and counters for the model.
+
+    A Diagnostics object records, for every named stage, how often it was called
+    (and how often its cached value was reused), the wall time spent in it, the
+    number of units it processed, the peak memory it allocated and the process peak
+    RSS. Optionally every top level stage is also run under cProfile.
+
+    Diagnostics are off unless enabled with an argument or the
+    RETIREMENT_VILLAGE_DIAGNOSTICS environment variable, which is '1' to enable the
+    timers, or a comma separated list of 'profile' (cProfile) and 'memory'
+    (tracemalloc) to enable the timers with those captures, e.g.
+
+        RETIREMENT_VILLAGE_DIAGNOSTICS=profile,memory streamlit run app.py
+
+    When disabled, measuring a stage just calls it.
+'''
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+import model_points
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+ENVIRONMENT_VARIABLE = 'RETIREMENT_VILLAGE_DIAGNOSTICS'
+
+REPORT_COLUMNS = ['stage', 'calls', 'cache hits', 'seconds', 'last seconds', 'units', 'peak bytes', 'peak RSS bytes']
+
+
+def peak_rss():
+    '''
+        peak resident set size of the process in bytes, None where it is not available.
+    '''
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class Diagnostics:
+    '''
+        wall time, call counts, units processed and peak memory of nested stages.
+
+        The time of a stage excludes the stages measured inside it on the same thread. Its peak memory (with
+        trace_memory) is the highest traced memory above what was allocated when it started, at any point while it
+        ran, including inside nested stages (and, as tracemalloc is process wide, stages running on other threads
+        at the same time). Numbers accumulate over calls (e.g. Streamlit reruns) until reset.
+
+        Parameters:
+        enabled (bool): record stages at all.
+        profile (bool): run every top level stage under cProfile, see profile_report.
+        trace_memory (bool): measure the peak memory of each stage with tracemalloc, which slows the run down.
+    '''
+
+    def __init__(self, enabled=False, profile=False, trace_memory=False):
+        self.enabled = enabled or profile or trace_memory
+        self.profile = profile
+        self.trace_memory = trace_memory
+
+        self.lock = threading.RLock()
+        self.profiler = None
+        self.started_tracemalloc = False
+        self.reset()
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        '''
+            Diagnostics configured by the RETIREMENT_VILLAGE_DIAGNOSTICS environment variable.
+        '''
+        options = {option.strip().lower() for option in environ.get(ENVIRONMENT_VARIABLE, '').split(',')} - {''}
+        if not options or options & {'0', 'false', 'off', 'no'}:
+            return cls()
+
+        return cls(enabled=True, profile='profile' in options, trace_memory='memory' in options)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            # the stages in progress on each thread, see stack
+            self.local = threading.local()
+            if self.profile:
+                import cProfile
+                self.profiler = cProfile.Profile()
+
+    @property
+    def stack(self):
+        '''
+            stages in progress on the current thread, innermost last.
+        '''
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def stop(self):
+        '''
+            stop tracemalloc if these diagnostics started it.
+        '''
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def stage_record(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'cache hits': 0, 'seconds': 0.0, 'last seconds': None, 'units': 0, 'peak bytes': None, 'peak RSS bytes': None}
+        return self.stages[name]
+
+    def traced_memory(self):
+        return tracemalloc.get_traced_memory() if self.trace_memory else (0, 0)
+
+    def hit(self, name):
+        '''
+            count a call to a stage whose cached value was reused.
+        '''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            record = self.stage_record(name)
+            record['calls'] += 1
+            record['cache hits'] += 1
+
+    def measure(self, name, function, units=None):
+        '''
+            function() timed as the stage name, processing the given number of units.
+        '''
+        if not self.enabled:
+            return function()
+
+        with self.section(name, units):
+            return function()
+
+    @contextlib.contextmanager
+    def section(self, name, units=None):
+        '''
+            context manager timing the enclosed block as the stage name, e.g. for the rendering code of the app.
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.stack
+        with self.lock:
+            if self.trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracemalloc = True
+
+            if stack:
+                parent = stack[-1]
+                parent['peak'] = max(parent['peak'], self.traced_memory()[1])
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+
+            top_level = not stack
+            frame = {'start_memory': self.traced_memory()[0], 'peak': 0, 'child_time': 0.0}
+            stack.append(frame)
+
+        # the profiler only follows the thread that enabled it, and cannot be enabled twice on Python 3.12+
+        profiling = False
+        if top_level and self.profiler is not None:
+            try:
+                self.profiler.enable()
+                profiling = True
+            except ValueError:
+                pass
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiling:
+                self.profiler.disable()
+
+            with self.lock:
+                stack.pop()
+                frame['peak'] = max(frame['peak'], self.traced_memory()[1])
+
+                record = self.stage_record(name)
+                record['calls'] += 1
+                record['seconds'] += elapsed - frame['child_time']
+                record['last seconds'] = elapsed - frame['child_time']
+                record['units'] += units or 0
+                if self.trace_memory:
+                    record['peak bytes'] = max(record['peak bytes'] or 0, frame['peak'] - frame['start_memory'])
+                record['peak RSS bytes'] = peak_rss()
+
+                if stack:
+                    parent = stack[-1]
+                    parent['child_time'] += elapsed
+                    parent['peak'] = max(parent['peak'], frame['peak'])
+
+    def report(self):
+        '''
+            one row per stage, in the order the stages were first called.
+        '''
+        with self.lock:
+            rows = [dict(record, stage=name) for name, record in self.stages.items()]
+
+        return pd.DataFrame(rows, columns=REPORT_COLUMNS)
+
+    def profile_report(self, limit=30):
+        '''
+            the functions with the most cumulative time under cProfile (with profile enabled).
+        '''
+        columns = ['function', 'calls', 'total seconds', 'cumulative seconds']
+        if self.profiler is None:
+            return pd.DataFrame(columns=columns)
+
+        import pstats
+
+        with self.lock:
+            try:
+                stats = pstats.Stats(self.profiler).stats
+            except TypeError: # nothing profiled yet
+                return pd.DataFrame(columns=columns)
+
+        rows = [
+            {'function': f'{function} ({os.path.basename(path)}:{line})', 'calls': calls, 'total seconds': total, 'cumulative seconds': cumulative}
+            for (path, line, function), (_, calls, total, cumulative, _) in stats.items()
+        ]
+
+        return pd.DataFrame(rows, columns=columns).sort_values('cumulative seconds', ascending=False).head(limit).reset_index(drop=True)
+
+
+def measured(name):
+    '''
+        decorator measuring a Model method as the stage name, counting the units of its units argument (a DataFrame
+        or model_points.ModelPoints).
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            units = kwargs.get('units', args[0] if args else None)
+            count = len(units) if isinstance(units, (pd.DataFrame, model_points.ModelPoints)) else None
+
+            return self.diagnostics.measure(name, lambda: method(self, *args, **kwargs), count)
+
+        return wrapper
+
+    return decorator
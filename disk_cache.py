@@ -0,0 +1,239 @@
+'''
+    On-disk cache of model results shared between processes.
+
+    Results are stored under a content address, the SHA-256 of everything they
+    depend on (see content_key), so any app session or CLI run with the same units,
+    mortality table and parameters finds them. Each entry is a directory of .npy
+    files, one per array, which are memory mapped when read back. A repeat
+    valuation then costs little more than opening the files, however large the
+    cashflows are.
+
+    Entries are written to a temporary directory and renamed into place, and
+    evicted by renaming them away before deleting them. So concurrent readers and
+    writers, in threads or processes, only ever see complete entries. Reading an
+    entry marks it as recently used. Once the cache grows past max_bytes, the least
+    recently used entries are evicted.
+
+    The cache directory is set with the RETIREMENT_VILLAGE_RESULT_CACHE environment
+    variable, which is a path or '0' to disable the cache, and defaults to
+    retirementvillage/results in the user's cache directory, e.g.
+
+        RETIREMENT_VILLAGE_RESULT_CACHE=/shared/results streamlit run app.py
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+ENVIRONMENT_VARIABLE = 'RETIREMENT_VILLAGE_RESULT_CACHE'
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
+def default_directory(environ=os.environ):
+    cache_home = environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(cache_home, 'retirementvillage', 'results')
+
+
+def content_key(*parts):
+    '''
+        hex SHA-256 of the repr of parts, which should be built from strings, numbers, None and tuples of them.
+    '''
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def directory_bytes(path):
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+
+def load_array(path):
+    '''
+        read only, memory mapped array from a .npy file (read into memory where it cannot be mapped, e.g. when empty).
+    '''
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        array = np.load(path)
+        array.flags.writeable = False
+        return array
+
+
+class DiskCache:
+    '''
+        content addressed cache of dicts of arrays in a directory, bounded by total bytes.
+
+        Parameters:
+        directory (str): where the entries are kept, created if needed. Caches in other processes can share it.
+        max_bytes (int): total size of the entries above which the least recently used are evicted.
+    '''
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_environment(cls, environ=os.environ, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+            DiskCache in the directory of the RETIREMENT_VILLAGE_RESULT_CACHE environment variable, None if disabled.
+        '''
+        directory = environ.get(ENVIRONMENT_VARIABLE, '').strip()
+        if directory.lower() in {'0', 'false', 'off', 'no'}:
+            return None
+
+        return cls(directory or default_directory(environ), max_bytes)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        '''
+            dict of read only, memory mapped arrays stored for key, None on a miss.
+        '''
+        path = self.path(key)
+        try:
+            names = [name for name in os.listdir(path) if name.endswith('.npy')]
+            arrays = {name[:-len('.npy')]: load_array(os.path.join(path, name)) for name in names}
+            # mark as recently used for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            arrays = None
+        except (OSError, ValueError):
+            # unreadable, e.g. written by an incompatible numpy
+            self.remove(key)
+            arrays = None
+
+        with self.lock:
+            if arrays is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return arrays
+
+    def put(self, key, arrays):
+        '''
+            store a dict of arrays for key, keeping the existing entry if another writer stored it first.
+        '''
+        staging = tempfile.mkdtemp(prefix=f'.{key}-', dir=self.directory)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, name + '.npy'), np.asarray(array), allow_pickle=False)
+            os.rename(staging, self.path(key))
+        except OSError:
+            # the entry exists already
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        with self.lock:
+            self.writes += 1
+
+        self.evict()
+
+    def remove(self, key):
+        '''
+            drop the entry for key, if any. Readers that already mapped its arrays keep them.
+        '''
+        trash = os.path.join(self.directory, f'.{key}-{uuid.uuid4().hex}.evicted')
+        try:
+            os.rename(self.path(key), trash)
+        except OSError:
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+
+        return True
+
+    def entries(self):
+        '''
+            (last used time, bytes, key) of every entry, least recently used first.
+        '''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                entries.append((entry.stat().st_mtime_ns, directory_bytes(entry.path), entry.name))
+            except FileNotFoundError:
+                continue
+
+        return sorted(entries)
+
+    def remove_abandoned(self, age_seconds=3600):
+        '''
+            remove staging and evicted directories older than age_seconds, left behind by processes that died.
+        '''
+        cutoff = time.time() - age_seconds
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.startswith('.') and entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+
+    def evict(self):
+        '''
+            remove the least recently used entries until the cache fits in max_bytes.
+        '''
+        self.remove_abandoned()
+        entries = self.entries()
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if nbytes <= self.max_bytes:
+                break
+            if self.remove(key):
+                with self.lock:
+                    self.evictions += 1
+            nbytes -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
+
+    def stats(self):
+        entries = self.entries()
+        with self.lock:
+            return {
+                'directory': self.directory,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'evictions': self.evictions,
+            }
+
+
+shared_lock = threading.Lock()
+shared_caches = {}
+
+
+def shared():
+    '''
+        the process wide DiskCache configured by the environment (see DiskCache.from_environment), e.g. for every
+        session of the app. None if the cache is disabled or its directory cannot be created.
+    '''
+    with shared_lock:
+        if 'shared' not in shared_caches:
+            try:
+                shared_caches['shared'] = DiskCache.from_environment()
+            except OSError:
+                shared_caches['shared'] = None
+
+        return shared_caches['shared']
@@ -0,0 +1,214 @@
+'''
+    Vectorised projection of unit cashflows.
+
+    All units are projected together as (units x months) arrays, one array per
+    cashflow leg, following the same month by month rules as the original loop
+    in Model.main:
+
+    - a unit is occupied from its start month until its exit month, which is
+      start month + last life expectancy (in months)
+    - for Life Rights the purchase price is received in the start month and the
+      refund on resale is paid in the exit month (if the exit happens within the
+      early exit term)
+    - with replacement a new occupant starts in the month after each exit, at the
+      initial purchase price grown with the property investment return up to the
+      exit month
+
+    The package and pricing parameters can be single values for the whole portfolio
+    or arrays with a value per unit, so a mixed portfolio is projected in one pass.
+'''
+import numpy as np
+
+
+LEGS = ['sale', 'fee', 'expense', 'refund']
+
+
+def unit_column(values):
+    '''
+        a single value as is, or per unit values as a (units x 1) column that broadcasts over the months.
+    '''
+    if np.ndim(values) == 0:
+        return values
+
+    return np.asarray(values).reshape(-1, 1)
+
+
+def life_rights(package):
+    '''
+        whether the package (single value or per unit) is Life Rights, as a bool or a (units x 1) mask.
+    '''
+    return unit_column(np.asarray(package) == 'Life Rights')
+
+
+def discount_factors(discount_rate, months):
+    '''
+        monthly discount factors for an annual discount rate (in %).
+    '''
+    # built with python floats so that results agree exactly with the original per unit lists
+    return np.array([1/(1 + discount_rate/(100*12)) ** (month) for month in range(months)], dtype=float)
+
+
+def investment_return_factors(investment_return, months):
+    '''
+        monthly accumulation factors for an annual investment return (in %).
+    '''
+    return np.array([(1 + investment_return/(100*12)) ** (month) for month in range(months)], dtype=float)
+
+
+def exit_schedule(last_life_expectancies, months, replacement):
+    '''
+        occupancy schedule for every unit and month.
+
+        Parameters:
+        last_life_expectancies (array-like): months until exit for each unit.
+        months (int): number of projection months.
+        replacement (bool): whether a new occupant starts after each exit.
+
+        Returns:
+        dict: (units x months) arrays
+            'generation' - occupant number (0 for the original occupant),
+            'active' - mask of months that are projected,
+            'start' - mask of months in which an occupant starts,
+            'exit' - mask of months in which an occupant exits.
+    '''
+    last_life_expectancies = np.asarray(last_life_expectancies, dtype=np.int64).reshape(-1, 1)
+    period = last_life_expectancies + 1
+    month = np.arange(months, dtype=np.int64).reshape(1, -1)
+
+    generation = month // period
+    offset = month - generation * period
+
+    if replacement:
+        active = np.ones(generation.shape, dtype=bool)
+    else:
+        active = generation == 0
+
+    return {
+        'generation': generation,
+        'active': active,
+        'start': active & (offset == 0),
+        'exit': active & (offset == last_life_expectancies),
+    }
+
+
+def fee_leg(schedule, monthly_fee):
+    '''
+        monthly fee received in every projected month.
+    '''
+    return np.where(schedule['active'], unit_column(np.asarray(monthly_fee, dtype=float)), 0.0)
+
+
+def expense_leg(schedule, monthly_expense):
+    '''
+        monthly expense paid in every projected month.
+    '''
+    return np.where(schedule['active'], 0 - unit_column(monthly_expense), 0.0)
+
+
+def previous_exits(schedule, last_life_expectancies):
+    '''
+        month of the exit before each occupant's start (0 for the original occupant), which their price is grown to.
+    '''
+    last_life_expectancies = np.asarray(last_life_expectancies, dtype=np.int64).reshape(-1, 1)
+
+    return np.clip(schedule['generation'] * (last_life_expectancies + 1) - 1, 0, None)
+
+
+def occupant_prices(schedule, last_life_expectancies, investment_return, purchase_price):
+    '''
+        purchase price paid by the occupant of each unit in each month.
+
+        Each replacement occupant pays the initial price grown with the investment return to the previous exit month.
+        The investment return may also be an array with a value per unit.
+    '''
+    generation = schedule['generation']
+    months = generation.shape[1]
+
+    purchase_price = unit_column(np.asarray(purchase_price, dtype=float))
+
+    previous_exit = previous_exits(schedule, last_life_expectancies)
+
+    if np.ndim(investment_return) == 0:
+        growth = investment_return_factors(investment_return, months)[previous_exit]
+    else:
+        growth = (1 + unit_column(investment_return)/(100*12)) ** previous_exit
+
+    return np.where(generation > 0, purchase_price * growth, purchase_price)
+
+
+def sale_leg(schedule, prices):
+    '''
+        purchase price received in each occupant's start month.
+    '''
+    return np.where(schedule['start'], prices, 0.0)
+
+
+def refundable(schedule, last_life_expectancies, refund_on_resale_duration):
+    '''
+        mask of the exit months in which a refund on resale is paid, for exits within the early exit term (in years).
+    '''
+    last_life_expectancies = np.asarray(last_life_expectancies, dtype=np.int64).reshape(-1, 1)
+
+    return schedule['exit'] & (last_life_expectancies < unit_column(refund_on_resale_duration) * 12)
+
+
+def refund_leg(schedule, prices, last_life_expectancies, refund_on_resale_pct, refund_on_resale_duration):
+    '''
+        refund on resale paid in the exit month, for exits within the early exit term.
+
+        The refund % and early exit term (in years) may also be arrays with a value per unit.
+    '''
+    return np.where(refundable(schedule, last_life_expectancies, refund_on_resale_duration), 0 - prices * (unit_column(refund_on_resale_pct)/100), 0.0)
+
+
+def occupant_counts(schedule, package):
+    '''
+        number of occupants started so far (-1 for months no longer projected).
+    '''
+    return np.where(schedule['active'], np.where(life_rights(package), schedule['generation'] + 1, 0), -1)
+
+
+def total_cashflows(sale, fee, expense, refund):
+    return sale + fee + expense + refund
+
+
+def annuity_factors(discount_rate, months):
+    '''
+        present value of 1 paid at the start of each of the first n months, for n = 0, 1, ..., months.
+
+        Closed form (1 - v^n) / (1 - v) with v the monthly discount factor, or n at a zero discount rate.
+    '''
+    n = np.arange(months + 1, dtype=float)
+    if discount_rate == 0:
+        return n
+
+    v = 1/(1 + discount_rate/(100*12))
+    return (1 - v ** n) / (1 - v)
+
+
+def occupied_months(last_life_expectancies, months, replacement):
+    '''
+        number of projected months of each unit, which are always the first months of the projection.
+    '''
+    last_life_expectancies = np.asarray(last_life_expectancies, dtype=np.int64)
+    if replacement:
+        return np.full(len(last_life_expectancies), months)
+
+    return np.minimum(last_life_expectancies + 1, months)
+
+
+def level_present_values(amount, occupied, annuity):
+    '''
+        present value of a level monthly amount (single value or per unit) received in every projected month, from
+        the occupied_months of each unit and the annuity_factors.
+    '''
+    return np.asarray(amount, dtype=float) * annuity[occupied]
+
+
+def present_values(cashflows, factors):
+    '''
+        present value of each unit of (units x months) cashflows, as one matrix-vector product with the monthly
+        discount factors.
+    '''
+    return cashflows @ factors
+
@@ -0,0 +1,211 @@
+'''
+    Probability weighted (expected value) projection of unit cashflows.
+
+    Rather than exiting every unit at its life expectancy, each month's cashflows are
+    weighted by probabilities from the mortality table:
+
+    - fees and expenses by the probability that the unit is still occupied (the
+      last survivor of the main member and spouse for Double units)
+    - refunds by the probability that the occupant exits in that month
+    - with replacement, sales by the probability that a new occupant starts in that
+      month, found from the renewal equation (a new occupant starts the month after
+      each exit)
+
+    The exit distribution is the same as in the stochastic mode (see stochastic.py),
+    so these are the expected cashflows that the Monte Carlo simulation converges to,
+    without its sampling cost. Units with the same ages and genders share one exit
+    distribution, so the work grows with the number of distinct lives rather than
+    the number of units.
+'''
+import numpy as np
+import pandas as pd
+
+import engine
+import model_points
+import mortality
+
+
+def exit_probabilities(mortality_tables, main_ages, main_genders, spouse_ages, spouse_genders, single_double, longevity_loading_pct, months, fractional_assumption=None):
+    '''
+        probability that an occupancy lasts exactly k months, for k = 0, ..., months - 1.
+
+        The lifetimes are stretched by the longevity loading in the same way as the deterministic life expectancies,
+        unless a fractional_assumption is given, in which case the survival curves come from the loaded rates of
+        mortality.MonthlySurvivalTable.
+        single_double is 'Single' or 'Double' for every life or an array with a value per life; the spouse ages and
+        genders are only used for Double lives.
+
+        Returns:
+        np.ndarray: (lives x months) probabilities, one row per entry of the age and gender arrays.
+    '''
+    survival_curves = {}
+
+    def survival_curve(age, gender):
+        if (age, gender) not in survival_curves:
+            if fractional_assumption is None:
+                survival_curves[(age, gender)] = mortality.monthly_survival_curve(mortality.table_for_age(mortality_tables, age), age, gender)
+            else:
+                survival_curves[(age, gender)] = mortality.monthly_survival_table(mortality.table_for_age(mortality_tables, age), gender, longevity_loading_pct, fractional_assumption).curve(age)
+        return survival_curves[(age, gender)]
+
+    # lifetimes are stretched by the loading unless it is already in the rates
+    stretch_loading_pct = longevity_loading_pct if fractional_assumption is None else 0
+
+    curves = [survival_curve(age, gender) for age, gender in zip(main_ages, main_genders)]
+    double = np.broadcast_to(np.asarray(single_double) == 'Double', len(curves))
+    spouse_curves = []
+    if double.any():
+        # no spouse (a survival curve of zeros) for Single lives
+        spouse_curves = [survival_curve(age, gender) if is_double else np.zeros(0) for age, gender, is_double in zip(spouse_ages, spouse_genders, double)]
+    length = max([len(curve) for curve in curves + spouse_curves], default=0) + 1
+
+    def padded(curves):
+        survival = np.zeros((len(curves), length))
+        for index, curve in enumerate(curves):
+            survival[index, :len(curve)] = curve
+        return survival
+
+    survival = padded(curves)
+    if double.any():
+        spouse_survival = padded(spouse_curves)
+        survival = survival + spouse_survival - survival * spouse_survival # last survivor
+
+    # complete months lived, the last entry of each curve being the end of the table
+    lifetime = survival[:, :-1] - survival[:, 1:]
+
+    # stretch lifetimes k -> int(k * loading), adding together the probabilities of lifetimes that land in the same month
+    stretched = (np.arange(length - 1) * (1 + stretch_loading_pct/100)).astype(np.int64)
+    keep = stretched < months
+
+    probabilities = np.zeros((len(curves), months))
+    for k in np.nonzero(keep)[0]:
+        probabilities[:, stretched[k]] += lifetime[:, k]
+
+    return probabilities
+
+
+def start_probabilities(exit_probabilities):
+    '''
+        probability that a new occupant starts in each month when units are replaced, from the renewal equation
+
+            start[m] = sum over k of start[m - k - 1] * exit[k], start[0] = 1
+    '''
+    lives, months = exit_probabilities.shape
+
+    # start probabilities in reverse order, so that start[m - 1], ..., start[0] is a contiguous slice
+    reversed_start = np.zeros((lives, months))
+    if months:
+        reversed_start[:, -1] = 1.0
+
+    for month in range(1, months):
+        # exits k = 0 .. month - 1 months after starts at month - k - 1
+        reversed_start[:, months - 1 - month] = np.einsum('ij,ij->i', reversed_start[:, months - month:], exit_probabilities[:, :month])
+
+    return reversed_start[:, ::-1].copy()
+
+
+def convolve(a, b):
+    '''
+        row by row linear convolution of two (rows x months) arrays, truncated to months.
+    '''
+    months = a.shape[1]
+    if months == 0:
+        return np.zeros(a.shape)
+
+    size = 2 * months
+    return np.fft.irfft(np.fft.rfft(a, size, axis=1) * np.fft.rfft(b, size, axis=1), size, axis=1)[:, :months]
+
+
+def expected_cashflows(exit_probabilities, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, package, purchase_price, monthly_fee, monthly_expense):
+    '''
+        expected cashflows of every leg given each unit's occupancy length distribution.
+
+        The package, purchase price, monthly fee and monthly expense are single values or arrays with a value per unit.
+
+        Returns:
+        dict: (units x months) float arrays for each leg in engine.LEGS and their 'total', as well as the
+        'occupied' and 'start' probabilities.
+    '''
+    units, months = exit_probabilities.shape
+
+    if replacement:
+        start = start_probabilities(exit_probabilities)
+        occupied = np.ones((units, months))
+    else:
+        start = np.zeros((units, months))
+        start[:, :1] = 1.0
+        # occupied in month m if the occupancy lasts at least m months
+        occupied = 1 - np.concatenate([np.zeros((units, 1)), np.cumsum(exit_probabilities, axis=1)[:, :-1]], axis=1)
+
+    fee = occupied * engine.unit_column(np.asarray(monthly_fee, dtype=float))
+    expense = occupied * (0 - engine.unit_column(monthly_expense))
+
+    sale = np.zeros((units, months))
+    refund = np.zeros((units, months))
+    is_life_rights = engine.life_rights(package)
+    if np.any(is_life_rights):
+        # an occupant starting in month t > 0 pays the initial price grown to the previous exit month t - 1
+        inv_return_factors = engine.investment_return_factors(investment_return, months)
+        purchase_price = np.broadcast_to(engine.unit_column(np.asarray(purchase_price, dtype=float)), (units, 1))
+        prices = np.concatenate([purchase_price, purchase_price * inv_return_factors[:-1]], axis=1)[:, :months]
+
+        sale = start * prices
+
+        # refund in month t + k for an occupant starting in month t and exiting after k months within the early exit term,
+        # i.e. the convolution of the sales with the refundable exit probabilities
+        refundable = exit_probabilities * (np.arange(months) < refund_on_resale_duration * 12)
+        refund = 0 - convolve(sale, refundable) * (refund_on_resale_pct/100)
+
+        if not np.all(is_life_rights):
+            sale = np.where(is_life_rights, sale, 0.0)
+            refund = np.where(is_life_rights, refund, 0.0)
+
+    return {
+        'sale': sale,
+        'fee': fee,
+        'expense': expense,
+        'refund': refund,
+        'total': engine.total_cashflows(sale, fee, expense, refund),
+        'occupied': occupied,
+        'start': start,
+    }
+
+
+def project_expected(units, mortality_tables, longevity_loading_pct, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price, monthly_fee, monthly_expense, fractional_assumption=None):
+    '''
+        expected cashflows for every unit, computed once per distinct combination of ages, genders and (per unit)
+        package and pricing parameters.
+
+        units are model_points.ModelPoints. single_double, package, purchase_price, monthly_fee and monthly_expense
+        are single values or arrays with a value per unit.
+
+        Returns:
+        tuple: a dict as from expected_cashflows with one row per distinct life, plus their 'exit' probabilities,
+        and the index of each unit's row in it.
+    '''
+    model_points.check_spouses(units, single_double)
+
+    months = investment_term * 12
+
+    double = np.broadcast_to(np.asarray(single_double) == 'Double', len(units))
+    frame = pd.DataFrame({
+        'Main Member Age': units.main_ages,
+        'Main Member Gender': units.main_gender_labels(),
+        # the spouse of a Single unit is ignored
+        'Spouse Age': np.where(double, units.spouse_ages, np.nan),
+        'Spouse Gender': np.where(double, units.spouse_gender_labels(), np.nan),
+        'single_double': np.broadcast_to(single_double, len(units)),
+        'package': np.broadcast_to(package, len(units)),
+        'purchase_price': np.broadcast_to(purchase_price, len(units)),
+        'monthly_fee': np.broadcast_to(monthly_fee, len(units)),
+        'monthly_expense': np.broadcast_to(monthly_expense, len(units)),
+    })
+    unit_lives = frame.groupby(list(frame.columns), dropna=False, sort=False).ngroup().to_numpy()
+    lives = frame.drop_duplicates()
+
+    probabilities = exit_probabilities(mortality_tables, lives['Main Member Age'], lives['Main Member Gender'], lives['Spouse Age'], lives['Spouse Gender'], lives['single_double'].to_numpy(), longevity_loading_pct, months, fractional_assumption)
+
+    cashflows = expected_cashflows(probabilities, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, lives['package'].to_numpy(), lives['purchase_price'].to_numpy(), lives['monthly_fee'].to_numpy(), lives['monthly_expense'].to_numpy())
+    cashflows['exit'] = probabilities
+
+    return cashflows, unit_lives
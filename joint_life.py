@@ -0,0 +1,119 @@
+'''
+    Joint life expectancies of a main member and spouse.
+
+    For a Double unit the occupancy lasts until the second death, so its expected
+    duration is the last survivor expectancy
+
+        e(last) = e(main) + e(spouse) - e(joint)
+
+    where e(joint) = sum over t of tpx(main) * tpx(spouse) is the expectancy of
+    the first death, assuming the two lives are independent. This is longer than
+    the larger of the two single life expectancies.
+
+    The expectancies are curtate and loaded in the same way as the single life
+    expectancies of mortality.LifeExpectancyTable. They are computed for every
+    pair of ages of a table at once, as a (main ages x spouse ages) grid per
+    gender pair and longevity loading, so that looking up any number of units is
+    an array gather. With a fractional age assumption they are computed from the
+    monthly survival of mortality.MonthlySurvivalTable instead, in the same way.
+'''
+import numpy as np
+
+import cache
+import mortality
+
+
+STATUSES = ('last', 'first')
+
+
+def survival_matrix(mortality_tables, gender):
+    '''
+        (ages x years) survival curve from every age of the table, tpx for t = 1, 2, ..., zero past the end of the table.
+    '''
+    table_ages = mortality_tables['Age'].to_numpy()
+    px = 1 - mortality_tables[mortality.GENDER_COLUMNS[gender]].to_numpy(dtype=float)
+    ages = np.unique(table_ages)
+
+    survival = np.zeros((len(ages), len(px)))
+    for index, age in enumerate(ages):
+        curve = np.cumprod(px[table_ages >= age])
+        survival[index, :len(curve)] = curve
+
+    return ages, survival
+
+
+def joint_life_table(mortality_tables, main_gender, spouse_gender, longevity_loading_pct, fractional_assumption=None, spouse_mortality_tables=None):
+    '''
+        JointLifeTable for a mortality table, gender pair, longevity loading and fractional age assumption, cached per table.
+    '''
+    spouse_key = mortality.mortality_table_key(spouse_mortality_tables) if spouse_mortality_tables is not None else None
+    key = ('joint_life_table', mortality.mortality_table_key(mortality_tables), spouse_key, main_gender, spouse_gender, longevity_loading_pct, fractional_assumption)
+
+    return cache.shared.get(key, lambda: JointLifeTable(mortality_tables, main_gender, spouse_gender, longevity_loading_pct, fractional_assumption, spouse_mortality_tables))
+
+
+class JointLifeTable:
+    '''
+        last survivor and first death curtate life expectancies in months for every pair of ages of a mortality
+        table, for one gender pair and longevity loading.
+
+        With fractional_assumption None these are annual expectancies loaded like LifeExpectancyTable, otherwise
+        monthly expectancies from the loaded rates of MonthlySurvivalTable. The spouse's rates come from
+        spouse_mortality_tables if given (e.g. the cohort table of another birth year), else from mortality_tables.
+
+        Attributes:
+        ages (np.ndarray): ages of the table.
+        last, first (np.ndarray): (ages + 1 x ages + 1) expectancies in months, indexed by the main member's age and then
+            the spouse's age. The last row and column are for ages past the end of the table.
+    '''
+
+    def __init__(self, mortality_tables, main_gender, spouse_gender, longevity_loading_pct, fractional_assumption=None, spouse_mortality_tables=None):
+        assert main_gender in mortality.GENDER_COLUMNS and spouse_gender in mortality.GENDER_COLUMNS
+        assert 0 <= longevity_loading_pct <= 100
+
+        self.main_gender = main_gender
+        self.spouse_gender = spouse_gender
+        self.longevity_loading_pct = longevity_loading_pct
+        self.fractional_assumption = fractional_assumption
+        if spouse_mortality_tables is None:
+            spouse_mortality_tables = mortality_tables
+
+        if fractional_assumption is None:
+            self.ages, main_survival = survival_matrix(mortality_tables, main_gender)
+            _, spouse_survival = survival_matrix(spouse_mortality_tables, spouse_gender)
+
+            # an extra row of zeros for ages past the end of the table
+            main_survival = np.vstack([main_survival, np.zeros(main_survival.shape[1])])
+            spouse_survival = np.vstack([spouse_survival, np.zeros(spouse_survival.shape[1])])
+
+            # annual sums to months, with the loading applied to the expectancies
+            scale = (1 + longevity_loading_pct/100) * 12
+        else:
+            main_table = mortality.monthly_survival_table(mortality_tables, main_gender, longevity_loading_pct, fractional_assumption)
+            spouse_table = mortality.monthly_survival_table(spouse_mortality_tables, spouse_gender, longevity_loading_pct, fractional_assumption)
+
+            # survival for 1, 2, ... months, the loading is already in the rates
+            self.ages = main_table.ages
+            main_survival = main_table.survival[:, 1:]
+            spouse_survival = spouse_table.survival[:, 1:]
+            scale = 1
+
+        main_sums = main_survival.sum(axis=1)
+        spouse_sums = spouse_survival.sum(axis=1)
+        # sum over t of tpx(main) * tpx(spouse) for every pair of ages
+        first_sums = main_survival @ spouse_survival.T
+        last_sums = main_sums.reshape(-1, 1) + spouse_sums - first_sums
+
+        self.first = (first_sums * scale).astype(np.int64)
+        self.last = (last_sums * scale).astype(np.int64)
+
+    def lookup(self, main_ages, spouse_ages, status='last'):
+        '''
+            'last' survivor or 'first' death life expectancy in months for arrays of main member and spouse ages.
+        '''
+        if status not in STATUSES:
+            raise ValueError(f'Unknown joint life status {status!r}, expected one of {STATUSES}')
+
+        grid = self.last if status == 'last' else self.first
+
+        return grid[np.searchsorted(self.ages, main_ages, side='left'), np.searchsorted(self.ages, spouse_ages, side='left')]
@@ -1,9 +1,28 @@
 import pandas as pd 
 import numpy as  np 
 import pdb 
-import plotly.express as px
 from io import BytesIO
 import io
+import os
+import contextlib
+import hashlib
+import inspect
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import breakeven
+import disk_cache
+import engine
+import expected
+import joint_life
+import model_points
+import mortality
+import results_store
+import scenarios
+import stochastic
+import streaming
+from diagnostics import Diagnostics, measured
 
 def expand_array_columns(df):
     """
@@ -32,109 +51,361 @@ def expand_array_columns(df):
     return expanded_df
 
 
+def hash_units(units):
+    '''
+        hashable key identifying the contents of a units DataFrame (or model_points.ModelPoints).
+    '''
+    if isinstance(units, model_points.ModelPoints):
+        return units.key
+
+    return hashlib.sha1(pd.util.hash_pandas_object(units, index=False).to_numpy().tobytes()).hexdigest()
+
+
+EXCEL_MAX_ROWS = 1048576
+
+
+def excel_value(value):
+    '''
+        convert a DataFrame value to one that openpyxl can write, the same way as DataFrame.to_excel did for the model's results.
+    '''
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return str(np.asarray(value).tolist())
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, str) and value == '':
+        return None
+    return value
+
+
+def frame_rows(frame):
+    '''
+        rows of a DataFrame as lists of values that openpyxl can write.
+    '''
+    for row in zip(*[frame[column].tolist() for column in frame.columns]):
+        yield [excel_value(value) for value in row]
+
+
+def append_sheet(workbook, title, frame):
+    '''
+        write a DataFrame (without its index) to a new sheet of a write-only workbook.
+    '''
+    worksheet = workbook.create_sheet(str(title))
+    worksheet.append(list(frame.columns))
+    for row in frame_rows(frame):
+        worksheet.append(row)
+
+
+# optional units columns that override Model.main parameters for individual units
+UNIT_PARAMETER_COLUMNS = {
+    'single_double': 'Single/Double',
+    'package': 'Package',
+    'purchase_price_input': 'Purchase Price',
+    'monthly_fee': 'Monthly Fee',
+    'monthly_expense': 'Monthly Expense',
+}
+
+
+def unit_parameters(units, **defaults):
+    '''
+        per unit values of the parameters in UNIT_PARAMETER_COLUMNS, from the model_points.ModelPoints columns where
+        they are present and not blank, and otherwise from the defaults (the Model.main arguments, i.e. the sidebar
+        values).
+
+        Returns:
+        dict: an array with a value per unit for each parameter.
+    '''
+    parameters = {}
+    for name, column in UNIT_PARAMETER_COLUMNS.items():
+        if column in units.parameter_columns:
+            values = units.parameter_columns[column]
+            values = np.where(pd.isna(values), defaults[name], values)
+        else:
+            values = np.full(len(units), defaults[name])
+        parameters[name] = values
+
+    assert np.isin(parameters['single_double'], ['Single', 'Double']).all()
+    assert np.isin(parameters['package'], ['Life Rights', 'Rental']).all()
+
+    return parameters
+
+
+def parameter_key(values):
+    '''
+        stage key for per unit parameter values, the value itself when it is the same for every unit.
+    '''
+    values = np.asarray(values)
+    if len(values) and (values == values[0]).all():
+        return values[0].item() if isinstance(values[0], np.generic) else values[0]
+
+    return hashlib.sha1(pd.util.hash_array(values.astype(object)).tobytes()).hexdigest()
+
+
+# results columns holding the present value of each cashflow leg
+# bump when a change to the model changes its results, so that results cached on disk by earlier versions are not reused
+RESULT_CACHE_VERSION = 3
+
+NPV_COMPONENTS = {
+    'NPV': 'total',
+    'Purchase NPV': 'sale',
+    'Refund NPV': 'refund',
+    'Fee NPV': 'fee',
+    'Expense NPV': 'expense',
+}
+
+
+# parameters that Model.solve_breakeven can solve for and the label of their results column
+BREAKEVEN_PARAMETERS = {
+    'purchase_price_input': 'Purchase Price',
+    'monthly_fee': 'Monthly Fee',
+    'monthly_expense': 'Monthly Expense',
+    'refund_on_resale_pct': 'Refund %',
+    'discount_rate': 'Discount Rate',
+    'investment_return': 'Investment Return',
+    'refund_on_resale_duration': 'Early Exit Term',
+}
+
+# parameters the NPV is linear in: the value they are projected at and the results NPV columns proportional to them
+BREAKEVEN_LINEAR = {
+    'purchase_price_input': (1, ['Purchase NPV', 'Refund NPV']),
+    'monthly_fee': (1, ['Fee NPV']),
+    'monthly_expense': (1, ['Expense NPV']),
+    'refund_on_resale_pct': (100, ['Refund NPV']),
+}
+
+# default bisection brackets of the other parameters
+BREAKEVEN_BOUNDS = {
+    'discount_rate': (0, 100),
+    'investment_return': (-50, 50),
+    'refund_on_resale_duration': (0, 100),
+}
+
+
+# Model.main parameters in the order of the stages they feed, so that sweeps vary the later (cheaper) stages fastest
+SWEEP_PARAMETERS = [
+    'longevity_loading_pct',
+    'fractional_assumption',
+    'single_double',
+    'investment_term',
+    'replacement',
+    'package',
+    'investment_return',
+    'purchase_price_input',
+    'refund_on_resale_pct',
+    'refund_on_resale_duration',
+    'monthly_fee',
+    'monthly_expense',
+    'discount_rate',
+]
+
+# units and mortality tables shared with each sweep worker process, set once per process by init_sweep_worker
+sweep_state = {}
+
+
+def init_sweep_worker(units, mortality_tables):
+    sweep_state['units'] = units
+    sweep_state['mortality_tables'] = mortality_tables
+    sweep_state['model'] = Model(units)
+
+
+def run_sweep_chunk(combinations):
+    '''
+        NPV components of every unit for a chunk of parameter combinations, as a (combinations x components x units) array.
+    '''
+    return sweep_combinations(sweep_state['model'], sweep_state['units'], sweep_state['mortality_tables'], combinations)
+
+
+def sweep_combinations(model, units, mortality_tables, combinations):
+    values = np.empty((len(combinations), len(NPV_COMPONENTS), len(units)))
+    for index, parameters in enumerate(combinations):
+        components = model.npv_components(units, mortality_tables, **parameters)
+        for component_index, column in enumerate(NPV_COMPONENTS):
+            values[index, component_index] = components[column]
+
+    return values
+
+
+class Cancelled(Exception):
+    '''
+        raised by a model stage when the run it belongs to has been cancelled, see Model.cancellable.
+    '''
+
+
 class Model:
 
-    def __init__(self, model_points):
+    def __init__(self, model_points, diagnostics=None, result_cache=None):
         self.model_points = model_points
         self.life_expectancies = pd.DataFrame()
         self.cashflows = pd.DataFrame()
 
         self.charts = {}
 
+        # workings DataFrame of every unit from the latest run of main, built when looked up, see results_store.UnitWorkings
         self.all_workings = {}
 
+        # monthly cashflows of every unit from the latest run of main
+        self.store = None
 
+        self.expected_cashflows = pd.DataFrame()
+        self.simulation = pd.DataFrame()
+        self.breakeven = pd.DataFrame()
+        self.scenario_results = pd.DataFrame()
 
+        # latest value of each model stage and how often each stage was rebuilt, see Model.stage
+        self.stages = {}
+        self.stage_builds = {}
 
+        # stage timers and counters, configured by the RETIREMENT_VILLAGE_DIAGNOSTICS environment variable unless given
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics.from_environment()
 
+        # set while a run that can be cancelled is in progress, see Model.cancellable
+        self.cancelled = None
 
+        # disk_cache.DiskCache of the results of main shared with other processes, None to always run the model
+        self.result_cache = result_cache
 
+        # (key, life expectancies, store) of the latest run of main that is not in the result cache yet
+        self.uncached_result = None
 
+        # streaming.PortfolioAggregates of the latest run of stream
+        self.aggregates = None
 
-    def generate_excel(self):
 
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
 
-            
-            self.model_points.to_excel(writer, index=False, sheet_name='Model Points')
-            self.life_expectancies.to_excel(writer, index=False, sheet_name='Life Expectancies')
-            self.cashflows.to_excel(writer, index=False, sheet_name='Cashflows')
 
 
-            for key in self.all_workings:
-                self.all_workings[key].to_excel(writer, index=False, sheet_name=key)
-            # pd.DataFrame().to_excel(writer, 'Charts')
-            # # workbook = writer.book
-            # # workbook.add_worksheet("Charts")
-            # charts_sheet = writer.sheets['Charts']
-            # for chart_label in self.charts:
-            #     fig = self.charts[chart_label]
-
-            #     pdb.set_trace()
-            #     img_bytes = io.BytesIO()
-            #     fig.savefig(img_bytes, format='png')
-            #     #plt.close(fig)  # Close the figure to avoid displaying it in notebooks
-            #     img_bytes.seek(0)  # Move to the beginning of the BytesIO object
 
 
-            #     # Convert it to a BytesIO stream.
-            #     #image_data = BytesIO(fig.to_image(format="png"))
 
-            #     # Write the image to the same sheet as the data.
-            #     charts_sheet.insert_image('D2', 'plot.png', {'image_data': img_bytes})
 
-            #                 # # Create a new worksheet and add the image to it.
-            #                 # worksheet = workbook.add_worksheet()
-            #                 # worksheet.insert_image(2, 3, 'plotly.png', {'image_data': image_data})
+    def generate_excel(self, single_workings_sheet=False):
+        '''
+            results workbook as bytes, see write_excel.
+        '''
+        output = io.BytesIO()
+        self.write_excel(output, single_workings_sheet)
 
-        output.seek(0)
+        return output.getvalue()
 
+    @measured('write_excel')
+    def write_excel(self, output, single_workings_sheet=False):
+        '''
+            write the results workbook to a file path or file-like object.
 
-        return output.read()
+            Parameters:
+            output (str or file-like): where to save the workbook.
+            single_workings_sheet (bool): write the workings of all units to one long format 'Workings' sheet (with an
+                'ID' column) instead of one sheet per unit. Workings longer than an Excel sheet continue on
+                'Workings 2', 'Workings 3', etc.
 
-    def calculate_life_expectancy(self, mortality_tables, age, gender, longevity_loading_pct):
+            The workbook is written with openpyxl's write-only mode, which streams rows to disk as they are appended,
+            so memory does not grow with the number of units or months.
         '''
-            calculate life expectancy in months.
-        '''
-    # assert 60 <= age <= 100
-        assert gender in ('Male', 'Female')
-        assert 0 <= longevity_loading_pct <= 100
+        import openpyxl
 
-        # Example: Calculate life expectancy for someone aged 30
-        # age = 70
-        # gender = 'Male'
-        #mortality_improvement_loading = 0.0
+        workbook = openpyxl.Workbook(write_only=True)
 
-        if gender == 'Male':
-            mortality_table = mortality_tables[['Age', 'MaleMortality_qx']].copy()
+        points = self.model_points
+        append_sheet(workbook, 'Model Points', points.to_frame() if isinstance(points, model_points.ModelPoints) else points)
+        append_sheet(workbook, 'Life Expectancies', self.life_expectancies)
+        append_sheet(workbook, 'Cashflows', self.cashflows)
+
+        if single_workings_sheet:
+            worksheet = None
+            sheet_number = 0
+            for key in self.all_workings:
+                unit_workings = self.all_workings[key]
+                for row in frame_rows(unit_workings):
+                    if worksheet is None or worksheet_rows == EXCEL_MAX_ROWS:
+                        sheet_number += 1
+                        worksheet = workbook.create_sheet('Workings' if sheet_number == 1 else f'Workings {sheet_number}')
+                        worksheet.append(['ID'] + list(unit_workings.columns))
+                        worksheet_rows = 1
+                    worksheet.append([key] + row)
+                    worksheet_rows += 1
         else:
-            mortality_table = mortality_tables[['Age', 'FemaleMortality_qx']].copy()
-        mortality_table.columns = ['age', 'qx']
+            for key in self.all_workings:
+                append_sheet(workbook, key, self.all_workings[key])
 
-        mortality_table['qx'] = mortality_table['qx'] 
+        workbook.save(output)
 
-        # Filter the table for ages greater than or equal to the input age
-        table = mortality_table[mortality_table['age'] >= age].copy()
-        
-        # Calculate survival probability px = 1 - qx
-        table['px'] = 1 - table['qx']
+    def life_expectancy_table(self, mortality_tables, gender, longevity_loading_pct, fractional_assumption=None):
+        '''
+            life expectancy lookup table for a mortality table, gender and longevity loading, built once and shared between reruns.
 
-        # table['px'] = table['px'] * (1 + longevity_loading_pct/100)
-        # table.loc[table['px'] > 1, 'px'] = 1
-        #table['px'][table['px'] > 1] = 1
+            With a fractional_assumption (one of mortality.FRACTIONAL_ASSUMPTIONS) the life expectancies are monthly,
+            from rates reduced by the longevity loading, see mortality.MonthlySurvivalTable. Otherwise they are annual
+            and the loading is applied to the life expectancy.
+        '''
+        if fractional_assumption is not None:
+            return mortality.monthly_survival_table(mortality_tables, gender, longevity_loading_pct, fractional_assumption)
 
-        # Calculate cumulative survival probability from the input age
-        table['survival_prob'] = table['px'].cumprod()
-        
-        # Calculate life expectancy by summing up survival probabilities for each year
-        life_expectancy = table['survival_prob'].sum()
+        return mortality.life_expectancy_table(mortality_tables, gender, longevity_loading_pct)
 
-        life_expectancy = life_expectancy * (1 + longevity_loading_pct/100)
+    def calculate_life_expectancy(self, mortality_tables, age, gender, longevity_loading_pct, fractional_assumption=None):
+        '''
+            calculate life expectancy in months.
+        '''
+        assert gender in ('Male', 'Female')
+        assert 0 <= longevity_loading_pct <= 100
 
-        life_expectancy = int(life_expectancy * 12) # convert to months
+        return int(self.life_expectancy_table(mortality_tables, gender, longevity_loading_pct, fractional_assumption).lookup(age))
 
-        return life_expectancy
+    def calculate_life_expectancies(self, mortality_tables, ages, genders, longevity_loading_pct, fractional_assumption=None):
+        '''
+            calculate life expectancies in months for arrays of ages and genders.
+        '''
+        ages = np.asarray(ages)
+        genders = model_points.gender_codes(genders)
+        assert (genders >= 0).all()
+
+        life_expectancies = np.zeros(len(ages), dtype=np.int64)
+        if isinstance(mortality_tables, mortality.GenerationalTable):
+            # each cohort with its own diagonal of the table
+            birth_years = mortality_tables.birth_years(ages)
+            for birth_year in np.unique(birth_years):
+                mask = birth_years == birth_year
+                life_expectancies[mask] = self.calculate_life_expectancies(mortality_tables.cohort_table(birth_year), ages[mask], genders[mask], longevity_loading_pct, fractional_assumption)
+            return life_expectancies
+
+        for code, gender in enumerate(model_points.GENDERS):
+            mask = genders == code
+            if mask.any():
+                life_expectancies[mask] = self.life_expectancy_table(mortality_tables, gender, longevity_loading_pct, fractional_assumption).lookup(ages[mask])
+
+        return life_expectancies
+
+    def calculate_joint_life_expectancies(self, mortality_tables, main_ages, main_genders, spouse_ages, spouse_genders, longevity_loading_pct, status='last', fractional_assumption=None, spouse_mortality_tables=None):
+        '''
+            calculate 'last' survivor or 'first' death life expectancies in months for arrays of main member and spouse
+            ages and genders, see joint_life.py.
+
+            spouse_mortality_tables are the spouses' rates where they differ from the main members' (cohort tables).
+        '''
+        main_ages = np.asarray(main_ages)
+        main_genders = model_points.gender_codes(main_genders)
+        spouse_ages = np.asarray(spouse_ages)
+        spouse_genders = model_points.gender_codes(spouse_genders)
+        assert (main_genders >= 0).all() and (spouse_genders >= 0).all()
+
+        life_expectancies = np.zeros(len(main_ages), dtype=np.int64)
+        if isinstance(mortality_tables, mortality.GenerationalTable):
+            # each pair of cohorts with their own diagonals of the table
+            birth_years = np.stack([mortality_tables.birth_years(main_ages), mortality_tables.birth_years(spouse_ages)], axis=1)
+            pairs, pair_index = np.unique(birth_years, axis=0, return_inverse=True)
+            for index, (main_birth_year, spouse_birth_year) in enumerate(pairs):
+                mask = pair_index.reshape(-1) == index
+                life_expectancies[mask] = self.calculate_joint_life_expectancies(mortality_tables.cohort_table(main_birth_year), main_ages[mask], main_genders[mask], spouse_ages[mask], spouse_genders[mask], longevity_loading_pct, status, fractional_assumption, mortality_tables.cohort_table(spouse_birth_year))
+            return life_expectancies
+
+        for (main_code, main_gender), (spouse_code, spouse_gender) in itertools.product(enumerate(model_points.GENDERS), repeat=2):
+            mask = (main_genders == main_code) & (spouse_genders == spouse_code)
+            if mask.any():
+                table = joint_life.joint_life_table(mortality_tables, main_gender, spouse_gender, longevity_loading_pct, fractional_assumption, spouse_mortality_tables)
+                life_expectancies[mask] = table.lookup(main_ages[mask], spouse_ages[mask], status)
+
+        return life_expectancies
 
 
     def discount_cashflows(self, cashflows, discount_factors):
@@ -144,226 +415,675 @@ class Model:
 
 
 
-    def main(self, units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price_input, monthly_fee, monthly_expense):
-        '''
-            note that cashflows and life expectancy are in months.
+    def stage(self, name, key, build):
         '''
+            value of a model stage, rebuilt only when the stage key (its inputs) changes.
 
+            only the latest value of each stage is kept.
+        '''
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise Cancelled(name)
 
+        cached = self.stages.get(name)
+        if cached is not None and cached[0] == key:
+            self.diagnostics.hit(name)
+            return cached[1]
 
-        
-        main_life_expectancies = []
-        spouse_life_expectancies = []
-        purchase_cashflows = []
-        discount_cashflows_list = []
-        npvs = []
-
-
-        discount_sale_cf_list = []
-        discount_monthly_fee_cf_list = []
-        discount_monthly_expense_cf_list = []
-        discount_refund_cf_list = []
+        value = self.diagnostics.measure(name, build)
+        self.stages[name] = (key, value)
+        self.stage_builds[name] = self.stage_builds.get(name, 0) + 1
 
-        sale_npvs = []
-        refund_npvs = []
-        monthly_fee_npvs = []
-        monthly_expense_npvs = []
+        return value
 
-        last_life_expectancies = []
+    @contextlib.contextmanager
+    def cancellable(self, cancelled):
+        '''
+            context manager in which every model stage first checks the cancelled event (a threading.Event) and
+            raises Cancelled once it is set, e.g. when a background run is superseded (see background.py).
 
-        discs = []
-        invs = []
-        discount_factors = [1/(1 + discount_rate/(100*12)) ** (month) for month in range(investment_term * 12)]
-        inv_return_factors = [(1 + investment_return/(100*12)) ** (month) for month in range(investment_term * 12)]
+            Stages completed before the cancellation keep their values, so a later run with the same inputs reuses them.
+        '''
+        previous = self.cancelled
+        self.cancelled = cancelled
+        try:
+            yield
+        finally:
+            self.cancelled = previous
+
+    def unit_life_expectancies(self, units, mortality_tables, longevity_loading_pct, single_double, fractional_assumption=None):
+        '''
+            main member, spouse, last (exit) and first death life expectancies in months for every unit.
 
+            units are model_points.ModelPoints. single_double is 'Single' or 'Double' for the whole portfolio or an array
+            with a value per unit; spouse, last survivor and first death life expectancies of Double units are calculated
+            from the joint survival of both lives, see joint_life.py. For Single units the last and first are the main
+            member's life expectancy, and the spouse's is NaN.
 
-        all_workings = {}
+            Returns:
+            dict: int64 arrays 'main', 'last' and 'first', and a float64 array 'spouse'.
+        '''
+        main_life_expectancies = self.calculate_life_expectancies(mortality_tables, units.main_ages, units.main_genders, longevity_loading_pct, fractional_assumption)
+        last_life_expectancies = main_life_expectancies
+        first_life_expectancies = main_life_expectancies
+        spouse_life_expectancies = np.full(len(units), np.nan)
+
+        model_points.check_spouses(units, single_double)
+        double = np.broadcast_to(np.asarray(single_double) == 'Double', len(units))
+
+        if double.any():
+            main_ages = units.main_ages[double]
+            main_genders = units.main_genders[double]
+            spouse_ages = units.spouse_ages[double]
+            spouse_genders = units.spouse_genders[double]
+
+            spouse_life_expectancies[double] = self.calculate_life_expectancies(mortality_tables, spouse_ages, spouse_genders, longevity_loading_pct, fractional_assumption)
+
+            last_life_expectancies = last_life_expectancies.copy()
+            last_life_expectancies[double] = self.calculate_joint_life_expectancies(mortality_tables, main_ages, main_genders, spouse_ages, spouse_genders, longevity_loading_pct, 'last', fractional_assumption)
+            first_life_expectancies = first_life_expectancies.copy()
+            first_life_expectancies[double] = self.calculate_joint_life_expectancies(mortality_tables, main_ages, main_genders, spouse_ages, spouse_genders, longevity_loading_pct, 'first', fractional_assumption)
+
+        return {
+            'main': main_life_expectancies,
+            'spouse': spouse_life_expectancies,
+            'last': last_life_expectancies,
+            'first': first_life_expectancies,
+        }
+
+    @measured('main')
+    def main(self, units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price_input, monthly_fee, monthly_expense, fractional_assumption=None, workings=True, cache_result=True):
+        '''
+            note that cashflows and life expectancy are in months.
 
+            all units are projected together with the vectorised engine, see engine.py. The model is split into
+            stages (mortality -> life expectancy -> exit schedule -> cashflow legs -> discounting -> aggregation),
+            each keyed by its own inputs, so a rerun only recomputes the stages whose inputs changed. E.g. changing
+            the discount rate only rediscounts the cashflows and changing the monthly fee only rebuilds the fee leg.
 
-        for _, unit in units.iterrows():
+            units may carry 'Single/Double', 'Package', 'Purchase Price', 'Monthly Fee' and 'Monthly Expense' columns,
+            which override single_double, package, purchase_price_input, monthly_fee and monthly_expense for each unit
+            (blank values fall back to the arguments), so a mixed portfolio is priced in the same single pass.
 
+            fractional_assumption None projects exits at the annual life expectancies with the longevity loading
+            applied to the expectancy. 'udd', 'constant_force' or 'balducci' uses monthly life expectancies from rates
+            reduced by the longevity loading instead, see mortality.MonthlySurvivalTable.
 
+            all_workings maps each unit ID to its monthly workings DataFrame, which is only built from self.store when
+            it is looked up (the most recently used frames are kept), so the summary results do not pay for the
+            workings. workings=False leaves all_workings empty.
 
-            unit_workings = pd.DataFrame()
-            unit_workings['Month'] = [month for month in range(investment_term * 12)]
-            unit_workings['Investment Return Factors'] = inv_return_factors
-            unit_workings['Discount Factors'] = discount_factors
+            with a result_cache, results already computed for the same units, mortality table and parameters (by this
+            or any other process sharing the cache) are read back instead of running the model. New results are
+            written to the cache unless cache_result is False, e.g. for interactive reruns, which can write them later
+            with write_result_cache.
+        '''
+        units = model_points.ModelPoints.coerce(units)
+        arguments = (longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price_input, monthly_fee, monthly_expense, fractional_assumption)
+
+        cache_key = None
+        cached = None
+        if self.result_cache is not None:
+            cache_key = disk_cache.content_key(RESULT_CACHE_VERSION, hash_units(units), mortality.mortality_table_key(mortality_tables), arguments)
+            cached = self.diagnostics.measure('read result cache', lambda: self.result_cache.get(cache_key))
+
+        self.uncached_result = None
+        if cached is not None:
+            results, all_workings, store = self.stage('aggregation', cache_key, lambda: self.results_from_arrays(units, cached))
+        else:
+            projection = self.project(units, mortality_tables, *arguments)
+            results, all_workings, store = self.stage('aggregation', projection['key'], lambda: self.aggregate(units, projection['life_expectancies'], projection['legs'], projection['counts'], projection['present_values'], projection['discount_factors'], projection['inv_return_factors']))
 
-            discs.append(discount_factors)
-            invs.append(inv_return_factors)
+            if cache_key is not None:
+                self.uncached_result = (cache_key, projection['life_expectancies'], store)
+                if cache_result:
+                    self.write_result_cache()
 
-            main_age = unit['Main Member Age']
-            main_gender = unit['Main Member Gender']
-            main_life_expectancy = self.calculate_life_expectancy(mortality_tables, main_age, main_gender, longevity_loading_pct)
-            last_life_expectancy = main_life_expectancy
-            spouse_age = 'NA'
-            spouse_gender = 'NA'
-            spouse_life_expectancy = 'NA'
-            if single_double == 'Double':
-                spouse_age = unit['Spouse Age']
-                spouse_gender = unit['Spouse Gender']
-                spouse_life_expectancy = self.calculate_life_expectancy(mortality_tables, spouse_age, spouse_gender, longevity_loading_pct)
+        self.cashflows = results
+        self.all_workings = all_workings if workings else {}
+        self.store = store
 
-                last_life_expectancy = max(last_life_expectancy, spouse_life_expectancy)
+        return results
 
-            last_life_expectancies.append(self.convert_age_to_years_months(last_life_expectancy))
-            initial_purchase_price = purchase_price_input #unit['Purchase Price']
-            #monthly_fee = unit['Monthly Fee']
-            #monthly_expense = unit['Monthly Expense']
+    def write_result_cache(self):
+        '''
+            write the results of the latest run of main to the result cache, if they are not there already.
+        '''
+        if self.uncached_result is None:
+            return
 
+        cache_key, life_expectancies, store = self.uncached_result
+        self.diagnostics.measure('write result cache', lambda: self.result_cache.put(cache_key, self.result_arrays(life_expectancies, store)))
+        self.uncached_result = None
 
-            sale_cf = [0] * investment_term * 12
-            monthly_fee_cf = [0] * investment_term * 12
-            monthly_expense_cf = [0] * investment_term * 12
-            refund_cf = [0] * investment_term * 12
-            # net_purchase_price_cf = [0] * investment_term * 12
-            # net_purchase_price_cf = [0] * investment_term * 12
-            # net_purchase_price_cf = [0] * investment_term * 12
-            # expected_cashflows = [0] * investment_term * 12
-            #start_month = 0
+    def project(self, units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price_input, monthly_fee, monthly_expense, fractional_assumption=None):
+        '''
+            run every stage of the model up to and including discounting.
 
+            Returns:
+            dict: life expectancies, exit schedule, occupied months, per unit package and pricing parameters, cashflow legs, occupant
+            counts, the present value of each leg per unit, the discount and investment return factors and a 'key'
+            identifying all of the inputs.
+        '''
+        units = model_points.ModelPoints.coerce(units)
+        months = investment_term * 12
+
+        # mortality: the life expectancy tables themselves are cached per table contents, see mortality.life_expectancy_table
+        mortality_key = mortality.mortality_table_key(mortality_tables)
+        units_key = hash_units(units)
+
+        # package and pricing parameters per unit, see UNIT_PARAMETER_COLUMNS
+        parameters = unit_parameters(units, single_double=single_double, package=package, purchase_price_input=purchase_price_input, monthly_fee=monthly_fee, monthly_expense=monthly_expense)
+        keys = {name: parameter_key(values) for name, values in parameters.items()}
+        is_life_rights = engine.life_rights(parameters['package'])
+
+        life_expectancy_key = (mortality_key, units_key, longevity_loading_pct, keys['single_double'], fractional_assumption)
+        life_expectancies = self.stage('life_expectancy', life_expectancy_key, lambda: self.unit_life_expectancies(units, mortality_tables, longevity_loading_pct, parameters['single_double'], fractional_assumption))
+        last_life_expectancies = life_expectancies['last']
+
+        schedule_key = (life_expectancy_key, investment_term, replacement)
+        schedule = self.stage('schedule', schedule_key, lambda: engine.exit_schedule(last_life_expectancies, months, replacement))
+
+        fee_key = (schedule_key, keys['monthly_fee'])
+        expense_key = (schedule_key, keys['monthly_expense'])
+        sale_key = (schedule_key, keys['package'], investment_return, keys['purchase_price_input'])
+        refund_key = (sale_key, refund_on_resale_pct, refund_on_resale_duration)
+
+        def price_leg(build):
+            if not np.any(is_life_rights):
+                return np.zeros((len(last_life_expectancies), months))
+            prices = self.stage('prices', sale_key, lambda: engine.occupant_prices(schedule, last_life_expectancies, investment_return, parameters['purchase_price_input']))
+            if np.all(is_life_rights):
+                return build(prices)
+            return np.where(is_life_rights, build(prices), 0.0)
+
+        legs = {
+            'sale': self.stage('sale', sale_key, lambda: price_leg(lambda prices: engine.sale_leg(schedule, prices))),
+            'fee': self.stage('fee', fee_key, lambda: engine.fee_leg(schedule, parameters['monthly_fee'])),
+            'expense': self.stage('expense', expense_key, lambda: engine.expense_leg(schedule, parameters['monthly_expense'])),
+            'refund': self.stage('refund', refund_key, lambda: price_leg(lambda prices: engine.refund_leg(schedule, prices, last_life_expectancies, refund_on_resale_pct, refund_on_resale_duration))),
+        }
+        leg_keys = {'sale': sale_key, 'fee': fee_key, 'expense': expense_key, 'refund': refund_key}
+        leg_keys['total'] = tuple(leg_keys.values())
+        legs['total'] = self.stage('total', leg_keys['total'], lambda: engine.total_cashflows(legs['sale'], legs['fee'], legs['expense'], legs['refund']))
+        counts = self.stage('count', (schedule_key, keys['package']), lambda: engine.occupant_counts(schedule, parameters['package']))
+
+        discount_key = (discount_rate, months)
+        discount_factors = self.stage('discount_factors', discount_key, lambda: engine.discount_factors(discount_rate, months))
+        inv_return_factors = self.stage('investment_return_factors', (investment_return, months), lambda: engine.investment_return_factors(investment_return, months))
+
+        # the fee and expense are level while a unit is occupied, so their present values are annuities
+        annuity = self.stage('annuity_factors', discount_key, lambda: engine.annuity_factors(discount_rate, months))
+        occupied = self.stage('occupied_months', schedule_key, lambda: engine.occupied_months(last_life_expectancies, months, replacement))
+
+        present_values = {
+            'sale': self.stage('present_value_sale', (sale_key, discount_key), lambda: engine.present_values(legs['sale'], discount_factors)),
+            'fee': self.stage('present_value_fee', (fee_key, discount_key), lambda: engine.level_present_values(parameters['monthly_fee'], occupied, annuity)),
+            'expense': self.stage('present_value_expense', (expense_key, discount_key), lambda: engine.level_present_values(0 - np.asarray(parameters['monthly_expense'], dtype=float), occupied, annuity)),
+            'refund': self.stage('present_value_refund', (refund_key, discount_key), lambda: engine.present_values(legs['refund'], discount_factors)),
+        }
+        present_values['total'] = engine.total_cashflows(present_values['sale'], present_values['fee'], present_values['expense'], present_values['refund'])
+
+        return {
+            'life_expectancies': life_expectancies,
+            'schedule': schedule,
+            'occupied': occupied,
+            'parameters': parameters,
+            'legs': legs,
+            'counts': counts,
+            'present_values': present_values,
+            'discount_factors': discount_factors,
+            'inv_return_factors': inv_return_factors,
+            'key': (units_key, leg_keys['total'], discount_key, investment_return, keys['package']),
+        }
+
+    def npv_components(self, units, mortality_tables, **parameters):
+        '''
+            present value of each cashflow leg and the NPV of every unit, without building the results table or workings.
 
+            parameters are the same as for Model.main.
 
-       
-            orig_intial_purchase_price = initial_purchase_price
-            purchase_price = orig_intial_purchase_price 
+            Returns:
+            dict: arrays of per unit present values keyed by the results column names in NPV_COMPONENTS.
+        '''
+        present_values = self.project(units, mortality_tables, **parameters)['present_values']
 
-            #print(1/x for x in discount_factors[-5:])
-            #print(inv_return_factors[-5:])
+        return {column: present_values[leg] for column, leg in NPV_COMPONENTS.items()}
 
-            counts = [''] * investment_term * 12
-            count = 0
+    @measured('expected_value')
+    def expected_value(self, units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price_input, monthly_fee, monthly_expense, fractional_assumption=None):
+        '''
+            expected value mode: NPVs of the survival weighted expected cashflows of every unit, see expected.py.
+        '''
+        units = model_points.ModelPoints.coerce(units)
+        parameters = unit_parameters(units, single_double=single_double, package=package, purchase_price_input=purchase_price_input, monthly_fee=monthly_fee, monthly_expense=monthly_expense)
+        cashflows, unit_lives = expected.project_expected(units, mortality_tables, longevity_loading_pct, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, parameters['single_double'], parameters['package'], parameters['purchase_price_input'], parameters['monthly_fee'], parameters['monthly_expense'], fractional_assumption)
+        discount_factors = engine.discount_factors(discount_rate, investment_term * 12)
 
-            start_month = 0
-            for i in range(investment_term * 12):
-                if (package == 'Life Rights') and (i == start_month):
-                    sale_cf[i] = purchase_price 
-                    count = count + 1
+        # cashflows are per distinct life, so discount them before gathering the values of each unit
+        results = pd.DataFrame()
+        results['ID'] = units.ids
+        for column, leg in NPV_COMPONENTS.items():
+            results[column] = engine.present_values(cashflows[leg], discount_factors)[unit_lives]
+        results['Expected Occupied Months'] = cashflows['occupied'].sum(axis=1)[unit_lives]
 
-                if i >= start_month:
-                    monthly_fee_cf[i] += monthly_fee 
-                    monthly_expense_cf[i] -= monthly_expense
+        self.expected_cashflows = results
 
-                if (package == 'Life Rights') and (i == last_life_expectancy+start_month):
-                    if i < refund_on_resale_duration*12+start_month:
-                        refund_on_resale = purchase_price * (refund_on_resale_pct/100) # TODO: confirm if refund on resale is related on initial purchase price or sale price?
-                        refund_cf[i] -= refund_on_resale
+        return results
 
-                    purchase_price = orig_intial_purchase_price * inv_return_factors[i]
+    @measured('simulate')
+    def simulate(self, units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price_input, monthly_fee, monthly_expense, fractional_assumption=None, **options):
+        '''
+            stochastic mode: NPV distribution of every unit from simulated deaths, see stochastic.simulate for the options
+            (paths, seed, chunk_size, percentiles, var_levels).
+        '''
+        units = model_points.ModelPoints.coerce(units)
+        parameters = unit_parameters(units, single_double=single_double, package=package, purchase_price_input=purchase_price_input, monthly_fee=monthly_fee, monthly_expense=monthly_expense)
+        results = stochastic.simulate(units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, **parameters, fractional_assumption=fractional_assumption, **options)
 
-                    # print(f"month: {i}, inv ret fact: {((1+investment_return/(100*12))**i)}")
-                    
-                if (i == last_life_expectancy+start_month):
+        self.simulation = results
 
-                    if not replacement:
-                        counts[i] = count
-                        break
+        return results
 
-                    start_month = i + 1
-                 
+    @measured('scenarios')
+    def value_scenarios(self, units, mortality_tables, discount_curves=None, investment_return_paths=None, max_bytes=2**28, **parameters):
+        '''
+            NPV components of every unit under each economic scenario, see scenarios.py.
+
+            Parameters:
+            discount_curves: monthly spot rates (annual %) of each scenario, as a curves CSV path, a DataFrame with a
+                'Month' column and a column per scenario, or a (scenarios x months) array. None discounts every
+                scenario at discount_rate.
+            investment_return_paths: monthly property investment returns (annual %) of each scenario, in the same
+                forms. None grows prices at investment_return.
+            max_bytes (int): bound on the memory of the per scenario cashflows built at once with investment return paths.
+            parameters: values of the other Model.main parameters. discount_rate and investment_return are only
+                needed without discount_curves and investment_return_paths respectively.
+
+            A single curve or path applies to every scenario of the other.
+
+            Returns:
+            pd.DataFrame: one row per scenario and unit, with 'Scenario', 'ID' and the results NPV columns.
+        '''
+        if discount_curves is None and investment_return_paths is None:
+            raise ValueError('Give discount_curves, investment_return_paths or both')
+
+        units = model_points.ModelPoints.coerce(units)
+        months = parameters['investment_term'] * 12
+        # the flat rates the curves replace only matter to the projection's own present values
+        for name in ('discount_rate', 'investment_return'):
+            if parameters.get(name) is None:
+                parameters[name] = 0
+        projection = self.project(units, mortality_tables, **parameters)
+
+        if discount_curves is not None:
+            names, spot_rates = scenarios.as_curves(discount_curves, months, 'Discount curves')
+            discount_factors = scenarios.discount_factors(spot_rates)
+        else:
+            discount_factors = projection['discount_factors'].reshape(1, -1)
+
+        accumulation_factors = None
+        if investment_return_paths is not None:
+            path_names, return_rates = scenarios.as_curves(investment_return_paths, months, 'Investment return paths')
+            accumulation_factors = scenarios.accumulation_factors(return_rates)
+            if discount_curves is None or len(path_names) > len(names):
+                names = path_names
+
+        present_values = scenarios.present_values(
+            projection['schedule'], projection['legs'], projection['life_expectancies']['last'], projection['occupied'], projection['parameters'],
+            discount_factors, accumulation_factors, parameters['refund_on_resale_pct'], parameters['refund_on_resale_duration'], max_bytes,
+        )
 
-                counts[i] = count
+        n_scenarios = len(present_values['total'])
+        results = pd.DataFrame()
+        results['Scenario'] = np.repeat(names if len(names) == n_scenarios else range(n_scenarios), len(units))
+        results['ID'] = np.tile(units.ids, n_scenarios)
+        for column, leg in NPV_COMPONENTS.items():
+            results[column] = present_values[leg].ravel()
 
+        self.scenario_results = results
 
+        return results
 
+    @measured('stream')
+    def stream(self, units, mortality_tables, chunk_size=streaming.DEFAULT_CHUNK_SIZE, summary_path=None, **parameters):
+        '''
+            aggregates of a portfolio too large to value at once, projecting chunk_size units at a time, see streaming.py.
 
-            expected_cashflows = [x + y + z + a for x, y, z, a in zip(sale_cf, monthly_fee_cf, monthly_expense_cf, refund_cf)]
+            Parameters:
+            units: path of a units CSV, or an iterable of chunks of units (DataFrames or model_points.ModelPoints).
+            chunk_size (int): number of units read from a CSV and projected at a time, which bounds peak memory.
+            summary_path (str): if given, write the life expectancies and NPVs of every unit to this .csv or .parquet
+                file, chunk by chunk.
+            parameters: values of the Model.main parameters.
 
-           # pdb.set_trace()
-            unit_workings['Count'] = counts
-            unit_workings['Expected Sale Cashflows'] = sale_cf
-            unit_workings['Expected Fee Cashflows'] = monthly_fee_cf
-            unit_workings['Expected Expense Cashflows'] = monthly_expense_cf
-            unit_workings['Expected Refund Cashflows'] = refund_cf
-            unit_workings['All Expected Cashflows'] = expected_cashflows
+            Only the stages of the current chunk are kept, and no results table, store or workings are built.
 
-            disc_sale_cf, sale_pv, _ = self.discount_cashflows(sale_cf, discount_factors)
-            disc_refund_cf, refund_pv, _ = self.discount_cashflows(refund_cf, discount_factors)
-            disc_monthly_fee_cf, monthly_fee_pv, _ = self.discount_cashflows(monthly_fee_cf, discount_factors)
-            disc_monthly_expense_cf, monthly_expense_pv, _ = self.discount_cashflows(monthly_expense_cf, discount_factors)
-            discounted_cashflows, npv, discount_factors = self.discount_cashflows(expected_cashflows, discount_factors)
+            Returns:
+            streaming.PortfolioAggregates: NPV totals, yearly cashflow totals and life expectancy distributions.
+        '''
+        aggregates = streaming.PortfolioAggregates(parameters['investment_term'] * 12, list(NPV_COMPONENTS))
+        summary = streaming.SummaryWriter(summary_path) if summary_path else None
+
+        chunks = streaming.chunks(units, chunk_size)
+        try:
+            while True:
+                # drop the previous chunk's cashflows before reading the next one
+                self.stages.clear()
+                chunk = self.diagnostics.measure('read units', lambda: next(chunks, None))
+                if chunk is None:
+                    break
+
+                projection = self.project(chunk, mortality_tables, **parameters)
+                npvs = {column: projection['present_values'][leg] for column, leg in NPV_COMPONENTS.items()}
+                self.diagnostics.measure('aggregate chunk', lambda: aggregates.add(projection['life_expectancies'], projection['legs'], npvs, projection['discount_factors']), len(chunk))
+                if summary is not None:
+                    self.diagnostics.measure('write summary', lambda: summary.write(streaming.summary_table(chunk, projection['life_expectancies'], npvs)), len(chunk))
+                del projection, npvs
+        finally:
+            chunks.close()
+            if summary is not None:
+                summary.close()
+
+        self.aggregates = aggregates
+
+        return aggregates
+
+    @measured('solve_breakeven')
+    def solve_breakeven(self, units, mortality_tables, target_npv=0.0, solve_for='purchase_price_input', bounds=None, tolerance=1e-6, max_iterations=100, **parameters):
+        '''
+            value of one parameter at which the NPV of every unit equals target_npv.
+
+            Parameters:
+            target_npv (float or array-like): NPV to solve for, for all units or per unit.
+            solve_for (str): parameter to solve for, one of BREAKEVEN_PARAMETERS.
+            bounds (tuple): (low, high) bracket of the parameters solved by bisection, defaults to BREAKEVEN_BOUNDS.
+            tolerance, max_iterations: bisection stopping criteria, see breakeven.bisect.
+            parameters: values of the other Model.main parameters (a value given for solve_for is ignored, as is
+                its units column).
+
+            The NPV is linear in the purchase price, monthly fee, monthly expense and refund %, so their break-even
+            values come from a single projection. The discount rate, investment return and early exit term are
+            solved by bisection on all units at once, reusing the exit schedule and cashflow legs of one projection.
+
+            Returns:
+            pd.DataFrame: 'ID' and 'Break-even <parameter>' for every unit, NaN where no value in range gives the
+            target NPV (e.g. the purchase price of a Rental unit).
+        '''
+        if solve_for not in BREAKEVEN_PARAMETERS:
+            raise ValueError(f'Cannot solve for {solve_for}, expected one of {list(BREAKEVEN_PARAMETERS)}')
+
+        parameters = {name: value for name, value in parameters.items() if name != solve_for}
+        signature = inspect.signature(self.project).parameters
+        names = [name for name in signature if name not in ('units', 'mortality_tables', solve_for)]
+        unknown = set(parameters) - set(names)
+        if unknown:
+            raise ValueError(f'Unknown model parameters: {sorted(unknown)}')
+        missing = {name for name in names if signature[name].default is inspect.Parameter.empty} - set(parameters)
+        if missing:
+            raise ValueError(f'Missing model parameters: {sorted(missing)}')
+
+        units = model_points.ModelPoints.coerce(units)
+        column = UNIT_PARAMETER_COLUMNS.get(solve_for)
+        if column in units.parameter_columns:
+            units = units.without_column(column)
+        target_npv = np.asarray(target_npv, dtype=float)
+
+        if solve_for in BREAKEVEN_LINEAR:
+            # NPV = slope * value + intercept, from the NPV components at a known value
+            value, columns = BREAKEVEN_LINEAR[solve_for]
+            components = self.npv_components(units, mortality_tables, **parameters, **{solve_for: value})
+            proportional = sum(components[name] for name in columns)
+            values = breakeven.linear_breakeven(proportional / value, components['NPV'] - proportional, target_npv)
+        else:
+            low, high = bounds if bounds is not None else BREAKEVEN_BOUNDS[solve_for]
+            projection = self.project(units, mortality_tables, **parameters, **{solve_for: low})
+
+            months = parameters['investment_term'] * 12
+            legs = projection['legs']
+            present_values = projection['present_values']
+            unit_values = projection['parameters']
+            last_life_expectancies = projection['life_expectancies']['last']
+            is_life_rights = engine.life_rights(unit_values['package'])
+
+            if solve_for == 'discount_rate':
+                def npv(discount_rates):
+                    return breakeven.present_values(legs['total'], breakeven.discount_factors(discount_rates, months))
+            elif solve_for == 'investment_return':
+                def npv(investment_returns):
+                    sale, refund = breakeven.price_legs(projection['schedule'], last_life_expectancies, is_life_rights, investment_returns, unit_values['purchase_price_input'], parameters['refund_on_resale_pct'], parameters['refund_on_resale_duration'])
+                    return present_values['fee'] + present_values['expense'] + breakeven.present_values(sale + refund, projection['discount_factors'])
+            else:
+                def npv(refund_on_resale_durations):
+                    _, refund = breakeven.price_legs(projection['schedule'], last_life_expectancies, is_life_rights, parameters['investment_return'], unit_values['purchase_price_input'], parameters['refund_on_resale_pct'], refund_on_resale_durations)
+                    return present_values['sale'] + present_values['fee'] + present_values['expense'] + breakeven.present_values(refund, projection['discount_factors'])
+
+            values = breakeven.bisect(lambda x: npv(x) - target_npv, np.full(len(units), low), np.full(len(units), high), tolerance, max_iterations)
 
+        results = pd.DataFrame()
+        results['ID'] = units.ids
+        results[f'Break-even {BREAKEVEN_PARAMETERS[solve_for]}'] = values
 
-            unit_workings['Discounted Sale Cashflows'] = disc_sale_cf
-            unit_workings['Discounted Fee Cashflows'] = disc_monthly_fee_cf
-            unit_workings['Discounted Expense Cashflows'] = disc_monthly_expense_cf
-            unit_workings['Discounted Refund Cashflows'] = disc_refund_cf
-            unit_workings['All Discounted Cashflows'] = discounted_cashflows
+        self.breakeven = results
 
+        return results
 
+    @measured('sweep')
+    def sweep(self, grid, mortality_tables, workers=None, chunksize=None, **parameters):
+        '''
+            NPV components of every unit for every combination of the parameter values in grid.
+
+            Parameters:
+            grid (dict): Model.main parameter name -> list of values to sweep, e.g. {'discount_rate': [5, 10, 15]}.
+            mortality_tables (pd.DataFrame): mortality table used for every combination.
+            workers (int): number of worker processes, defaults to the number of CPUs. 1 runs in this process.
+            chunksize (int): number of combinations sent to a worker at a time.
+            parameters: values of the Model.main parameters that are not swept.
+
+            The units (self.model_points) and mortality table are sent to each worker once. Each worker keeps its
+            own model stages, and combinations are ordered so that consecutive combinations in a chunk share the
+            expensive early stages.
+
+            Returns:
+            pd.DataFrame: long format, one row per combination, unit and component, with a column for each swept
+            parameter followed by 'ID', 'Component' (a results NPV column, e.g. 'Fee NPV') and 'Value'.
+        '''
+        signature = inspect.signature(self.project).parameters
+        names = [name for name in signature if name not in ('units', 'mortality_tables')]
+        unknown = set(grid) - set(names)
+        if unknown:
+            raise ValueError(f'Unknown sweep parameters: {sorted(unknown)}')
+        missing = {name for name in names if signature[name].default is inspect.Parameter.empty} - set(grid) - set(parameters)
+        if missing:
+            raise ValueError(f'Missing model parameters: {sorted(missing)}')
+
+        units = model_points.ModelPoints.coerce(self.model_points)
+        swept = [name for name in SWEEP_PARAMETERS if name in grid]
+        combinations = [dict(parameters, **dict(zip(swept, values))) for values in itertools.product(*[grid[name] for name in swept])]
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(combinations)))
+
+        if workers == 1:
+            values = sweep_combinations(Model(units), units, mortality_tables, combinations)
+        else:
+            if chunksize is None:
+                chunksize = math.ceil(len(combinations) / (workers * 4))
+            chunks = [combinations[i:i + chunksize] for i in range(0, len(combinations), chunksize)]
 
-            main_life_expectancies.append(self.convert_age_to_years_months(main_life_expectancy))
-            spouse_life_expectancies.append(self.convert_age_to_years_months(spouse_life_expectancy))
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_sweep_worker, initargs=(units, mortality_tables)) as executor:
+                values = np.concatenate(list(executor.map(run_sweep_chunk, chunks)))
 
+        n_combinations, n_components, n_units = values.shape
+        rows_per_combination = n_components * n_units
 
-            # unit_workings['Main Life'] = disc_refund_cf
-            # unit_workings['All Discounted Cashflows'] = discounted_cashflows
+        results = pd.DataFrame()
+        for name in swept:
+            results[name] = np.repeat([combination[name] for combination in combinations], rows_per_combination)
+        results['ID'] = np.tile(units.ids, n_combinations * n_components)
+        results['Component'] = np.tile(np.repeat(list(NPV_COMPONENTS), n_units), n_combinations)
+        results['Value'] = values.reshape(-1)
 
+        return results
 
-            purchase_cashflows.append(sale_cf)
-            # cashflows.append(expected_cashflows)
-            # cashflows.append(expected_cashflows)
-            # cashflows.append(expected_cashflows)
+    def aggregate(self, units, life_expectancies, legs, counts, present_values, discount_factors, inv_return_factors):
+        '''
+            build the results table, the results store and the lazy workings of every unit from the projected cashflows
+            and their present values. The store refers to the staged expected cashflows without copying them, and
+            discounts them when they are sliced.
+        '''
+        npvs = {column: present_values[leg] for column, leg in NPV_COMPONENTS.items()}
+
+        store = results_store.ResultsStore(
+            units.ids,
+            {
+                'Expected Sale Cashflows': legs['sale'],
+                'Expected Fee Cashflows': legs['fee'],
+                'Expected Expense Cashflows': legs['expense'],
+                'Expected Refund Cashflows': legs['refund'],
+                'All Expected Cashflows': legs['total'],
+            },
+            counts,
+            discount_factors,
+            inv_return_factors,
+            npvs,
+        )
 
-            discount_cashflows_list.append(discounted_cashflows)
-            discount_sale_cf_list.append(disc_sale_cf)
-            discount_refund_cf_list.append(disc_refund_cf)
-            discount_monthly_fee_cf_list.append(disc_monthly_fee_cf)
-            discount_monthly_expense_cf_list.append(disc_monthly_expense_cf)
-            
-            npvs.append(npv)
-            sale_npvs.append(sale_pv)
-            refund_npvs.append(refund_pv)
-            monthly_fee_npvs.append(monthly_fee_pv)
-            monthly_expense_npvs.append(monthly_expense_pv)
+        all_workings = results_store.UnitWorkings(store, self.unit_workings)
+        results = self.results_table(units, life_expectancies, npvs)
 
+        return results, all_workings, store
 
-            unit_workings['Sale NPV'] = ''
-            unit_workings['Fee NPV'] = ''
-            unit_workings['Expense NPV'] = ''
-            unit_workings['Refund NPV'] = ''
-            unit_workings['NPV'] = ''
-            unit_workings.loc[0, 'Sale NPV'] = sale_pv
-            unit_workings.loc[0, 'Fee NPV'] = monthly_fee_pv
-            unit_workings.loc[0, 'Expense NPV'] = monthly_expense_pv
-            unit_workings.loc[0, 'Refund NPV'] = refund_pv
-            unit_workings.loc[0, 'NPV'] = npv
-            # unit_workings['Discounted Fee Cashflows'] = disc_monthly_fee_cf
-            # unit_workings['Discounted Expense Cashflows'] = disc_monthly_expense_cf
-            # unit_workings['Discounted Refund Cashflows'] = disc_refund_cf
-            # unit_workings['All Discounted Cashflows'] = discounted_cashflows
+    def results_table(self, units, life_expectancies, npvs):
+        '''
+            results table of life expectancies and NPV components, one row per unit.
+        '''
+        frame = units.to_frame()
+        spouse_life_expectancies = [None if np.isnan(life_expectancy) else int(life_expectancy) for life_expectancy in life_expectancies['spouse'].tolist()]
 
+        results = pd.DataFrame()
+        results['ID'] = frame['ID']
+        results['Last Life Expectancy'] = [self.convert_age_to_years_months(x) for x in life_expectancies['last'].tolist()]
+        results['NPV'] = npvs['NPV']
+        results['Purchase NPV'] = npvs['Purchase NPV']
+        results['Refund NPV'] = npvs['Refund NPV']
+        results['Fee NPV'] = npvs['Fee NPV']
+        results['Expense NPV'] = npvs['Expense NPV']
+        results['Main Member Age'] = frame['Main Member Age']
+        results['Main Member Gender'] = frame['Main Member Gender']
+        results['Spouse Age'] = frame['Spouse Age']
+        results['Spouse Gender'] = frame['Spouse Gender']
+        results['Main Life Expectancy'] = [self.convert_age_to_years_months(x) for x in life_expectancies['main'].tolist()]
+        results['Spouse Life Expectancy'] = [self.convert_age_to_years_months(x) for x in spouse_life_expectancies]
+        # the monthly cashflows, discount factors and investment return factors of each unit are in the results store
 
+        return results
 
-            all_workings[unit['ID']] = unit_workings
-            # if main_age == 90:
-            #     pdb.set_trace()
+    def result_arrays(self, life_expectancies, store):
+        '''
+            arrays of the results of main for the result cache, see results_from_arrays.
 
-        results = pd.DataFrame()
-        results['ID'] = units['ID']
-        results['Last Life Expectancy'] = last_life_expectancies
-        results['NPV'] = npvs
-        results['Purchase NPV'] = sale_npvs
-        results['Refund NPV'] = refund_npvs
-        results['Fee NPV'] = monthly_fee_npvs
-        results['Expense NPV'] = monthly_expense_npvs
-        results['Main Member Age'] = units['Main Member Age']
-        results['Main Member Gender'] = units['Main Member Gender']
-        results['Spouse Age'] = units['Spouse Age']
-        results['Spouse Gender'] = units['Spouse Gender']
-        results['Main Life Expectancy'] = main_life_expectancies
-        results['Spouse Life Expectancy'] = spouse_life_expectancies
-        results['Purchase Cashflows'] = purchase_cashflows
-        results['Discounted Cashflows'] = discount_cashflows_list
-        results['Discount Factors'] = discs
-        results['Investment Return Factors'] = invs
+            Only the expected cashflows are kept, in compact form: the fee and expense as one amount per unit (they are
+            level in every projected month, i.e. where the count is not -1), and the sale and refund, which are only
+            paid in a few months, as the positions and values of their payments. The total and the discounted
+            cashflows are recomputed when the results are read back.
+        '''
+        counts = store.counts
+        if counts.size and counts.max() <= np.iinfo(np.int16).max:
+            counts = counts.astype(np.int16)
+
+        arrays = {
+            'life_expectancies': np.array([
+                life_expectancies['main'],
+                np.where(np.isnan(life_expectancies['spouse']), -1, life_expectancies['spouse']),
+                life_expectancies['last'],
+                life_expectancies['first'],
+            ], dtype=np.int64).reshape(4, -1),
+            'counts': counts,
+            # every unit is projected in month 0
+            'fee': store.legs['Expected Fee Cashflows'][:, :1],
+            'expense': store.legs['Expected Expense Cashflows'][:, :1],
+            'discount_factors': store.discount_factors,
+            'inv_return_factors': store.inv_return_factors,
+            'npvs': store.npvs[list(NPV_COMPONENTS)].to_numpy(dtype=float).T,
+        }
+        for name, leg in (('sale', 'Expected Sale Cashflows'), ('refund', 'Expected Refund Cashflows')):
+            values = store.legs[leg].reshape(-1)
+            # keep negative zeros, so that the cashflows read back are identical
+            positions = np.flatnonzero((values != 0) | np.signbit(values))
+            arrays[f'{name}_positions'] = positions.astype(np.int32) if values.size <= np.iinfo(np.int32).max else positions
+            arrays[f'{name}_values'] = values[positions]
+
+        return arrays
+
+    def results_from_arrays(self, units, arrays):
+        '''
+            results table, lazy workings and results store of main from the arrays of result_arrays.
 
+            The expected cashflows are rebuilt from their compact form, and the store discounts them when sliced.
+        '''
+        main, spouse, last, first = np.asarray(arrays['life_expectancies'])
+        life_expectancies = {'main': main, 'spouse': np.where(spouse < 0, np.nan, spouse), 'last': last, 'first': first}
+        npvs = dict(zip(NPV_COMPONENTS, arrays['npvs']))
+
+        counts = np.asarray(arrays['counts'])
+        projected = counts >= 0
+        legs = {
+            'fee': np.where(projected, arrays['fee'], 0.0),
+            'expense': np.where(projected, arrays['expense'], 0.0),
+        }
+        for name in ('sale', 'refund'):
+            values = np.zeros(counts.shape)
+            values.reshape(-1)[arrays[f'{name}_positions']] = arrays[f'{name}_values']
+            legs[name] = values
+        legs['total'] = engine.total_cashflows(legs['sale'], legs['fee'], legs['expense'], legs['refund'])
+
+        store = results_store.ResultsStore(
+            units.ids,
+            {
+                'Expected Sale Cashflows': legs['sale'],
+                'Expected Fee Cashflows': legs['fee'],
+                'Expected Expense Cashflows': legs['expense'],
+                'Expected Refund Cashflows': legs['refund'],
+                'All Expected Cashflows': legs['total'],
+            },
+            counts,
+            arrays['discount_factors'],
+            arrays['inv_return_factors'],
+            npvs,
+        )
 
-        self.cashflows = results
-        self.all_workings = all_workings
+        return self.results_table(units, life_expectancies, npvs), results_store.UnitWorkings(store, self.unit_workings), store
 
-        return results
-        
+    @measured('unit_workings')
+    def unit_workings(self, store, unit_id):
+        '''
+            monthly workings of one unit from the results store.
+        '''
+        position = store.position(unit_id)
+        npvs = store.npvs.iloc[position]
+
+        unit_workings = pd.DataFrame()
+        unit_workings['Month'] = [month for month in range(store.months)]
+        unit_workings['Investment Return Factors'] = store.inv_return_factors
+        unit_workings['Discount Factors'] = store.discount_factors
+
+        unit_workings['Count'] = [count if count >= 0 else '' for count in store.counts[position].tolist()]
+        for column in results_store.LEGS:
+            unit_workings[column] = np.array(store.leg(column, position))
+
+        unit_workings['Sale NPV'] = ''
+        unit_workings['Fee NPV'] = ''
+        unit_workings['Expense NPV'] = ''
+        unit_workings['Refund NPV'] = ''
+        unit_workings['NPV'] = ''
+        unit_workings.loc[0, 'Sale NPV'] = npvs['Purchase NPV']
+        unit_workings.loc[0, 'Fee NPV'] = npvs['Fee NPV']
+        unit_workings.loc[0, 'Expense NPV'] = npvs['Expense NPV']
+        unit_workings.loc[0, 'Refund NPV'] = npvs['Refund NPV']
+        unit_workings.loc[0, 'NPV'] = npvs['NPV']
+
+        return unit_workings
 
     def convert_age_to_years_months(self, age_in_months):
 
@@ -377,24 +1097,31 @@ class Model:
         else:
             return ""
 
-    def remaining_life_expectancies(self, mortality_tables, longevity_loading_pct):
+    def remaining_life_expectancies(self, mortality_tables, longevity_loading_pct, fractional_assumption=None):
+        '''
+            life expectancies from various ages, only recalculated when the mortality table, longevity loading or fractional age assumption changes.
+        '''
+        key = (mortality.mortality_table_key(mortality_tables), longevity_loading_pct, fractional_assumption)
+        results, fig = self.stage('remaining_life_expectancies', key, lambda: self.build_remaining_life_expectancies(mortality_tables, longevity_loading_pct, fractional_assumption))
 
-        results = pd.DataFrame()
-        age = []
-        remaining_life_expectancy_male = []
-        remaining_life_expectancy_female = []
-        
+        self.charts["Life Expectancy from Various Ages"] = fig
+        self.life_expectancies = results
 
-        for x in range(60, 95, 5):
-            age.append(x)
+        return results, fig
 
-            remaining_life_expectancy_male.append(self.calculate_life_expectancy(mortality_tables, x, 'Male', longevity_loading_pct)/ 12.0) 
-            remaining_life_expectancy_female.append(self.calculate_life_expectancy(mortality_tables, x, 'Female', longevity_loading_pct)/ 12.0) 
+    def build_remaining_life_expectancies(self, mortality_tables, longevity_loading_pct, fractional_assumption=None):
+
+        results = pd.DataFrame()
+        age = list(range(60, 95, 5))
+        remaining_life_expectancy_male = self.calculate_life_expectancies(mortality_tables, age, ['Male'] * len(age), longevity_loading_pct, fractional_assumption) / 12.0
+        remaining_life_expectancy_female = self.calculate_life_expectancies(mortality_tables, age, ['Female'] * len(age), longevity_loading_pct, fractional_assumption) / 12.0
 
         results['Age'] = age 
         results['Male'] = remaining_life_expectancy_male
         results['Female'] = remaining_life_expectancy_female
 
+        import plotly.express as px
+
         fig = px.line(
             results,
             x="Age",
@@ -403,16 +1130,12 @@ class Model:
             title="Life Expectancy from Various Ages",
         )
 
-        self.charts["Life Expectancy from Various Ages"] = fig
-
         results['Male'] = results['Male'] * 12
         results['Female'] = results['Female'] * 12
 
         results['Male'] = results['Male'].apply(self.convert_age_to_years_months)
         results['Female' ] = results['Female'].apply(self.convert_age_to_years_months)
 
-        self.life_expectancies = results
-
         return results, fig
 
 # if __name__ == '__main__':
@@ -0,0 +1,232 @@
+'''
+    Typed, columnar model points.
+
+    A ModelPoints holds the units of a units CSV as one contiguous array per field:
+    int16 ages, int8 gender codes (indices into GENDERS), a boolean has_spouse mask,
+    and the optional per unit package and pricing columns (see
+    model.UNIT_PARAMETER_COLUMNS) with blanks as NaN. The projection works on these
+    arrays directly rather than on DataFrame columns of Python objects.
+
+    The units are validated when they are loaded, so a malformed file fails with a
+    message naming the offending units, rather than part way through a projection.
+
+        points = ModelPoints.read_csv('units.csv')
+        model.main(points, mortality_tables, ...)
+
+    Model methods also accept a units DataFrame, which they convert with
+    ModelPoints.coerce.
+'''
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import cache
+import mortality
+
+
+GENDERS = tuple(mortality.GENDER_COLUMNS)
+
+REQUIRED_COLUMNS = ['ID', 'Main Member Age', 'Main Member Gender', 'Spouse Age', 'Spouse Gender']
+
+# optional per unit columns and their allowed values, None for numeric columns
+PARAMETER_COLUMNS = {
+    'Single/Double': ('Single', 'Double'),
+    'Package': ('Life Rights', 'Rental'),
+    'Purchase Price': None,
+    'Monthly Fee': None,
+    'Monthly Expense': None,
+}
+
+MAX_AGE = 130
+
+
+def gender_codes(genders):
+    '''
+        int8 codes into GENDERS of gender labels (or of codes, which are returned as is), -1 for anything else.
+    '''
+    genders = np.asarray(genders)
+    if genders.dtype.kind in 'iu':
+        return genders.astype(np.int8, copy=False)
+
+    return pd.Categorical(genders, categories=GENDERS).codes.astype(np.int8, copy=False)
+
+
+def invalid_units(ids, mask, limit=5):
+    '''
+        the first few IDs of the units in mask, for error messages.
+    '''
+    invalid = ids[mask][:limit].tolist()
+    more = mask.sum() - len(invalid)
+
+    return ', '.join(map(str, invalid)) + (f' and {more} more' if more else '')
+
+
+def check_spouses(units, single_double):
+    '''
+        raise a ValueError naming the Double units without spouse details.
+
+        Parameters:
+        units (ModelPoints): units to check.
+        single_double (str or np.ndarray): 'Single' or 'Double', for all units or per unit.
+    '''
+    missing = np.broadcast_to(np.asarray(single_double) == 'Double', len(units)) & ~units.has_spouse
+    if missing.any():
+        raise ValueError(f'Double units need spouse details, missing for units {invalid_units(units.ids, missing)}')
+
+
+def ages(values, ids, column, required):
+    '''
+        int16 ages from a column, 0 where blank, raising ValueError for invalid ages (or blanks if required).
+    '''
+    numeric = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+    blank = pd.isna(values)
+    is_number = ~np.isnan(numeric)
+    invalid = (~blank & ~is_number) | (is_number & ((numeric != np.round(numeric)) | (numeric < 0) | (numeric > MAX_AGE)))
+    if required:
+        invalid |= blank
+    if invalid.any():
+        raise ValueError(f"Invalid '{column}' (whole years from 0 to {MAX_AGE}) for units {invalid_units(ids, invalid)}")
+
+    return np.where(blank, 0, numeric).astype(np.int16)
+
+
+class ModelPoints:
+    '''
+        typed columnar units.
+
+        Attributes:
+        ids (np.ndarray): unit IDs.
+        main_ages, spouse_ages (np.ndarray): int16 ages, spouse ages 0 for units without a spouse.
+        main_genders, spouse_genders (np.ndarray): int8 codes into GENDERS, spouse genders -1 for units without a spouse.
+        has_spouse (np.ndarray): bool mask of the units with spouse details.
+        parameter_columns (dict): the optional PARAMETER_COLUMNS present, as object arrays of labels (None when blank)
+            or float arrays (NaN when blank).
+    '''
+
+    def __init__(self, ids, main_ages, main_genders, spouse_ages, spouse_genders, has_spouse, parameter_columns=None):
+        self.ids = np.asarray(ids)
+        self.main_ages = main_ages
+        self.main_genders = main_genders
+        self.spouse_ages = spouse_ages
+        self.spouse_genders = spouse_genders
+        self.has_spouse = has_spouse
+        self.parameter_columns = parameter_columns or {}
+
+        self._key = None
+
+    @classmethod
+    def from_frame(cls, units):
+        '''
+            validated model points from a units DataFrame with the columns of units.csv.
+        '''
+        missing = [column for column in REQUIRED_COLUMNS if column not in units]
+        if missing:
+            raise ValueError(f'Units are missing the columns {missing}, expected {REQUIRED_COLUMNS} and optionally {list(PARAMETER_COLUMNS)}')
+
+        ids = units['ID'].to_numpy()
+        if pd.isna(ids).any():
+            raise ValueError(f'{pd.isna(ids).sum()} units have no ID')
+
+        main_ages = ages(units['Main Member Age'].to_numpy(), ids, 'Main Member Age', required=True)
+        main_genders = gender_codes(units['Main Member Gender'].to_numpy(dtype=object))
+        if (main_genders < 0).any():
+            raise ValueError(f"Invalid 'Main Member Gender' (one of {GENDERS}) for units {invalid_units(ids, main_genders < 0)}")
+
+        spouse_age_blank = units['Spouse Age'].isna().to_numpy()
+        spouse_gender_blank = units['Spouse Gender'].isna().to_numpy()
+        partial = spouse_age_blank != spouse_gender_blank
+        if partial.any():
+            raise ValueError(f"Units {invalid_units(ids, partial)} have only one of 'Spouse Age' and 'Spouse Gender'")
+        has_spouse = ~spouse_age_blank
+
+        spouse_ages = ages(units['Spouse Age'].to_numpy(), ids, 'Spouse Age', required=False)
+        spouse_genders = gender_codes(units['Spouse Gender'].to_numpy(dtype=object))
+        if (has_spouse & (spouse_genders < 0)).any():
+            raise ValueError(f"Invalid 'Spouse Gender' (one of {GENDERS}) for units {invalid_units(ids, has_spouse & (spouse_genders < 0))}")
+
+        parameter_columns = {}
+        for column, allowed in PARAMETER_COLUMNS.items():
+            if column not in units:
+                continue
+            blank = units[column].isna().to_numpy()
+            if allowed is None:
+                values = pd.to_numeric(units[column], errors='coerce').to_numpy(dtype=float)
+                invalid = np.isnan(values) & ~blank
+                expected = 'a number'
+            else:
+                values = units[column].where(~blank, None).to_numpy(dtype=object)
+                invalid = ~blank & ~np.isin(values, allowed)
+                expected = f'one of {allowed}'
+            if invalid.any():
+                raise ValueError(f"Invalid '{column}' ({expected} or blank) for units {invalid_units(ids, invalid)}")
+            parameter_columns[column] = values
+
+        return cls(ids, main_ages, main_genders, spouse_ages, spouse_genders, has_spouse, parameter_columns)
+
+    @classmethod
+    def read_csv(cls, path):
+        '''
+            validated model points from a units CSV, cached until the file changes.
+        '''
+        return cache.cached_file('model_points', path, lambda path: cls.from_frame(pd.read_csv(path)))
+
+    @classmethod
+    def coerce(cls, units):
+        '''
+            units as ModelPoints, converting a units DataFrame.
+        '''
+        return units if isinstance(units, cls) else cls.from_frame(units)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def key(self):
+        '''
+            hashable key identifying the contents of the model points.
+        '''
+        if self._key is None:
+            digest = hashlib.sha1()
+            digest.update(pd.util.hash_array(self.ids).tobytes())
+            for values in (self.main_ages, self.main_genders, self.spouse_ages, self.spouse_genders, self.has_spouse):
+                digest.update(np.ascontiguousarray(values).tobytes())
+            for column, values in self.parameter_columns.items():
+                digest.update(column.encode())
+                digest.update(pd.util.hash_array(np.asarray(values, dtype=object)).tobytes())
+            self._key = digest.hexdigest()
+
+        return self._key
+
+    def main_gender_labels(self):
+        return np.array(GENDERS, dtype=object)[self.main_genders]
+
+    def spouse_gender_labels(self):
+        '''
+            spouse genders, None for units without a spouse.
+        '''
+        return np.where(self.has_spouse, np.array(GENDERS + (None,), dtype=object)[self.spouse_genders], None)
+
+    def without_column(self, column):
+        '''
+            the same model points without one of the optional parameter columns.
+        '''
+        parameter_columns = {name: values for name, values in self.parameter_columns.items() if name != column}
+
+        return ModelPoints(self.ids, self.main_ages, self.main_genders, self.spouse_ages, self.spouse_genders, self.has_spouse, parameter_columns)
+
+    def to_frame(self):
+        '''
+            the units as a DataFrame with the columns of units.csv, blanks as NaN.
+        '''
+        frame = pd.DataFrame({
+            'ID': self.ids,
+            'Main Member Age': self.main_ages.astype(np.int64),
+            'Main Member Gender': self.main_gender_labels(),
+            'Spouse Age': self.spouse_ages.astype(np.int64) if self.has_spouse.all() else np.where(self.has_spouse, self.spouse_ages, np.nan),
+            'Spouse Gender': np.where(self.has_spouse, self.spouse_gender_labels(), np.nan),
+        })
+        for column, values in self.parameter_columns.items():
+            frame[column] = np.where(pd.isna(values), np.nan, values) if values.dtype == object else values
+
+        return frame
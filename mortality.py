@@ -0,0 +1,450 @@
+'''
+    Mortality table helpers shared by the model engines.
+
+    Besides the annual tables, a monthly layer gives the probability of surviving
+    every number of months from every age of a table, with the longevity loading
+    applied to the mortality rates and survival within each year of age following
+    one of the fractional age assumptions in FRACTIONAL_ASSUMPTIONS.
+
+    Tables are found by file name in the model directory (TABLE_DIRECTORY, the
+    directory of this module, whatever the working directory):
+
+        mortality_table_<label>.csv        period table, rates by age
+        mortality_cohort_<label>.csv       generational table, rates by age and calendar year
+        mortality_improvement_<label>.csv  improvement scale, annual rate reductions by age and calendar year
+
+    Generational tables and period tables projected with an improvement scale are
+    GenerationalTable objects. Every function taking mortality_tables accepts one
+    in place of a period table DataFrame: each unit is then valued with the
+    cohort diagonal of its birth year, see table_for_age.
+'''
+import glob
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+
+GENDER_COLUMNS = {
+    'Male': 'MaleMortality_qx',
+    'Female': 'FemaleMortality_qx',
+}
+
+# survival within a year of age: uniform distribution of deaths, constant force of mortality or Balducci
+FRACTIONAL_ASSUMPTIONS = ('udd', 'constant_force', 'balducci')
+
+IMPROVEMENT_COLUMNS = {
+    'Male': 'MaleImprovement',
+    'Female': 'FemaleImprovement',
+}
+
+# directory the tables are read from unless another is given
+TABLE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# file name prefix of each kind of table
+TABLE_PREFIXES = {
+    'period': 'mortality_table_',
+    'generational': 'mortality_cohort_',
+    'improvement': 'mortality_improvement_',
+}
+
+
+def table_labels(kind='period', directory=TABLE_DIRECTORY):
+    '''
+        labels of the tables of a kind ('period', 'generational' or 'improvement') in a directory, e.g. the
+        <label> of every mortality_table_<label>.csv for period tables.
+    '''
+    prefix = TABLE_PREFIXES[kind]
+    paths = glob.glob(os.path.join(directory, f'{prefix}*.csv'))
+
+    return sorted(os.path.basename(path)[len(prefix):-len('.csv')] for path in paths)
+
+
+def mortality_table_key(mortality_tables):
+    '''
+        hashable key identifying the contents of a mortality table DataFrame (or GenerationalTable).
+    '''
+    if isinstance(mortality_tables, GenerationalTable):
+        return mortality_tables.key
+
+    digest = hashlib.sha1()
+    for column in ['Age'] + list(GENDER_COLUMNS.values()):
+        digest.update(mortality_tables[column].to_numpy(dtype=float).tobytes())
+
+    return digest.hexdigest()
+
+
+def read_mortality_table(path):
+    '''
+        parse a mortality table CSV into read only float arrays.
+
+        Some tables (e.g. SA8590) pad their rates with whitespace, which is stripped before conversion.
+    '''
+    frame = pd.read_csv(path, skipinitialspace=True)
+
+    columns = {'Age': frame['Age'].to_numpy(dtype=np.int64)}
+    for column in GENDER_COLUMNS.values():
+        values = frame[column]
+        if values.dtype == object:
+            values = values.str.strip()
+        columns[column] = pd.to_numeric(values).to_numpy(dtype=float)
+
+    for values in columns.values():
+        values.flags.writeable = False
+
+    return columns
+
+
+def load_mortality_table(label, directory=TABLE_DIRECTORY):
+    '''
+        mortality table DataFrame for a table label, e.g. 'SAIFL98_SAIML98', cached until the CSV changes.
+    '''
+    path = os.path.join(directory, f'mortality_table_{label}.csv')
+    columns = cache.cached_file('mortality_table', path, read_mortality_table)
+
+    return pd.DataFrame({column: values.copy() for column, values in columns.items()})
+
+
+def read_age_year_table(path, columns, fill_value=np.nan, dtype=np.float64):
+    '''
+        parse a long format CSV with 'Age' and 'Year' columns into read only (ages x years) arrays, one per gender.
+
+        Parameters:
+        columns (dict): gender -> column of the rates, e.g. GENDER_COLUMNS or IMPROVEMENT_COLUMNS.
+        fill_value (float): rate of ages and years between the first and last that are not in the file.
+        dtype: float type of the arrays, np.float32 halves their size.
+
+        Returns:
+        dict: 'ages' and 'years' (consecutive), and 'rates' with an array per gender.
+    '''
+    frame = pd.read_csv(path, skipinitialspace=True)
+
+    ages = np.arange(frame['Age'].min(), frame['Age'].max() + 1)
+    years = np.arange(frame['Year'].min(), frame['Year'].max() + 1)
+    index = pd.MultiIndex.from_arrays([frame['Age'].to_numpy(dtype=np.int64), frame['Year'].to_numpy(dtype=np.int64)])
+
+    rates = {}
+    for gender, column in columns.items():
+        values = frame[column]
+        if values.dtype == object:
+            values = values.str.strip()
+        grid = pd.Series(pd.to_numeric(values).to_numpy(dtype=float), index=index).unstack().reindex(index=ages, columns=years)
+        rates[gender] = grid.fillna(fill_value).to_numpy(dtype=dtype)
+        rates[gender].flags.writeable = False
+
+    return {'ages': ages, 'years': years, 'rates': rates}
+
+
+def load_generational_table(label, valuation_year, directory=TABLE_DIRECTORY, dtype=np.float64):
+    '''
+        GenerationalTable of a mortality_cohort_<label>.csv for a valuation year, cached until the CSV changes.
+    '''
+    path = os.path.join(directory, f'{TABLE_PREFIXES["generational"]}{label}.csv')
+    key = ('generational_table', cache.file_key(path), valuation_year, np.dtype(dtype).name)
+
+    def build():
+        table = cache.cached_file(f'generational_rates_{np.dtype(dtype).name}', path, lambda path: read_age_year_table(path, GENDER_COLUMNS, dtype=dtype))
+        if np.isnan([rates.sum() for rates in table['rates'].values()]).any():
+            raise ValueError(f'{path} does not have a rate for every age and year between the first and last')
+        return GenerationalTable(table['ages'], table['years'], table['rates'], valuation_year)
+
+    return cache.shared.get(key, build)
+
+
+def load_improved_table(label, improvement_label, base_year, valuation_year, directory=TABLE_DIRECTORY, dtype=np.float64):
+    '''
+        GenerationalTable of the period table mortality_table_<label>.csv, taken to be the rates of base_year,
+        projected with the improvement scale mortality_improvement_<improvement_label>.csv, cached until either CSV changes.
+    '''
+    path = os.path.join(directory, f'{TABLE_PREFIXES["period"]}{label}.csv')
+    improvement_path = os.path.join(directory, f'{TABLE_PREFIXES["improvement"]}{improvement_label}.csv')
+    key = ('improved_table', cache.file_key(path), cache.file_key(improvement_path), base_year, valuation_year, np.dtype(dtype).name)
+
+    def build():
+        improvement = cache.cached_file('improvement_scale', improvement_path, lambda path: read_age_year_table(path, IMPROVEMENT_COLUMNS, fill_value=0.0))
+        return GenerationalTable.from_improvement(load_mortality_table(label, directory), improvement, base_year, valuation_year, dtype)
+
+    return cache.shared.get(key, build)
+
+
+def table_for_age(mortality_tables, age):
+    '''
+        period table DataFrame for a life of an age in the valuation year: the table itself, or the cohort diagonal
+        of the life's birth year for a GenerationalTable.
+    '''
+    if isinstance(mortality_tables, GenerationalTable):
+        return mortality_tables.cohort_table(mortality_tables.valuation_year - int(age))
+
+    return mortality_tables
+
+
+class GenerationalTable:
+    '''
+        mortality rates by age and calendar year, for a valuation year.
+
+        A life aged x in the valuation year was born in valuation_year - x, and at age x + t in year
+        valuation_year + t is subject to the rate of that age and year. These rates, the diagonal of the table for the
+        life's birth year, form a period table for that cohort, which is built once per birth year and reused for
+        every unit of that cohort. Years outside the table use its first or last year.
+
+        Attributes:
+        ages, years (np.ndarray): consecutive ages and calendar years of the table.
+        rates (dict): gender -> (ages x years) mortality rates.
+        valuation_year (int): calendar year of the units' ages.
+        key (str): hash of the contents and valuation year, see mortality_table_key.
+    '''
+
+    def __init__(self, ages, years, rates, valuation_year):
+        self.ages = np.asarray(ages, dtype=np.int64)
+        self.years = np.asarray(years, dtype=np.int64)
+        self.rates = rates
+        self.valuation_year = int(valuation_year)
+
+        digest = hashlib.sha1()
+        for values in [self.ages, self.years] + [rates[gender] for gender in GENDER_COLUMNS]:
+            digest.update(np.ascontiguousarray(values).tobytes())
+        digest.update(str(self.valuation_year).encode())
+        self.key = digest.hexdigest()
+
+        self.cohorts = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_improvement(cls, mortality_tables, improvement, base_year, valuation_year, dtype=np.float64):
+        '''
+            project a period table of base_year rates with an improvement scale.
+
+            The rate of age x in year t > base_year is qx * (1 - improvement(x, base_year + 1)) * ... * (1 - improvement(x, t)).
+            Ages and years outside the scale use its nearest age and year, so its last year's improvement continues.
+
+            Parameters:
+            mortality_tables (pd.DataFrame): period table.
+            improvement (dict): improvement scale as from read_age_year_table.
+        '''
+        ages = mortality_tables['Age'].to_numpy(dtype=np.int64)
+        # every year from the base year (or an earlier valuation year) to the year the youngest life reaches the oldest age
+        years = np.arange(min(base_year, valuation_year), valuation_year + ages.max() - ages.min() + 1)
+
+        age_positions = np.clip(ages - improvement['ages'][0], 0, len(improvement['ages']) - 1)
+        year_positions = np.clip(years - improvement['years'][0], 0, len(improvement['years']) - 1)
+
+        rates = {}
+        for gender, column in GENDER_COLUMNS.items():
+            reductions = 1 - improvement['rates'][gender][np.ix_(age_positions, year_positions)].astype(float)
+            reductions[:, years <= base_year] = 1.0
+            qx = mortality_tables[column].to_numpy(dtype=float).reshape(-1, 1) * np.cumprod(reductions, axis=1)
+            rates[gender] = qx.astype(dtype)
+            rates[gender].flags.writeable = False
+
+        return cls(ages, years, rates, valuation_year)
+
+    def cohort_table(self, birth_year):
+        '''
+            period table DataFrame of the rates of a birth year's cohort at every age, in the dtype of the table's rates,
+            built once per birth year.
+        '''
+        birth_year = int(birth_year)
+        with self.lock:
+            if birth_year not in self.cohorts:
+                positions = np.clip(birth_year + self.ages - self.years[0], 0, len(self.years) - 1)
+                columns = {'Age': self.ages.copy()}
+                for gender, column in GENDER_COLUMNS.items():
+                    columns[column] = self.rates[gender][np.arange(len(self.ages)), positions]
+                self.cohorts[birth_year] = pd.DataFrame(columns)
+            return self.cohorts[birth_year]
+
+    def birth_years(self, ages):
+        return self.valuation_year - np.asarray(ages).astype(np.int64)
+
+    def to_frame(self):
+        '''
+            the rates as a long format DataFrame with 'Age', 'Year' and a rate column per gender.
+        '''
+        frame = pd.DataFrame({'Age': np.repeat(self.ages, len(self.years)), 'Year': np.tile(self.years, len(self.ages))})
+        for gender, column in GENDER_COLUMNS.items():
+            frame[column] = self.rates[gender].reshape(-1)
+
+        return frame
+
+    def __getstate__(self):
+        # the memoised cohorts and lock stay with this process
+        state = dict(vars(self), cohorts={})
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self.lock = threading.Lock()
+
+
+def monthly_survival_curve(mortality_tables, age, gender):
+    '''
+        probability of surviving each number of months from an age, assuming a constant force of mortality within each year of age.
+
+        Uses the table rows from the age onwards, the same as the life expectancy calculation, and ends at the last age of the table.
+
+        Returns:
+        np.ndarray: survival probabilities for 0, 1, ..., 12 * (years left in the table) months.
+    '''
+    def build():
+        table_ages = mortality_tables['Age'].to_numpy()
+        px = 1 - mortality_tables[GENDER_COLUMNS[gender]].to_numpy(dtype=float)[table_ages >= age]
+
+        start_of_year = np.concatenate([[1.0], np.cumprod(px)[:-1]])
+        fraction = np.arange(12) / 12
+        curve = np.concatenate([(start_of_year.reshape(-1, 1) * px.reshape(-1, 1) ** fraction).reshape(-1), np.cumprod(px)[-1:] if len(px) else [1.0]])
+        curve.flags.writeable = False
+        return curve
+
+    return cache.shared.get(('monthly_survival_curve', mortality_table_key(mortality_tables), age, gender), build)
+
+
+def life_expectancy_table(mortality_tables, gender, longevity_loading_pct):
+    '''
+        LifeExpectancyTable for a mortality table, gender and longevity loading, cached per table.
+    '''
+    key = ('life_expectancy_table', mortality_table_key(mortality_tables), gender, longevity_loading_pct)
+
+    return cache.shared.get(key, lambda: LifeExpectancyTable(mortality_tables, gender, longevity_loading_pct))
+
+
+class LifeExpectancyTable:
+    '''
+        curtate life expectancy in months from every age of a mortality table,
+        for one gender and longevity loading.
+
+        The expectation for each age in the table is computed once when the table
+        is built; lookups for any number of ages are then a single array gather.
+    '''
+
+    def __init__(self, mortality_tables, gender, longevity_loading_pct):
+        assert gender in GENDER_COLUMNS
+        assert 0 <= longevity_loading_pct <= 100
+
+        table_ages = mortality_tables['Age'].to_numpy()
+        px = 1 - mortality_tables[GENDER_COLUMNS[gender]].to_numpy(dtype=float)
+
+        self.gender = gender
+        self.longevity_loading_pct = longevity_loading_pct
+        self.ages = np.unique(table_ages)
+
+        # sum of the survival curve from each age, summed exactly as in the original per age calculation
+        # so that the month truncation below gives identical results. The extra 0 is for ages past the end of the table.
+        survival_sums = [np.cumprod(px[table_ages >= age]).sum() for age in self.ages] + [0.0]
+        life_expectancies = np.array(survival_sums) * (1 + longevity_loading_pct/100)
+
+        self.months = (life_expectancies * 12).astype(np.int64) # convert to months
+
+    def lookup(self, ages):
+        '''
+            life expectancy in months for an age or an array of ages.
+        '''
+        return self.months[np.searchsorted(self.ages, ages, side='left')]
+
+
+def loaded_rates(mortality_tables, gender, longevity_loading_pct):
+    '''
+        mortality rates of a gender reduced by the longevity loading, qx * (1 - longevity_loading_pct / 100).
+    '''
+    assert 0 <= longevity_loading_pct <= 100
+
+    return mortality_tables[GENDER_COLUMNS[gender]].to_numpy(dtype=float) * (1 - longevity_loading_pct/100)
+
+
+def fractional_survival(qx, fractions, assumption):
+    '''
+        probability of surviving a fraction of a year of age from the start of that year, given its mortality rate qx.
+
+        Parameters:
+        qx (np.ndarray): annual mortality rates.
+        fractions (np.ndarray): fractions of a year in [0, 1], broadcast against qx.
+        assumption (str): one of FRACTIONAL_ASSUMPTIONS.
+    '''
+    if assumption == 'udd':
+        return 1 - fractions * qx
+    if assumption == 'constant_force':
+        return (1 - qx) ** fractions
+    if assumption == 'balducci':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(fractions == 0, 1.0, (1 - qx) / (1 - (1 - fractions) * qx))
+
+    raise ValueError(f'Unknown fractional age assumption {assumption!r}, expected one of {FRACTIONAL_ASSUMPTIONS}')
+
+
+def monthly_survival_table(mortality_tables, gender, longevity_loading_pct, assumption):
+    '''
+        MonthlySurvivalTable for a mortality table, gender, longevity loading and fractional age assumption, cached per table.
+    '''
+    key = ('monthly_survival_table', mortality_table_key(mortality_tables), gender, longevity_loading_pct, assumption)
+
+    return cache.shared.get(key, lambda: MonthlySurvivalTable(mortality_tables, gender, longevity_loading_pct, assumption))
+
+
+class MonthlySurvivalTable:
+    '''
+        probability of surviving every number of months from every age of a mortality table, for one gender,
+        longevity loading (applied to the rates) and fractional age assumption.
+
+        The survival of all ages is computed at once, and the curtate life expectancy in months from every age
+        follows from it, so the table can be used wherever a LifeExpectancyTable is.
+
+        Attributes:
+        ages (np.ndarray): ages of the table.
+        survival (np.ndarray): (ages + 1 x 12 * ages + 1) survival for 0, 1, 2, ... months from each age, zero after
+            the end of the table. The last row is for ages past the end of the table.
+        months (np.ndarray): curtate life expectancy in months from each age, the sum of its monthly survival.
+    '''
+
+    def __init__(self, mortality_tables, gender, longevity_loading_pct, assumption):
+        assert gender in GENDER_COLUMNS
+        if assumption not in FRACTIONAL_ASSUMPTIONS:
+            raise ValueError(f'Unknown fractional age assumption {assumption!r}, expected one of {FRACTIONAL_ASSUMPTIONS}')
+
+        table_ages = mortality_tables['Age'].to_numpy()
+        qx = loaded_rates(mortality_tables, gender, longevity_loading_pct)
+
+        self.gender = gender
+        self.longevity_loading_pct = longevity_loading_pct
+        self.assumption = assumption
+        self.ages = np.unique(table_ages)
+
+        # rate of year k from the i-th age, certain death after the end of the table
+        start = np.searchsorted(table_ages, self.ages, side='left')
+        years = len(qx)
+        rows = start.reshape(-1, 1) + np.arange(years)
+        rates = np.vstack([np.where(rows < years, qx[np.minimum(rows, years - 1)], 1.0), np.ones(years)])
+
+        # survival to the start of each year of age, then within it
+        start_of_year = np.concatenate([np.ones((len(rates), 1)), np.cumprod(1 - rates, axis=1)], axis=1)
+        within_year = fractional_survival(rates.reshape(len(rates), years, 1), np.arange(12) / 12, assumption)
+        survival = np.concatenate([(start_of_year[:, :-1, np.newaxis] * within_year).reshape(len(rates), -1), start_of_year[:, -1:]], axis=1)
+
+        # nobody survives past the end of the table (the table's last age ends the curve, as in monthly_survival_curve)
+        table_months = 12 * (years - np.append(start, years))
+        survival[np.arange(survival.shape[1]) > table_months.reshape(-1, 1)] = 0.0
+
+        self.survival = survival
+        self.survival.flags.writeable = False
+        self.table_months = table_months
+        self.months = survival[:, 1:].sum(axis=1).astype(np.int64)
+
+    def position(self, ages):
+        return np.searchsorted(self.ages, ages, side='left')
+
+    def curve(self, age):
+        '''
+            survival for 0, 1, ..., 12 * (years left in the table) months from an age, as from monthly_survival_curve.
+        '''
+        position = self.position(age)
+
+        return self.survival[position, :self.table_months[position] + 1]
+
+    def lookup(self, ages):
+        '''
+            life expectancy in months for an age or an array of ages.
+        '''
+        return self.months[self.position(ages)]
@@ -0,0 +1,273 @@
+'''
+    Columnar store of the projected monthly cashflows of every unit.
+
+    The store holds the (units x months) expected cashflows of each leg as projected,
+    without copying them, and the discount factors shared by all units. A discounted
+    leg is only computed, as its expected leg times the discount factors, for the
+    units it is sliced for. So any unit or leg can be sliced without re-running the
+    projection or building Python lists, and rediscounting does not touch the store.
+    The store can be saved to an Arrow IPC file, which is read back memory mapped and
+    without copying, or to Parquet for exchange with other tools.
+
+    pyarrow is only needed to save and load stores.
+
+    UnitWorkings presents the per unit workings DataFrames as a read only mapping
+    over a store, building each unit's frame only when it is looked up.
+'''
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+
+# monthly legs held in the store, named as the columns of the unit workings
+LEGS = [
+    'Expected Sale Cashflows',
+    'Expected Fee Cashflows',
+    'Expected Expense Cashflows',
+    'Expected Refund Cashflows',
+    'All Expected Cashflows',
+    'Discounted Sale Cashflows',
+    'Discounted Fee Cashflows',
+    'Discounted Expense Cashflows',
+    'Discounted Refund Cashflows',
+    'All Discounted Cashflows',
+]
+
+# discounted legs of the store and the expected legs they discount
+DISCOUNTED_LEGS = {
+    'Discounted Sale Cashflows': 'Expected Sale Cashflows',
+    'Discounted Fee Cashflows': 'Expected Fee Cashflows',
+    'Discounted Expense Cashflows': 'Expected Expense Cashflows',
+    'Discounted Refund Cashflows': 'Expected Refund Cashflows',
+    'All Discounted Cashflows': 'All Expected Cashflows',
+}
+
+# legs held by the store, the others are discounted when sliced
+EXPECTED_LEGS = list(DISCOUNTED_LEGS.values())
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError('pyarrow is required to save and load results stores, install it with `pip install pyarrow`') from error
+
+    return pyarrow
+
+
+class ResultsStore:
+    '''
+        projected cashflows of every unit.
+
+        Attributes:
+        ids (np.ndarray): unit IDs.
+        legs (dict): (units x months) float64 expected cashflows keyed by the names in EXPECTED_LEGS.
+        counts (np.ndarray): (units x months) number of occupants started so far, -1 for months no longer projected.
+        discount_factors, inv_return_factors (np.ndarray): monthly factors shared by all units.
+        npvs (pd.DataFrame): present value of each cashflow leg per unit, one column per results NPV column.
+    '''
+
+    def __init__(self, ids, legs, counts, discount_factors, inv_return_factors, npvs):
+        self.ids = np.asarray(ids)
+        self.legs = {name: legs[name] for name in EXPECTED_LEGS}
+        self.counts = counts
+        self.discount_factors = np.asarray(discount_factors, dtype=float)
+        self.inv_return_factors = inv_return_factors
+        self.npvs = npvs if isinstance(npvs, pd.DataFrame) else pd.DataFrame(npvs)
+
+        self.index = None
+
+    @property
+    def months(self):
+        return self.counts.shape[1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, unit_id):
+        '''
+            row of a unit in the store.
+        '''
+        if self.index is None:
+            self.index = {key: position for position, key in enumerate(self.ids.tolist())}
+
+        return self.index[unit_id]
+
+    def leg(self, name, positions=None):
+        '''
+            (units x months) cashflows of one leg, for all units or the rows at positions. An expected leg is a view
+            of the projected cashflows, a discounted leg is computed for those rows.
+        '''
+        if name in self.legs:
+            values = self.legs[name]
+            return values if positions is None else values[positions]
+
+        values = self.legs[DISCOUNTED_LEGS[name]]
+        if positions is not None:
+            values = values[positions]
+
+        return values * self.discount_factors
+
+    def unit(self, unit_id):
+        '''
+            (months x legs) cashflows of one unit, legs in the order of LEGS.
+        '''
+        position = self.position(unit_id)
+
+        return np.stack([self.leg(name, position) for name in LEGS], axis=1)
+
+    @property
+    def values(self):
+        '''
+            (units x months x legs) array of every leg, legs in the order of LEGS. This builds all the discounted
+            legs in one more copy of the store, so it is only meant for exporting small stores; save writes the legs
+            without it.
+        '''
+        values = np.empty((len(self), self.months, len(LEGS)))
+        for index, name in enumerate(LEGS):
+            values[:, :, index] = self.leg(name)
+
+        return values
+
+    def unit_frame(self, unit_id):
+        '''
+            one unit's monthly cashflows as a DataFrame with a column per leg.
+        '''
+        frame = pd.DataFrame(self.unit(unit_id), columns=LEGS)
+        frame.insert(0, 'Month', np.arange(self.months))
+
+        return frame
+
+    def to_arrow(self):
+        '''
+            the store as a pyarrow Table with one row per unit.
+
+            Each expected leg and the counts are fixed size list columns over their (units x months) arrays, which are
+            only copied if they are not contiguous. The discounted legs are not written, they are computed again
+            from the discount factors, which are kept with the months and legs in the schema metadata.
+        '''
+        pa = import_pyarrow()
+
+        def monthly(values, dtype):
+            return pa.FixedSizeListArray.from_arrays(pa.array(np.ascontiguousarray(values, dtype=dtype).reshape(-1)), self.months)
+
+        columns = {'ID': pa.array(self.ids.tolist())}
+        for name in EXPECTED_LEGS:
+            columns[name] = monthly(self.legs[name], float)
+        columns['counts'] = monthly(self.counts, np.int64)
+        for column in self.npvs.columns:
+            columns[column] = pa.array(self.npvs[column].to_numpy(dtype=float))
+
+        metadata = {
+            'legs': '\n'.join(EXPECTED_LEGS),
+            'months': str(self.months),
+            'discount_factors': np.asarray(self.discount_factors, dtype=float).tobytes(),
+            'inv_return_factors': np.asarray(self.inv_return_factors, dtype=float).tobytes(),
+        }
+
+        return pa.table(columns, metadata=metadata)
+
+    def save(self, path):
+        '''
+            save to a Parquet file (.parquet) or otherwise an Arrow IPC file, which can be memory mapped by load.
+        '''
+        pa = import_pyarrow()
+
+        table = self.to_arrow()
+        if str(path).endswith('.parquet'):
+            pa.parquet.write_table(table, path)
+        else:
+            with pa.OSFile(str(path), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table, max_chunksize=max(len(self), 1))
+
+    @classmethod
+    def from_arrow(cls, table):
+        '''
+            store over the buffers of a pyarrow Table written by to_arrow, without copying the cashflows where possible.
+        '''
+        metadata = table.schema.metadata
+        legs = metadata[b'legs'].decode().split('\n')
+        if legs != EXPECTED_LEGS:
+            raise ValueError(f'Results store legs {legs} do not match {EXPECTED_LEGS}')
+        months = int(metadata[b'months'])
+
+        table = table.combine_chunks()
+
+        def monthly(column, dtype):
+            if not len(table):
+                return np.empty((0, months), dtype=dtype)
+            return table[column].chunk(0).flatten().to_numpy(zero_copy_only=False).reshape(len(table), months)
+
+        npvs = pd.DataFrame({column: table[column].to_numpy() for column in table.column_names if column not in ('ID', 'counts', *EXPECTED_LEGS)})
+
+        return cls(
+            np.array(table['ID'].to_pylist(), dtype=object),
+            {name: monthly(name, float) for name in EXPECTED_LEGS},
+            monthly('counts', np.int64),
+            np.frombuffer(metadata[b'discount_factors'], dtype=float),
+            np.frombuffer(metadata[b'inv_return_factors'], dtype=float),
+            npvs,
+        )
+
+    @classmethod
+    def load(cls, path):
+        '''
+            load a store saved with save.
+
+            Arrow IPC files are memory mapped, so the cashflows are read only views over the file and pages are only
+            read when they are sliced. Parquet files are decoded into memory.
+        '''
+        pa = import_pyarrow()
+
+        if str(path).endswith('.parquet'):
+            table = pa.parquet.read_table(path, memory_map=True)
+        else:
+            table = pa.ipc.open_file(pa.memory_map(str(path), 'r')).read_all()
+
+        return cls.from_arrow(table)
+
+
+class UnitWorkings(Mapping):
+    '''
+        mapping of unit ID to the workings DataFrame of that unit, built from a results store on first access.
+
+        Only the max_frames most recently used frames are kept, so iterating over the workings of a large
+        portfolio (e.g. to write them to Excel) holds one unit's workings at a time rather than all of them.
+
+        Parameters:
+        store (ResultsStore): cashflows of every unit.
+        build (callable): build(store, unit_id) returns the workings DataFrame of a unit.
+        max_frames (int): number of built frames to keep.
+    '''
+
+    def __init__(self, store, build, max_frames=64):
+        self.store = store
+        self.build = build
+        self.frames = cache.LRUCache(max_entries=max_frames)
+
+        # unit IDs in order of first appearance, a repeated ID maps to its last row as store.position does
+        self.ids = list(dict.fromkeys(store.ids.tolist()))
+
+    def __getitem__(self, unit_id):
+        # raises KeyError for unknown units before anything is built
+        self.store.position(unit_id)
+
+        return self.frames.get(unit_id, lambda: self.build(self.store, unit_id))
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, unit_id):
+        try:
+            self.store.position(unit_id)
+        except (KeyError, TypeError):
+            return False
+        return True
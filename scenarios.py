@@ -0,0 +1,189 @@
+'''
+    Valuation of every unit under many economic scenarios.
+
+    Instead of the flat discount_rate and investment_return, each scenario can have
+    a discount curve of monthly spot rates and a path of monthly property investment
+    returns, e.g. stressed curves or simulated property returns. Rates are annual %
+    compounded monthly, like discount_rate and investment_return, so a flat curve
+    gives the same factors as the flat rate:
+
+    - the discount factor of month m is 1 / (1 + spot rate of month m/1200) ** m
+    - the accumulation factor of month m is the product of (1 + return of month k/1200) for k < m
+
+    Curves are read from a CSV with a 'Month' column (0, 1, 2, ...) and one column
+    of rates per scenario, or given as a (scenarios x months) array.
+
+    All scenarios share one exit schedule and one set of cashflow legs. Without
+    investment return paths only the discounting depends on the scenario. Then the
+    present values of all scenarios are one matrix product of the legs with the
+    (months x scenarios) discount factors. The fee and expense use the cumulative
+    discount factors of each scenario. With investment return paths the sale and
+    refund depend on the scenario too. As they are only paid in the start and exit
+    months of each occupancy, only those payments are grown and discounted, for a
+    chunk of scenarios at a time so that at most max_bytes of (scenarios x
+    payments) arrays are held at once.
+'''
+import numpy as np
+import pandas as pd
+
+import cache
+import engine
+
+
+def parse_curves(path):
+    return curves_from_frame(pd.read_csv(path))
+
+
+def read_curves(path):
+    '''
+        (scenario names, (scenarios x months) rates) from a curves CSV, cached until the file changes.
+    '''
+    return cache.cached_file('curves', path, parse_curves)
+
+
+def curves_from_frame(frame):
+    '''
+        (scenario names, (scenarios x months) rates) from a DataFrame with a 'Month' column and a column per scenario.
+    '''
+    if 'Month' not in frame:
+        raise ValueError(f"Curves need a 'Month' column, got columns {list(frame.columns)}")
+
+    frame = frame.sort_values('Month')
+    if not np.array_equal(frame['Month'].to_numpy(), np.arange(len(frame))):
+        raise ValueError('Curves need a row for every month from month 0')
+
+    names = [column for column in frame.columns if column != 'Month']
+    rates = frame[names].to_numpy(dtype=float).T
+    rates.flags.writeable = False
+
+    return names, rates
+
+
+def as_curves(curves, months, description='Curves'):
+    '''
+        (scenario names, (scenarios x months) rates) for the first months of curves given as a CSV path, a DataFrame
+        (see curves_from_frame), a (scenarios x months) array or a single curve. Array scenarios are numbered from 0.
+    '''
+    if isinstance(curves, str):
+        names, rates = read_curves(curves)
+    elif isinstance(curves, pd.DataFrame):
+        names, rates = curves_from_frame(curves)
+    else:
+        rates = np.atleast_2d(np.asarray(curves, dtype=float))
+        names = list(range(len(rates)))
+
+    if rates.ndim != 2 or rates.shape[1] < months:
+        raise ValueError(f'{description} need at least the {months} months of the projection, got shape {rates.shape}')
+
+    return names, rates[:, :months]
+
+
+def discount_factors(spot_rates):
+    '''
+        (scenarios x months) discount factors for (scenarios x months) annual spot rates (in %).
+    '''
+    spot_rates = np.atleast_2d(spot_rates)
+
+    return 1/(1 + spot_rates/(100*12)) ** np.arange(spot_rates.shape[1])
+
+
+def accumulation_factors(return_rates):
+    '''
+        (scenarios x months) accumulation factors for (scenarios x months) annual investment returns (in %), 1 in month 0.
+    '''
+    return_rates = np.atleast_2d(return_rates)
+    growth = np.cumprod(1 + return_rates[:, :-1]/(100*12), axis=1)
+
+    return np.concatenate([np.ones((len(return_rates), 1)), growth], axis=1)
+
+
+def scenario_count(*factors):
+    '''
+        number of scenarios of factors with one row per scenario, where a single row applies to every scenario.
+    '''
+    counts = {len(values) for values in factors if values is not None} - {1}
+    if len(counts) > 1:
+        raise ValueError(f'Scenario curves have different numbers of scenarios: {sorted(counts)}')
+
+    return counts.pop() if counts else 1
+
+
+def event_present_values(mask, amounts, previous_exit, replaced, discount_factors, accumulation_factors, max_bytes):
+    '''
+        (scenarios x units) present value of the per unit amounts paid in the months of a (units x months) mask, grown
+        with the accumulation factors to the previous exit for replacement occupants.
+
+        Only the months of the mask are evaluated, a chunk of scenarios at a time with at most max_bytes of
+        (scenarios x payments) arrays.
+    '''
+    scenarios = len(discount_factors)
+    values = np.zeros((scenarios, mask.shape[0]))
+
+    # payments in unit order, as np.nonzero returns them
+    rows, months = np.nonzero(mask)
+    if not len(rows):
+        return values
+    growth_months = previous_exit[rows, months]
+    grown = replaced[rows, months]
+    amounts = amounts[rows]
+    paying_units, first_payments = np.unique(rows, return_index=True)
+
+    chunk_size = max(1, max_bytes // (3 * 8 * len(rows)))
+    for start in range(0, scenarios, chunk_size):
+        stop = min(start + chunk_size, scenarios)
+        growth = np.where(grown, accumulation_factors[start:stop][:, growth_months], 1.0)
+        payments = amounts * growth * discount_factors[start:stop][:, months]
+        values[start:stop, paying_units] = np.add.reduceat(payments, first_payments, axis=1)
+
+    return values
+
+
+def present_values(schedule, legs, last_life_expectancies, occupied, parameters, discount_factors, accumulation_factors=None, refund_on_resale_pct=0, refund_on_resale_duration=0, max_bytes=2**28):
+    '''
+        present value of each cashflow leg of every unit in every scenario.
+
+        Parameters:
+        schedule, legs: exit schedule and cashflow legs of one projection, see Model.project.
+        last_life_expectancies (np.ndarray): months until exit of each unit.
+        occupied (np.ndarray): projected months of each unit, see engine.occupied_months.
+        parameters (dict): per unit package and pricing parameters, see model.unit_parameters.
+        discount_factors (np.ndarray): (scenarios x months) discount factors.
+        accumulation_factors (np.ndarray): (scenarios x months) investment return accumulation factors, or None to
+            keep the sale and refund legs of the projection.
+        max_bytes (int): bound on the memory of the per scenario payments evaluated at once with accumulation_factors.
+
+        Returns:
+        dict: (scenarios x units) present values for each leg in engine.LEGS and their 'total'.
+    '''
+    scenarios = scenario_count(discount_factors, accumulation_factors)
+    discount_factors = np.broadcast_to(discount_factors, (scenarios, discount_factors.shape[1]))
+    units = len(occupied)
+
+    # present value of a level amount for each number of occupied months, per scenario
+    annuity = np.concatenate([np.zeros((scenarios, 1)), np.cumsum(discount_factors, axis=1)], axis=1)
+
+    values = {
+        'fee': np.asarray(parameters['monthly_fee'], dtype=float) * annuity[:, occupied],
+        'expense': (0 - np.asarray(parameters['monthly_expense'], dtype=float)) * annuity[:, occupied],
+    }
+
+    if accumulation_factors is None:
+        values['sale'] = (legs['sale'] @ discount_factors.T).T
+        values['refund'] = (legs['refund'] @ discount_factors.T).T
+    else:
+        # the sale and refund are paid in a few months of each occupancy, at the price grown along each path
+        accumulation_factors = np.broadcast_to(accumulation_factors, (scenarios, accumulation_factors.shape[1]))
+        is_life_rights = engine.life_rights(parameters['package'])
+        purchase_price = np.broadcast_to(np.asarray(parameters['purchase_price_input'], dtype=float), (units,))
+        refund = 0 - purchase_price * (np.broadcast_to(np.asarray(refund_on_resale_pct, dtype=float), (units,))/100)
+        previous_exit = engine.previous_exits(schedule, last_life_expectancies)
+        replaced = schedule['generation'] > 0
+
+        sales = schedule['start'] & is_life_rights
+        refunds = engine.refundable(schedule, last_life_expectancies, refund_on_resale_duration) & is_life_rights
+        values['sale'] = event_present_values(sales, purchase_price, previous_exit, replaced, discount_factors, accumulation_factors, max_bytes)
+        values['refund'] = event_present_values(refunds, refund, previous_exit, replaced, discount_factors, accumulation_factors, max_bytes)
+
+    values['total'] = engine.total_cashflows(values['sale'], values['fee'], values['expense'], values['refund'])
+
+    return values
@@ -0,0 +1,245 @@
+'''
+    Stochastic (Monte Carlo) projection of unit cashflows.
+
+    Instead of exiting every unit at its life expectancy, the month of death of the
+    main member (and spouse for Double units) is sampled from the monthly survival
+    curve of the mortality table, and the unit exits when the last member dies.
+    With replacement, each new occupant is the same age and gender as the original
+    occupant and their lifetime is sampled again.
+
+    Paths are simulated in chunks and only the present value of each leg is kept
+    per path, so memory depends on the chunk size and not on the number of paths or
+    projection months. The NPV distribution of each unit is accumulated across
+    chunks in a StreamingHistogram.
+'''
+import numpy as np
+import pandas as pd
+
+import engine
+import model_points
+import mortality
+
+
+class StreamingHistogram:
+    '''
+        histogram of a stream of values with a fixed number of bins, for approximate percentiles.
+
+        The range starts at the range of the first values added and is doubled (merging pairs of bins)
+        whenever later values fall outside it, so counts are never lost and percentiles are accurate to
+        within one bin width.
+    '''
+
+    def __init__(self, bins=4096):
+        assert bins % 2 == 0
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.low = None
+        self.high = None
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        if self.low is None:
+            self.low = self.min
+            self.high = self.max if self.max > self.min else self.min + 1.0
+
+        while self.max >= self.high or self.min < self.low:
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            width = self.high - self.low
+            if self.max >= self.high:
+                self.counts = np.concatenate([merged, np.zeros(self.bins // 2, dtype=np.int64)])
+                self.high = self.low + 2 * width
+            else:
+                self.counts = np.concatenate([np.zeros(self.bins // 2, dtype=np.int64), merged])
+                self.low = self.high - 2 * width
+
+        index = ((values - self.low) / (self.high - self.low) * self.bins).astype(np.int64)
+        self.counts += np.bincount(np.clip(index, 0, self.bins - 1), minlength=self.bins)
+
+    def percentile(self, q):
+        '''
+            q-th percentile (0-100), interpolated within the bin that contains it.
+        '''
+        total = self.counts.sum()
+        if total == 0:
+            return np.nan
+
+        cumulative = np.cumsum(self.counts)
+        target = q / 100 * total
+        index = min(int(np.searchsorted(cumulative, target, side='left')), self.bins - 1)
+        below = cumulative[index - 1] if index > 0 else 0
+        fraction = (target - below) / self.counts[index] if self.counts[index] else 0.0
+
+        width = (self.high - self.low) / self.bins
+        value = self.low + (index + fraction) * width
+
+        return float(np.clip(value, self.min, self.max))
+
+
+def sample_lifetimes(generator, survival_curve, size):
+    '''
+        sample complete months lived from a monthly survival curve by inversion.
+
+        Lives surviving to the end of the curve are taken to die at the end of the table.
+    '''
+    uniforms = generator.random(size)
+
+    # number of months m >= 1 with survival_curve[m] > u
+    return np.searchsorted(-survival_curve[1:], -uniforms, side='left')
+
+
+def sample_exit_months(generator, main_curve, spouse_curve, longevity_loading_pct, size):
+    '''
+        months until the last member of each path dies, with lifetimes stretched by the longevity loading
+        in the same way as the deterministic life expectancies.
+    '''
+    loading = 1 + longevity_loading_pct/100
+
+    exits = (sample_lifetimes(generator, main_curve, size) * loading).astype(np.int64)
+    if spouse_curve is not None:
+        exits = np.maximum(exits, (sample_lifetimes(generator, spouse_curve, size) * loading).astype(np.int64))
+
+    return exits
+
+
+def simulate_present_values(generator, paths, main_curve, spouse_curve, longevity_loading_pct, discount_factors, inv_return_factors, replacement, package, purchase_price, monthly_fee, monthly_expense, refund_on_resale_pct, refund_on_resale_duration):
+    '''
+        present value of each cashflow leg for a chunk of simulated paths of one unit.
+
+        Cashflows follow the same rules as the projection of engine.py, with the exit month sampled per path.
+
+        Returns:
+        dict: arrays of per path present values for each leg in engine.LEGS.
+    '''
+    months = len(discount_factors)
+    present_values = {leg: np.zeros(paths) for leg in engine.LEGS}
+    if months == 0:
+        return present_values
+
+    # cumulative discount factors, so that the present value of a level monthly amount is a difference
+    annuity = np.concatenate([[0.0], np.cumsum(discount_factors)])
+
+    start = np.zeros(paths, dtype=np.int64)
+    price = np.full(paths, float(purchase_price))
+    active = np.ones(paths, dtype=bool)
+
+    while active.any():
+        life = sample_exit_months(generator, main_curve, spouse_curve, longevity_loading_pct, paths)
+        exit = start + life
+        last_month = np.minimum(exit, months - 1)
+        first_month = np.minimum(start, months - 1)
+
+        occupied = np.where(active, annuity[last_month + 1] - annuity[first_month], 0.0)
+        present_values['fee'] += monthly_fee * occupied
+        present_values['expense'] -= monthly_expense * occupied
+
+        if package == 'Life Rights':
+            present_values['sale'] += np.where(active, price * discount_factors[first_month], 0.0)
+
+            refundable = active & (exit < months) & (life < refund_on_resale_duration * 12)
+            present_values['refund'] -= np.where(refundable, price * (refund_on_resale_pct/100) * discount_factors[np.minimum(exit, months - 1)], 0.0)
+
+        if not replacement:
+            break
+
+        price = np.where(exit < months, purchase_price * inv_return_factors[np.minimum(exit, months - 1)], price)
+        start = exit + 1
+        active = active & (start < months)
+
+    return present_values
+
+
+def simulate(units, mortality_tables, longevity_loading_pct, discount_rate, investment_term, investment_return, refund_on_resale_pct, replacement, refund_on_resale_duration, single_double, package, purchase_price_input, monthly_fee, monthly_expense, fractional_assumption=None, paths=100000, seed=None, chunk_size=65536, percentiles=(1, 5, 25, 50, 75, 95, 99), var_levels=(95, 99), bins=4096):
+    '''
+        simulate the NPV distribution of every unit.
+
+        Parameters are the same as for Model.main, with units as model_points.ModelPoints (single_double, package,
+        purchase_price_input, monthly_fee and monthly_expense may also be arrays with a value per unit), plus:
+        fractional_assumption (str): sample lifetimes from the loaded rates of mortality.MonthlySurvivalTable instead
+            of stretching them by the longevity loading.
+        paths (int): number of simulated paths per unit.
+        seed (int): seed for the random generator; each unit gets its own stream spawned from it, so results
+            are reproducible for a given seed and chunk_size.
+        chunk_size (int): number of paths simulated at a time, which bounds memory.
+        percentiles (tuple): NPV percentiles to report.
+        var_levels (tuple): confidence levels (%) for the value at risk, reported as the expected NPV less
+            the (100 - level)th percentile of the NPV.
+        bins (int): number of histogram bins used for the percentiles.
+
+        Returns:
+        pd.DataFrame: one row per unit with the mean of each NPV component, the NPV standard deviation,
+        percentiles and value at risk.
+    '''
+    model_points.check_spouses(units, single_double)
+
+    months = investment_term * 12
+    discount_factors = engine.discount_factors(discount_rate, months)
+    inv_return_factors = engine.investment_return_factors(investment_return, months)
+    if fractional_assumption is None:
+        def survival_curve(age, gender):
+            return mortality.monthly_survival_curve(mortality.table_for_age(mortality_tables, age), age, gender)
+    else:
+        def survival_curve(age, gender):
+            return mortality.monthly_survival_table(mortality.table_for_age(mortality_tables, age), gender, longevity_loading_pct, fractional_assumption).curve(age)
+
+    # lifetimes are stretched by the loading unless it is already in the rates
+    stretch_loading_pct = longevity_loading_pct if fractional_assumption is None else 0
+
+    generators = [np.random.default_rng(stream) for stream in np.random.SeedSequence(seed).spawn(len(units))]
+
+    unit_parameters = [np.broadcast_to(values, len(units)) for values in (single_double, package, purchase_price_input, monthly_fee, monthly_expense)]
+
+    rows = []
+    for generator, main_age, main_gender, spouse_age, spouse_gender, single_double, package, purchase_price_input, monthly_fee, monthly_expense in zip(generators, units.main_ages.tolist(), units.main_gender_labels(), units.spouse_ages.tolist(), units.spouse_gender_labels(), *unit_parameters):
+        main_curve = survival_curve(main_age, main_gender)
+        spouse_curve = None
+        if single_double == 'Double':
+            spouse_curve = survival_curve(spouse_age, spouse_gender)
+
+        sums = {leg: 0.0 for leg in engine.LEGS}
+        count, mean, m2 = 0, 0.0, 0.0
+        histogram = StreamingHistogram(bins)
+
+        for chunk_start in range(0, paths, chunk_size):
+            size = min(chunk_size, paths - chunk_start)
+            present_values = simulate_present_values(generator, size, main_curve, spouse_curve, stretch_loading_pct, discount_factors, inv_return_factors, replacement, package, purchase_price_input, monthly_fee, monthly_expense, refund_on_resale_pct, refund_on_resale_duration)
+            npvs = engine.total_cashflows(present_values['sale'], present_values['fee'], present_values['expense'], present_values['refund'])
+
+            for leg in engine.LEGS:
+                sums[leg] += present_values[leg].sum()
+
+            # combine the running mean and sum of squared deviations with this chunk's (Chan et al.)
+            chunk_mean = npvs.mean()
+            chunk_m2 = ((npvs - chunk_mean) ** 2).sum()
+            delta = chunk_mean - mean
+            mean += delta * size / (count + size)
+            m2 += chunk_m2 + delta ** 2 * count * size / (count + size)
+            count += size
+
+            histogram.add(npvs)
+
+        row = {
+            'Mean NPV': mean,
+            'Mean Purchase NPV': sums['sale'] / paths,
+            'Mean Refund NPV': sums['refund'] / paths,
+            'Mean Fee NPV': sums['fee'] / paths,
+            'Mean Expense NPV': sums['expense'] / paths,
+            'Std NPV': np.sqrt(m2 / (count - 1)) if count > 1 else 0.0,
+        }
+        for q in percentiles:
+            row[f'P{q} NPV'] = histogram.percentile(q)
+        for level in var_levels:
+            row[f'VaR {level}%'] = mean - histogram.percentile(100 - level)
+
+        rows.append(row)
+
+    results = pd.DataFrame(rows, columns=['Mean NPV', 'Mean Purchase NPV', 'Mean Refund NPV', 'Mean Fee NPV', 'Mean Expense NPV', 'Std NPV'] + [f'P{q} NPV' for q in percentiles] + [f'VaR {level}%' for level in var_levels])
+    results.insert(0, 'ID', units.ids)
+
+    return results
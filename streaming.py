@@ -0,0 +1,218 @@
+'''
+    Streaming valuation of units files too large to hold in memory.
+
+    Model.main keeps the monthly cashflows (and workings) of every unit. For
+    portfolio extracts of millions of units, Model.stream instead reads the units CSV
+    chunk_size rows at a time, projects each chunk with the batched engine and
+    reduces it into PortfolioAggregates:
+
+    - the number of units and the total of each NPV component
+    - the total expected and discounted cashflows of each leg per projection year
+    - the distributions of main member, spouse and last life expectancies in whole years
+
+    A chunk's cashflows are dropped once they are reduced, so peak memory depends on
+    chunk_size and the projection term, not on the number of units. The life
+    expectancies and NPVs of every unit can also be written out chunk by chunk, to a
+    .csv or .parquet file with a SummaryWriter.
+
+        aggregates = model.stream('units.csv', mortality_tables, chunk_size=10000, summary_path='npvs.parquet', **parameters)
+        aggregates.yearly_cashflows()
+
+    pyarrow is only needed for .parquet summaries.
+'''
+import numpy as np
+import pandas as pd
+
+import model_points
+import results_store
+
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# projected legs and the results store columns of their expected cashflows
+EXPECTED_LEGS = {
+    'sale': 'Expected Sale Cashflows',
+    'fee': 'Expected Fee Cashflows',
+    'expense': 'Expected Expense Cashflows',
+    'refund': 'Expected Refund Cashflows',
+    'total': 'All Expected Cashflows',
+}
+
+LIFE_EXPECTANCIES = {
+    'main': 'Main Member',
+    'spouse': 'Spouse',
+    'last': 'Last',
+}
+
+
+def chunks(units, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+        model_points.ModelPoints of chunk_size units at a time from a units CSV path, or of each chunk of an iterable
+        of units DataFrames (or ModelPoints).
+    '''
+    if isinstance(units, str):
+        with pd.read_csv(units, chunksize=chunk_size) as reader:
+            for frame in reader:
+                yield model_points.ModelPoints.from_frame(frame)
+    else:
+        for frame in units:
+            yield model_points.ModelPoints.coerce(frame)
+
+
+def summary_table(units, life_expectancies, npvs):
+    '''
+        life expectancies (in months) and NPV components of every unit of a chunk.
+
+        Genders are categorical and the spouse columns are always nullable, so every chunk has the same column types.
+    '''
+    summary = pd.DataFrame()
+    summary['ID'] = units.ids
+    summary['Main Member Age'] = units.main_ages
+    summary['Main Member Gender'] = pd.Categorical.from_codes(units.main_genders, model_points.GENDERS)
+    summary['Spouse Age'] = np.where(units.has_spouse, units.spouse_ages, np.nan)
+    summary['Spouse Gender'] = pd.Categorical.from_codes(np.where(units.has_spouse, units.spouse_genders, -1), model_points.GENDERS)
+    summary['Main Life Expectancy'] = life_expectancies['main']
+    summary['Spouse Life Expectancy'] = life_expectancies['spouse']
+    summary['Last Life Expectancy'] = life_expectancies['last']
+    for column, values in npvs.items():
+        summary[column] = values
+
+    return summary
+
+
+class PortfolioAggregates:
+    '''
+        running totals of the projections of a portfolio, added a chunk of units at a time.
+
+        Parameters:
+        months (int): projection term in months.
+        components (list): names of the NPV components, e.g. the results columns of model.NPV_COMPONENTS.
+
+        Attributes:
+        units (int): number of units added.
+        npv_totals (dict): total of each NPV component over the units.
+        cashflows (np.ndarray): (legs x months) total expected cashflows of each leg in EXPECTED_LEGS.
+        discount_factors (np.ndarray): monthly discount factors of the projections.
+        life_expectancy_counts (dict): number of units by whole years of each life expectancy in LIFE_EXPECTANCIES.
+    '''
+
+    def __init__(self, months, components):
+        self.months = months
+        self.units = 0
+        self.npv_totals = dict.fromkeys(components, 0.0)
+        self.cashflows = np.zeros((len(EXPECTED_LEGS), months))
+        self.discount_factors = None
+        self.life_expectancy_counts = {name: np.zeros(0, dtype=np.int64) for name in LIFE_EXPECTANCIES}
+
+    def add(self, life_expectancies, legs, npvs, discount_factors):
+        '''
+            add a chunk of projected units.
+
+            Parameters:
+            life_expectancies (dict): life expectancies in months of each unit, see Model.unit_life_expectancies.
+            legs (dict): (units x months) cashflows of each leg in EXPECTED_LEGS.
+            npvs (dict): NPV of each unit for each component.
+            discount_factors (np.ndarray): monthly discount factors, the same for every chunk.
+        '''
+        self.units += len(life_expectancies['last'])
+
+        for column, values in npvs.items():
+            self.npv_totals[column] += float(np.sum(values))
+
+        for index, leg in enumerate(EXPECTED_LEGS):
+            self.cashflows[index] += legs[leg].sum(axis=0)
+        self.discount_factors = np.asarray(discount_factors, dtype=float)
+
+        for name in LIFE_EXPECTANCIES:
+            values = np.asarray(life_expectancies[name], dtype=float)
+            years = (values[~np.isnan(values)] // 12).astype(np.int64)
+            counts = np.bincount(years, minlength=len(self.life_expectancy_counts[name]))
+            counts[:len(self.life_expectancy_counts[name])] += self.life_expectancy_counts[name]
+            self.life_expectancy_counts[name] = counts
+
+    def npv_summary(self):
+        '''
+            'Component', 'Total' and 'Mean' over the units of each NPV component.
+        '''
+        totals = pd.DataFrame({'Component': list(self.npv_totals), 'Total': list(self.npv_totals.values())})
+        totals['Mean'] = totals['Total'] / self.units if self.units else np.nan
+
+        return totals
+
+    def yearly_cashflows(self):
+        '''
+            total expected and discounted cashflows of each leg per projection year, named as the unit workings columns.
+        '''
+        yearly = pd.DataFrame({'Year': np.arange(1, self.months // 12 + 1)})
+        for index, column in enumerate(EXPECTED_LEGS.values()):
+            yearly[column] = self.cashflows[index].reshape(-1, 12).sum(axis=1)
+
+        discount_factors = self.discount_factors if self.discount_factors is not None else np.zeros(self.months)
+        for discounted, expected in results_store.DISCOUNTED_LEGS.items():
+            index = list(EXPECTED_LEGS.values()).index(expected)
+            yearly[discounted] = (self.cashflows[index] * discount_factors).reshape(-1, 12).sum(axis=1)
+
+        return yearly
+
+    def life_expectancy_distribution(self):
+        '''
+            number of units by whole years of main member, spouse and last life expectancy.
+        '''
+        years = max((len(counts) for counts in self.life_expectancy_counts.values()), default=0)
+        distribution = pd.DataFrame({'Years': np.arange(years)})
+        for name, column in LIFE_EXPECTANCIES.items():
+            counts = self.life_expectancy_counts[name]
+            distribution[column] = np.concatenate([counts, np.zeros(years - len(counts), dtype=np.int64)])
+
+        return distribution
+
+    def frames(self):
+        '''
+            every aggregate as a DataFrame, keyed by a sheet name.
+        '''
+        return {
+            'NPV Totals': self.npv_summary(),
+            'Yearly Cashflows': self.yearly_cashflows(),
+            'Life Expectancies': self.life_expectancy_distribution(),
+        }
+
+
+class SummaryWriter:
+    '''
+        writes per unit summaries to a .csv or .parquet file, a chunk at a time.
+
+        The Parquet schema is taken from the first chunk.
+    '''
+
+    def __init__(self, path):
+        if not path.endswith(('.csv', '.parquet')):
+            raise ValueError(f'Unsupported summary file {path}, expected .csv or .parquet')
+
+        self.path = path
+        self.rows = 0
+        self.writer = None
+
+    def write(self, frame):
+        if self.path.endswith('.csv'):
+            frame.to_csv(self.path, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        else:
+            pa = results_store.import_pyarrow()
+            if self.writer is None:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                self.writer = pa.parquet.ParquetWriter(self.path, table.schema)
+            else:
+                table = pa.Table.from_pandas(frame, schema=self.writer.schema, preserve_index=False)
+            self.writer.write_table(table)
+
+        self.rows += len(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cli
+
+
+@pytest.fixture(scope='session')
+def mortality_tables():
+    return cli.load_mortality_tables(cli.DEFAULT_PARAMETERS['mortality_table'])
+
+
+@pytest.fixture
+def parameters():
+    return {name: cli.DEFAULT_PARAMETERS[name] for name in cli.MAIN_PARAMETERS}
+
+
+@pytest.fixture
+def units():
+    return pd.DataFrame({
+        'ID': ['A', 'B', 'C'],
+        'Main Member Age': [70, 78, 85],
+        'Main Member Gender': ['Male', 'Female', 'Female'],
+        'Spouse Age': [68, 80, None],
+        'Spouse Gender': ['Female', 'Male', None],
+    })
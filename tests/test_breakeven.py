@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import breakeven
+from model import Model
+
+
+@pytest.fixture
+def parameters(parameters):
+    return dict(parameters, monthly_expense=2000, replacement=True, refund_on_resale_pct=80, refund_on_resale_duration=10)
+
+
+@pytest.mark.parametrize('solve_for', ['purchase_price_input', 'monthly_fee', 'discount_rate'])
+def test_npv_at_breakeven_is_zero(units, mortality_tables, parameters, solve_for):
+    model = Model(units)
+    values = model.solve_breakeven(units, mortality_tables, solve_for=solve_for, tolerance=1e-9, **parameters).iloc[:, 1].to_numpy()
+
+    for position, value in enumerate(values):
+        if np.isnan(value):
+            continue
+        npv = model.npv_components(units.iloc[[position]], mortality_tables, **dict(parameters, **{solve_for: value}))['NPV']
+        assert abs(npv[0]) < 1e-3
+
+
+def test_breakeven_without_bracket(units, mortality_tables, parameters):
+    # the NPV of unit B stays positive at every discount rate in BREAKEVEN_BOUNDS
+    values = Model(units).solve_breakeven(units, mortality_tables, solve_for='discount_rate', **parameters)['Break-even Discount Rate']
+
+    assert values.isna().tolist() == [False, True, False]
+
+
+def test_bisect():
+    roots = breakeven.bisect(lambda x: x ** 2 - np.array([2.0, 9.0, -1.0]), [0, 0, 0], [10, 10, 10], tolerance=1e-10)
+
+    np.testing.assert_allclose(roots[:2], [np.sqrt(2), 3], atol=1e-9)
+    assert np.isnan(roots[2])
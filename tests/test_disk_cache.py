@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import disk_cache
+from model import Model
+
+
+def test_cache_hit_returns_same_results(tmp_path, units, mortality_tables, parameters):
+    cache = disk_cache.DiskCache(str(tmp_path))
+    model = Model(units, result_cache=cache)
+    results = model.main(units, mortality_tables, **parameters)
+
+    cached = Model(units, result_cache=cache)
+    cached_results = cached.main(units, mortality_tables, **parameters)
+
+    assert (cache.stats()['hits'], cache.stats()['writes']) == (1, 1)
+    pd.testing.assert_frame_equal(cached_results, results)
+    np.testing.assert_array_equal(cached.store.values, model.store.values)
+    pd.testing.assert_frame_equal(cached.all_workings['C'], model.all_workings['C'])
+
+
+def test_eviction_keeps_cache_within_max_bytes(tmp_path):
+    entry = {'values': np.zeros(1000)}
+    cache = disk_cache.DiskCache(str(tmp_path))
+    cache.put('a', entry)
+    cache.max_bytes = 3 * cache.stats()['bytes']
+
+    for index, key in enumerate(['a', 'b', 'c', 'd', 'e']):
+        cache.put(key, entry)
+        # distinct last used times, oldest first
+        os.utime(cache.path(key), ns=(index * 10**9, index * 10**9))
+    cache.put('f', entry)
+
+    stats = cache.stats()
+    assert stats['bytes'] <= cache.max_bytes
+    assert stats['evictions'] == 3
+    assert [key for _, _, key in cache.entries()] == ['d', 'e', 'f']
+    np.testing.assert_array_equal(cache.get('f')['values'], entry['values'])
+    assert cache.get('a') is None
+
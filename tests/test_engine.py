@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+import engine
+
+
+@pytest.mark.parametrize('discount_rate', [10, 0])
+def test_level_present_values_match_discounted_cashflows(discount_rate):
+    months = 480
+    occupied = engine.occupied_months(np.array([0, 11, 200, 600]), months, replacement=False)
+    amount = np.array([1000.0, 1000.0, 2500.0, 750.0])
+
+    # a level leg of amount in each occupied month
+    cashflows = np.where(np.arange(months) < occupied[:, None], amount[:, None], 0.0)
+    factors = engine.discount_factors(discount_rate, months)
+    annuity = engine.annuity_factors(discount_rate, months)
+
+    np.testing.assert_allclose(engine.level_present_values(amount, occupied, annuity), engine.present_values(cashflows, factors), rtol=1e-12)
+
+
+def test_annuity_factors_at_zero_discount_rate():
+    np.testing.assert_array_equal(engine.annuity_factors(0, 12), np.arange(13))
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from model import Model
+
+
+def test_double_unit_without_spouse(units, mortality_tables, parameters):
+    parameters['single_double'] = 'Double'
+
+    with pytest.raises(ValueError, match='Double units need spouse details, missing for units C'):
+        Model(units).expected_value(units, mortality_tables, **parameters)
+
+
+@pytest.mark.parametrize('single_double', ['Single', 'Double'])
+def test_expected_value_matches_simulated_mean(units, mortality_tables, parameters, single_double):
+    units = units.iloc[:2]
+    parameters.update(single_double=single_double, replacement=True, refund_on_resale_pct=80, refund_on_resale_duration=10)
+    model = Model(units)
+
+    expected = model.expected_value(units, mortality_tables, **parameters)
+    paths = 200000
+    simulation = model.simulate(units, mortality_tables, paths=paths, seed=1, **parameters)
+
+    # within four standard errors of the simulated mean
+    standard_errors = np.abs(simulation['Mean NPV'] - expected['NPV']) / (simulation['Std NPV'] / np.sqrt(paths))
+    assert (standard_errors < 4).all(), standard_errors.tolist()
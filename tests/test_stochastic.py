@@ -0,0 +1,20 @@
+import pytest
+
+from model import Model
+
+
+def test_double_unit_without_spouse(units, mortality_tables, parameters):
+    parameters['single_double'] = 'Double'
+    model = Model(units)
+
+    with pytest.raises(ValueError, match='Double units need spouse details, missing for units C'):
+        model.simulate(units, mortality_tables, paths=100, seed=1, **parameters)
+    with pytest.raises(ValueError, match='Double units need spouse details, missing for units C'):
+        model.main(units, mortality_tables, **parameters)
+
+
+def test_single_unit_without_spouse(units, mortality_tables, parameters):
+    model = Model(units)
+    simulation = model.simulate(units, mortality_tables, paths=100, seed=1, **parameters)
+
+    assert simulation['ID'].tolist() == ['A', 'B', 'C']